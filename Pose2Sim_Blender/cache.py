@@ -0,0 +1,291 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+'''
+    ##################################################
+    ## BINARY CACHE FOR PARSED DATA FILES           ##
+    ##################################################
+
+    Parsing .trc, .mot and .csv text files is slow.
+    Once a file has been parsed, its content is saved as a binary .npz file
+    in a user cache directory, so that next imports of the same file skip text parsing.
+
+    Cache entries are keyed by file path, size, modification time, and content hash.
+    The cache size is bounded: least recently used entries are evicted first.
+    Set USE_CACHE to False (or the POSE2SIM_BLENDER_NO_CACHE environment variable)
+    to disable it, or pass use_cache=False to the loading functions.
+
+    Very large files can instead be converted to a raw .npy file, 
+    which is memory-mapped rather than loaded (see cached_memmap).
+
+    Decoded geometry files are stored in a versioned subdirectory (see geometry_cache_path).
+    They are keyed by path and modification time only, so that checking them is cheap.
+
+'''
+
+## INIT
+import os
+import json
+import hashlib
+import atexit
+import tempfile
+import numpy as np
+
+USE_CACHE = not os.environ.get('POSE2SIM_BLENDER_NO_CACHE')
+CACHE_DIR = os.environ.get('POSE2SIM_BLENDER_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'Pose2Sim_Blender'))
+MAX_CACHE_SIZE = 500 * 1024**2 # bytes
+CACHE_VERSION = 2
+GEOMETRY_CACHE_VERSION = 1
+GEOMETRY_CACHE_DIR = os.path.join(CACHE_DIR, f'geometry_v{GEOMETRY_CACHE_VERSION}')
+TEMP_FILES = [] # memory-mapped files outside of the cache directory, deleted on exit
+
+
+## AUTHORSHIP INFORMATION
+__author__ = "David Pagnon"
+__copyright__ = "Copyright 2023, Pose2Sim_Blender"
+__credits__ = ["David Pagnon"]
+__license__ = "MIT License"
+__version__ = "0.7.0"
+__maintainer__ = "David Pagnon"
+__email__ = "contact@david-pagnon.com"
+__status__ = "Development"
+
+
+## FUNCTIONS
+def cache_key(file_path, tag=''):
+    '''
+    Key of a file in the cache, from its path, size, modification time and content
+
+    INPUTS:
+    - file_path: path to the source file
+    - tag: name of the parser, so that one file can be cached by several parsers
+
+    OUTPUT:
+    - key: hexadecimal string
+    '''
+
+    file_path = os.path.abspath(file_path)
+    stat = os.stat(file_path)
+    h = hashlib.blake2b(digest_size=16)
+    h.update(f'{CACHE_VERSION}|{tag}|{file_path}|{stat.st_size}|{stat.st_mtime_ns}|'.encode())
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024**2), b''):
+            h.update(chunk)
+
+    return h.hexdigest()
+
+
+def save_to_cache(cache_path, outputs):
+    '''
+    Save the outputs of a parser to a .npz file.
+    Numpy arrays are stored as is, other outputs (names, flags) as a JSON header.
+    '''
+
+    arrays = {f'arr_{i}': o for i, o in enumerate(outputs) if isinstance(o, np.ndarray)}
+    header = {str(i): o for i, o in enumerate(outputs) if not isinstance(o, np.ndarray)}
+    header['n_outputs'] = len(outputs)
+
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    tmp_path = cache_path[:-4] + f'.tmp.{os.getpid()}.npz' # one per process, for parallel Blender instances
+    np.savez(tmp_path, header=np.array(json.dumps(header)), **arrays)
+    os.replace(tmp_path, cache_path)
+
+
+def read_from_cache(cache_path):
+    '''
+    Read the outputs of a parser from a .npz file created by save_to_cache
+    '''
+
+    with np.load(cache_path, allow_pickle=False) as cached:
+        header = json.loads(str(cached['header']))
+        outputs = [cached[f'arr_{i}'] if f'arr_{i}' in cached.files else header[str(i)]
+                   for i in range(header['n_outputs'])]
+
+    return tuple(outputs)
+
+
+def evict_cache(cache_dir=None, max_size=None, keep=None):
+    '''
+    Delete least recently used cache entries until the cache is smaller than max_size.
+    The entry at path keep is never deleted.
+    '''
+
+    cache_dir = CACHE_DIR if cache_dir is None else cache_dir
+    max_size = MAX_CACHE_SIZE if max_size is None else max_size
+    if not os.path.isdir(cache_dir):
+        return
+
+    entries = [e for e in os.scandir(cache_dir) 
+               if e.is_file() and e.name.endswith(('.npz', '.npy')) and '.tmp.' not in e.name]
+    entries = sorted(entries, key=lambda e: e.stat().st_mtime)
+    total_size = sum(e.stat().st_size for e in entries)
+    for e in entries:
+        if total_size <= max_size:
+            break
+        if keep is not None and os.path.abspath(e.path) == os.path.abspath(keep):
+            continue
+        try:
+            total_size -= e.stat().st_size
+            os.remove(e.path)
+        except OSError:
+            pass
+
+
+def cached_load(file_path, parser, tag='', use_cache=True):
+    '''
+    Parse a file, or retrieve its parsed content from the cache.
+    Any problem with the cache falls back to parsing the file.
+
+    INPUTS:
+    - file_path: path to the file to parse
+    - parser: function taking file_path and returning a tuple of outputs
+      (numpy arrays, and JSON serializable objects)
+    - tag: name of the parser
+    - use_cache: if False, just parse the file (default: True)
+
+    OUTPUT:
+    - outputs of parser(file_path)
+    '''
+
+    if not (use_cache and USE_CACHE):
+        return parser(file_path)
+
+    try:
+        cache_path = os.path.join(CACHE_DIR, f'{tag}_{cache_key(file_path, tag=tag)}.npz')
+    except OSError:
+        return parser(file_path)
+    if os.path.isfile(cache_path):
+        try:
+            outputs = read_from_cache(cache_path)
+            os.utime(cache_path) # mark as recently used
+            return outputs
+        except Exception:
+            pass # corrupted entry, parse again and overwrite it
+
+    outputs = parser(file_path)
+    try:
+        save_to_cache(cache_path, outputs)
+        evict_cache(keep=cache_path)
+    except Exception as e:
+        print(f'Could not write to cache {CACHE_DIR}: {e}')
+
+    return outputs
+
+
+def cached_memmap(file_path, writer, tag='', use_cache=True):
+    '''
+    Convert a file to a binary .npy file, or retrieve it from the cache,
+    and memory-map it: data stays on disk and is only read when accessed.
+
+    INPUTS:
+    - file_path: path to the file to convert
+    - writer: function taking file_path and npy_path, and writing a .npy file
+    - tag: name of the writer
+    - use_cache: if False, convert again instead of reusing a previous conversion (default: True).
+      The new file is still written to the cache directory, so that it is evicted like other entries
+
+    OUTPUT:
+    - data: read-only numpy memmap
+    '''
+
+    npy_path = None
+    if use_cache and USE_CACHE:
+        try:
+            npy_path = os.path.join(CACHE_DIR, f'{tag}_{cache_key(file_path, tag=tag)}.npy')
+            os.makedirs(CACHE_DIR, exist_ok=True)
+        except OSError:
+            npy_path = None
+    if npy_path is None:
+        try:
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            fd, npy_path = tempfile.mkstemp(suffix='.npy', prefix=f'{tag}_', dir=CACHE_DIR)
+        except OSError: # cache directory not writable
+            fd, npy_path = tempfile.mkstemp(suffix='.npy', prefix=f'{tag}_')
+            TEMP_FILES.append(npy_path)
+        os.close(fd)
+        writer(file_path, npy_path)
+        try:
+            evict_cache(keep=npy_path)
+        except OSError:
+            pass
+        return np.load(npy_path, mmap_mode='r')
+
+    if os.path.isfile(npy_path):
+        try:
+            data = np.load(npy_path, mmap_mode='r')
+            os.utime(npy_path) # mark as recently used
+            return data
+        except Exception:
+            pass # corrupted entry, convert again and overwrite it
+
+    tmp_path = npy_path[:-4] + f'.tmp.{os.getpid()}.npy'
+    writer(file_path, tmp_path)
+    os.replace(tmp_path, npy_path)
+    try:
+        evict_cache(keep=npy_path)
+    except OSError:
+        pass
+
+    return np.load(npy_path, mmap_mode='r')
+
+
+def remove_temp_files():
+    '''
+    Delete memory-mapped files written outside of the cache directory.
+    Called on exit.
+    '''
+
+    while TEMP_FILES:
+        try:
+            os.remove(TEMP_FILES.pop())
+        except OSError:
+            pass
+
+
+def geometry_cache_path(mesh_path):
+    '''
+    Path of the decoded version of a mesh file in the geometry cache.
+    The name changes when the source file is modified.
+
+    INPUT:
+    - mesh_path: path to the source mesh file
+
+    OUTPUT:
+    - cache_path: path to a .npz file, which may not exist yet
+    '''
+
+    mesh_path = os.path.abspath(mesh_path)
+    stat = os.stat(mesh_path)
+    path_hash = hashlib.blake2b(mesh_path.encode(), digest_size=8).hexdigest()
+    name = os.path.basename(mesh_path).split('.')[0]
+
+    return os.path.join(GEOMETRY_CACHE_DIR, f'{name}_{path_hash}_{stat.st_size}_{stat.st_mtime_ns}.npz')
+
+
+def remove_stale_geometry(cache_path):
+    '''
+    Delete the cache entries of older versions of the same source file
+    '''
+
+    prefix = '_'.join(os.path.basename(cache_path).split('_')[:-2]) + '_'
+    cache_dir = os.path.dirname(cache_path)
+    for e in os.scandir(cache_dir):
+        if e.name.startswith(prefix) and e.path != cache_path and '.tmp.' not in e.name:
+            try:
+                os.remove(e.path)
+            except OSError:
+                pass
+
+
+def clear_cache(cache_dir=None):
+    '''
+    Delete all cache entries, including decoded geometry
+    '''
+
+    evict_cache(cache_dir=cache_dir, max_size=0)
+    geometry_dir = GEOMETRY_CACHE_DIR if cache_dir is None else os.path.join(cache_dir, os.path.basename(GEOMETRY_CACHE_DIR))
+    evict_cache(cache_dir=geometry_dir, max_size=0)
+
+
+atexit.register(remove_temp_files)
@@ -12,7 +12,7 @@
     
     - Read a .toml calibration file and imports cameras
     - Find all cameras in the scene and export their properties as a .toml calibration file
-    - 
+    - Reproject markers into all cameras and report reprojection errors (see reprojection.py)
 
 '''
 
@@ -24,7 +24,15 @@ import numpy as np
 import os
 import toml
 import sys
-from .common import ShowMessageBox
+try:
+    import tomllib # Python 3.11+ (Blender 4.0+), faster than toml
+except ImportError:
+    tomllib = None
+from .common import ShowMessageBox, createMaterial, mat_to_euler, euler_to_mat, bulk_keyframe_insert, keyframe_frames, sample_property
+from .markers import load_trc
+from . import skeletons
+from anytree import PreOrderIter
+from . import reprojection
 
 RAY_WIDTH = 0/1000
 COLOR = (0.8, 0.4, 0.1, 0.8)
@@ -92,43 +100,65 @@ def rod_to_mat(rodrigues_vec):
     '''
     Transform Rodrigues vector to rotation matrix without cv2
     https://stackoverflow.com/questions/62345076/how-to-convert-a-rodrigues-vector-to-a-rotation-matrix-without-opencv-using-pyth
+
+    Also accepts a stack of Rodrigues vectors of shape (n, 3), 
+    and then returns rotation matrices of shape (n, 3, 3)
     '''
     
-    rodrigues_vec = rodrigues_vec.flatten()
-    theta = np.linalg.norm(rodrigues_vec)
-    if theta < sys.float_info.epsilon:
-        rotation_mat = np.eye(3, dtype=float)
-    else:
-        r = rodrigues_vec / theta
-        I = np.eye(3, dtype=float)
-        r_rT = np.array([
-            [r[0]*r[0], r[0]*r[1], r[0]*r[2]],
-            [r[1]*r[0], r[1]*r[1], r[1]*r[2]],
-            [r[2]*r[0], r[2]*r[1], r[2]*r[2]]
-        ])
-        r_cross = np.array([
-            [0, -r[2], r[1]],
-            [r[2], 0, -r[0]],
-            [-r[1], r[0], 0]
-        ])
-        rotation_mat = np.cos(theta) * I + (1 - np.cos(theta)) * r_rT + np.sin(theta) * r_cross
-    return rotation_mat
+    rodrigues_vec = np.asarray(rodrigues_vec, dtype=float)
+    single = rodrigues_vec.size == 3 and rodrigues_vec.ndim <= 2 and rodrigues_vec.shape != (1,3)
+    r_vecs = rodrigues_vec.reshape(-1, 3)
+    
+    theta = np.linalg.norm(r_vecs, axis=1)
+    small = theta < sys.float_info.epsilon
+    r = r_vecs / np.where(small, 1., theta)[:,None]
+    I = np.eye(3, dtype=float)
+    r_rT = r[:,:,None] * r[:,None,:]
+    r_cross = np.zeros((len(r), 3, 3))
+    r_cross[:,0,1], r_cross[:,0,2] = -r[:,2], r[:,1]
+    r_cross[:,1,0], r_cross[:,1,2] = r[:,2], -r[:,0]
+    r_cross[:,2,0], r_cross[:,2,1] = -r[:,1], r[:,0]
+    cos, sin = np.cos(theta)[:,None,None], np.sin(theta)[:,None,None]
+    rotation_mat = cos * I + (1 - cos) * r_rT + sin * r_cross
+    rotation_mat[small] = I
+    
+    return rotation_mat[0] if single else rotation_mat
+
+
+def projection_matrices(K, R, T):
+    '''
+    Projection matrices P = [K|0] @ [[R,T],[0,1]], for static or moving cameras.
+    Stacks of intrinsics (n, 3, 3) and/or extrinsics (n, 3, 3) and (n, 3) 
+    give a stack of projection matrices (n, 3, 4), computed at once.
+    '''
+    
+    K, R, T = np.asarray(K, dtype=float), np.asarray(R, dtype=float), np.asarray(T, dtype=float)
+    Kh = np.concatenate([K, np.zeros(K.shape[:-1]+(1,))], axis=-1)
+    H = np.zeros(np.broadcast_shapes(R.shape[:-2], T.shape[:-1]) + (4,4))
+    H[...,:3,:3] = R
+    H[...,:3,3] = T
+    H[...,3,3] = 1
+    
+    return Kh @ H
 
 
 def mat_to_rod(rotation_mat):
     '''
     Transform rotation matrix to Rodrigues vector without cv2
     https://docs.opencv.org/4.2.0/d9/d0c/group__calib3d.html#ga61585db663d9da06b68e70cfbf6a1eac
+    
+    Also accepts a stack of rotation matrices of shape (n, 3, 3),
+    and then returns Rodrigues vectors of shape (n, 3)
     '''
     
-    tr = np.trace(rotation_mat) # tr=1+2cos(theta)
-    if tr == 3.0: # no rotation
-        return np.array([0.,0.,0.])
-    theta = np.arccos((tr-1)/2)
-    r_cross_sin = (rotation_mat - rotation_mat.T) /2
-    r_sin = np.array([-r_cross_sin[1][2], r_cross_sin[0][2], -r_cross_sin[0][1]])
-    r_vec = r_sin / np.sin(theta)
-    r_vec *= theta
+    rotation_mat = np.asarray(rotation_mat, dtype=float)
+    tr = np.trace(rotation_mat, axis1=-2, axis2=-1) # tr=1+2cos(theta)
+    theta = np.arccos(np.clip((tr-1)/2, -1, 1))
+    r_cross_sin = (rotation_mat - np.swapaxes(rotation_mat, -1, -2)) /2
+    r_sin = np.stack([-r_cross_sin[...,1,2], r_cross_sin[...,0,2], -r_cross_sin[...,0,1]], axis=-1)
+    sin = np.sin(theta)
+    no_rotation = (tr == 3.0) | (sin == 0)
+    r_vec = r_sin * np.where(no_rotation, 0., theta / np.where(no_rotation, 1., sin))[...,None]
     return r_vec
 
 
@@ -140,10 +170,12 @@ def world_to_camera_persp(r, t):
     and inversely.
 
     Qc = RQ+T --> Q = R-1.Qc - R-1.T
+    
+    Also accepts stacks of rotations (n, 3, 3) and translations (n, 3)
     '''
 
-    r = r.T
-    t = - r @ t
+    r = np.swapaxes(np.asarray(r, dtype=float), -1, -2)
+    t = - (r @ np.asarray(t, dtype=float)[...,None])[...,0]
 
     return r, t
     
@@ -158,6 +190,54 @@ def set_loc_rotation(obj, value):
     obj.rotation_euler = (obj.rotation_euler.to_matrix() @ rot.to_matrix()).to_euler(obj.rotation_mode)
     
     
+def camera_poses(R, T):
+    '''
+    Location and Euler rotation of Blender cameras from calibrated extrinsics,
+    for all frames at once.
+    Same as setting matrix_world, rotating by 180° around the local x axis 
+    (see set_loc_rotation), and subtracting 90° from the z Euler angle.
+    
+    INPUTS:
+    - R: rotation matrices, shape (3, 3) or (n_frames, 3, 3)
+    - T: translation vectors, shape (3,) or (n_frames, 3)
+    
+    OUTPUTS:
+    - location: shape (3,) or (n_frames, 3)
+    - rotation_euler: 'XYZ' Euler angles, continuous from one frame to the next, shape (3,) or (n_frames, 3)
+    '''
+    
+    r, t = world_to_camera_persp(R, T)
+    location = np.stack([t[...,1], -t[...,0], t[...,2]], axis=-1)
+    rot_180 = np.diag([1., -1., -1.])
+    rotation_euler = mat_to_euler(r @ rot_180, compatible=r.ndim==3)
+    rotation_euler[...,2] -= np.pi/2
+    
+    return location, rotation_euler
+
+
+def lens_from_intrinsics(camera, K, w, h):
+    '''
+    Focal length (mm) of a Blender camera from calibrated intrinsics,
+    for all frames at once. Same as setting camera.angle to the largest field of view.
+    
+    INPUTS:
+    - camera: Blender camera data (bpy.types.Camera)
+    - K: intrinsic matrices, shape (3, 3) or (n_frames, 3, 3)
+    - w, h: image dimensions (px)
+    
+    OUTPUT:
+    - lens: focal length, float or shape (n_frames,)
+    '''
+    
+    K = np.asarray(K, dtype=float)
+    fov_x = 2 * np.arctan2(w, 2 * K[...,0,0])
+    fov_y = 2 * np.arctan2(h, 2 * K[...,1,1])
+    fov = np.maximum(fov_x, fov_y)
+    sensor = camera.sensor_height if camera.sensor_fit == 'VERTICAL' else camera.sensor_width
+    
+    return sensor / (2 * np.tan(fov/2))
+
+
 def f_from_fov(fov):
     '''
     Retrieve focal length from fov and from render_settings, with:
@@ -199,14 +279,8 @@ def add_bezier(v0 , v1, color=COLOR, ray_width=RAY_WIDTH):
     if not 'COLOR' in globals():
         color = (0.8, 0.4, 0.1, 0.8)
         
-    # Color
-    matg = bpy.data.materials.new("Orange")
-    matg.use_nodes = True
-    tree = matg.node_tree
-    nodes = tree.nodes
-    bsdf = nodes["Principled BSDF"]
-    bsdf.inputs["Base Color"].default_value = color
-    matg.diffuse_color = color
+    # Color, shared by all rays
+    matg = createMaterial(color=color, metallic = 0., roughness = 0.5)
     
     # middle point of the Bezier curve
     v0, v1 = mathutils.Vector(v0), mathutils.Vector(v1)  
@@ -234,6 +308,7 @@ def add_bezier(v0 , v1, color=COLOR, ray_width=RAY_WIDTH):
     curve.dimensions = '3D'
     curve.bevel_depth = ray_width
     curve.bevel_resolution = 3
+    curve.materials.append(matg)
     
     # Move gizmo from median part of the nurb to its extremity
     set_mesh_origin(ob, v0)
@@ -259,8 +334,11 @@ def retrieveCal_fromFile(toml_path):
     Output a dialog window to choose calibration file.
     '''
     N, S, D, K, R, T, P, moving = {}, {}, {}, {}, {}, {}, {}, {}
-    Kh, H = {}, {}
-    cal = toml.load(toml_path)
+    if tomllib is not None:
+        with open(toml_path, 'rb') as f:
+            cal = tomllib.load(f)
+    else:
+        cal = toml.load(toml_path)
     cal_keys = [c for c in cal.keys() if c not in ['metadata', 'capture_volume', 'charuco', 'checkerboard'] and isinstance(cal[c],dict)]
     for cam in cal_keys:
         try:
@@ -271,41 +349,13 @@ def retrieveCal_fromFile(toml_path):
         N[cam] = cal[cam].get('name') if cal[cam].get('name') else cam
         S[cam] = np.array(cal[cam]['size'])
         D[cam] = np.array(cal[cam]['distortions'])
-        K[cam] = np.array(cal[cam]['matrix'])
-        T[cam] = np.array(cal[cam]['translation'])
         
-        R[cam], P[cam], Kh[cam], H[cam] = [], [], [], []
-        
-        if moving[cam]:
-            if 'intr' in moving[cam]:
-                for i in range(len(K[cam])):
-                    Kh[cam].append(np.block([K[cam][i], np.zeros(3).reshape(3,1)]))
-            else:
-                Kh[cam] = np.block([K[cam], np.zeros(3).reshape(3,1)])
-        
-            if 'extr' in moving[cam]:
-                for i in range(len(T[cam])):
-                    R[cam].append(rod_to_mat(np.array(cal[cam]['rotation'][i])))
-                    H[cam].append(np.block([[R[cam][i],T[cam][i].reshape(3,1)], [np.zeros(3), 1 ]]))
-            else:
-                R[cam] = rod_to_mat(np.array(cal[cam]['rotation']))
-                H[cam] = np.block([[R[cam],T[cam].reshape(3,1)], [np.zeros(3), 1 ]])
-                    
-            if 'extr' in moving[cam] and 'intr' in moving[cam]:
-                for i in range(len(T[cam])):
-                    P[cam].append(Kh[cam][i] @ H[cam][i])
-            elif 'extr' in moving[cam] and 'intr' not in moving[cam]:
-                for i in range(len(T[cam])):
-                    P[cam].append(Kh[cam] @ H[cam][i])
-            elif 'intr' in moving[cam] and 'extr' not in moving[cam]:
-                for i in range(len(K[cam])):
-                    P[cam].append(Kh[cam][i] @ H[cam])
-            
-        else:
-            R[cam] = rod_to_mat(np.array(cal[cam]['rotation']))
-            H[cam] = np.block([[R[cam],T[cam].reshape(3,1)], [np.zeros(3), 1 ]])
-            Kh[cam] = np.block([K[cam], np.zeros(3).reshape(3,1)])
-            P[cam] = Kh[cam] @ H[cam]
+        # moving intrinsics/extrinsics are stacked along the first axis, one row per frame
+        K[cam] = np.array(cal[cam]['matrix'], dtype=float)
+        T[cam] = np.array(cal[cam]['translation'], dtype=float)
+        rotation = np.array(cal[cam]['rotation'], dtype=float)
+        R[cam] = rod_to_mat(rotation.reshape(-1,3) if (moving[cam] and 'extr' in moving[cam]) else rotation)
+        P[cam] = projection_matrices(K[cam], R[cam], T[cam])
         
     return N, S, D, K, R, T, P, moving
 
@@ -313,6 +363,10 @@ def retrieveCal_fromFile(toml_path):
 def retrieveCal_fromScene(cameras):
     '''
     Retrieve calibration parameters from cameras in the scene.
+    
+    Animated cameras are sampled at each frame, from frame 1 to their last keyframe,
+    so that their export is exact even with non-uniform keyframes.
+    Calibration parameters of animated cameras are stacked along the first axis, one row per frame.
     '''
     
     # image dimensions (only accurate if all cameras have the same resolution?)
@@ -320,94 +374,76 @@ def retrieveCal_fromScene(cameras):
     w = render_settings.resolution_x
     h = render_settings.resolution_y
     S = [[w, h]] * len(cameras)
+    max_wh = np.max([w,h])
     
     # distortions are neglected at the moment
     distortions = [0.0, 0.0, 0.0, 0.0]
     D = [distortions] * len(cameras)
     
-    N, K, R, T, P = [], [], [], [], []
+    rot_180 = np.diag([1., -1., -1.])
+    rot_90 = np.array([[0., -1., 0.], [1., 0., 0.], [0., 0., 1.]])
+    N, K, R, T, P, moving = [], [], [], [], [], []
     for camera_obj in cameras:
         # camera name
-        name = camera_obj.name
-        camera = bpy.data.cameras[camera_obj.name]
-        N += [name]
+        N += [camera_obj.name]
+        camera = camera_obj.data
+        moving_cam = []
         
         # principal point
-        max_wh = np.max([w,h])
         cx = max_wh * camera.shift_x + w/2
         cy = max_wh * camera.shift_y + h/2
         
+        # frames: from 1 to the last keyframe of intrinsics or extrinsics
+        lens_frames = keyframe_frames(camera, ['lens'])
+        extr_frames = keyframe_frames(camera_obj, ['location', 'rotation_euler'])
+        last_frame = np.max(np.concatenate([lens_frames, extr_frames, [1.]]))
+        frames = np.arange(1, np.ceil(last_frame)+1)
+        
         # focal distance (px)
-        if not has_keyframe(camera, "lens"):
-            fov = camera.angle
-            f_1 = w / ( 2 * np.tan(fov/2) )
-            f_2 = h / ( 2 * np.tan(fov/2) )
-            f = np.max([f_1, f_2])
-            
-            K += [[[f, 0.0, cx], [0.0, f, cy], [0.0, 0.0, 1.0]]]
-            
+        sensor = camera.sensor_height if camera.sensor_fit == 'VERTICAL' else camera.sensor_width
+        if len(lens_frames) == 0:
+            lens = np.array(camera.lens)
         else:
-            K_cam = []
-            for fc in camera.animation_data.action.fcurves:
-                if 'lens' in fc.data_path:
-                    for key in fc.keyframe_points:                      # each frame
-                        lens = key.co[1]
-                        f = lens * w / camera.sensor_width
-                        K_cam.append( [[f, 0.0, cx], [0.0, f, cy], [0.0, 0.0, 1.0]] )
-            K += [K_cam]
+            moving_cam += ['intr']
+            lens = sample_property(camera, 'lens', frames, camera.lens)[:,0]
+        f = lens * max_wh / sensor
+        K_cam = np.zeros(np.shape(f) + (3,3))
+        K_cam[...,0,0], K_cam[...,1,1] = f, f
+        K_cam[...,0,2], K_cam[...,1,2], K_cam[...,2,2] = cx, cy, 1.
         
         # rotation, translation
-        rot_180 = mathutils.Euler(np.radians([180,0,0]), 'ZYX').to_matrix()
-        rot_90 = np.array(mathutils.Euler([0,0,np.radians(90)]).to_matrix())
-        if not has_keyframe(camera_obj, "location") and not has_keyframe(camera_obj, "rotation_euler"):
-            # flip x
-            r = camera_obj.rotation_euler.to_matrix() @ rot_180
-            t = camera_obj.location
-            # rotate 90
-            t_new = rot_90 @ t
-            r_new = rot_90 @ r
-            
-            r_loc, t_loc = world_to_camera_persp(np.array(r_new), t_new)
-            
-            r_rod = mat_to_rod(r_loc)
-        
+        if len(extr_frames) == 0:
+            rotation = np.array(camera_obj.rotation_euler)
+            translation = np.array(camera_obj.location)
         else:
-            t_loc, r_rod = [], []
-            t_idx, r_idx, extr_len = 0, 0, 0
-            rotation = [[], [], []]
-            translation = [[], [], []]
-            for fc in camera_obj.animation_data.action.fcurves:  # each loc and rot
-                extr_len = len(fc.keyframe_points) if len(fc.keyframe_points) > extr_len else extr_len
-                if 'rotation' in fc.data_path:
-                    for key in fc.keyframe_points:                      # each frame
-                        rotation[r_idx].append(key.co[1])
-                    r_idx += 1
-                    
-                if 'location' in fc.data_path:
-                    for key in fc.keyframe_points:                      # each frame
-                        translation[t_idx].append(key.co[1])
-                    t_idx += 1
-            
-            rotation = np.array(rotation).T
-            translation = np.array(translation).T
-                    
-            for i in range(extr_len):
-                # flip x
-                r = mathutils.Euler(rotation[i]).to_matrix() @ rot_180
-                t = translation[i]
-                # rotate 90
-                t_new = rot_90 @ t
-                r_new = rot_90 @ r
-                
-                r_loc_i, t_loc_i = world_to_camera_persp(np.array(r_new), t_new)
-                
-                t_loc.append(list(t_loc_i))
-                r_rod.append(list(mat_to_rod(r_loc_i)))
+            moving_cam = ['extr'] + moving_cam
+            rotation = sample_property(camera_obj, 'rotation_euler', frames, camera_obj.rotation_euler)
+            translation = sample_property(camera_obj, 'location', frames, camera_obj.location)
+        # flip x, rotate 90
+        r_new = rot_90 @ euler_to_mat(rotation) @ rot_180
+        t_new = translation @ rot_90.T
+        r_loc, t_loc = world_to_camera_persp(r_new, t_new)
         
-        R += [list(r_rod)]
-        T += [list(t_loc)]
+        K += [K_cam]
+        R += [mat_to_rod(r_loc)]
+        T += [t_loc]
+        P += [projection_matrices(K_cam, r_loc, t_loc)]
+        moving += [moving_cam if moving_cam else False]
         
-    return S, D, N, K, R, T, P
+    return S, D, N, K, R, T, P, moving
+
+
+def toml_array(array):
+    '''
+    Format a (nested) numpy array or list as a TOML array, without loss of precision
+    '''
+    
+    def format_list(values):
+        if isinstance(values, list):
+            return '[' + ', '.join(format_list(v) for v in values) + ']'
+        return repr(values)
+    
+    return format_list(np.asarray(array).tolist())
 
 
 def write_calibration(calib_params, toml_path):
@@ -415,18 +451,20 @@ def write_calibration(calib_params, toml_path):
     Write calibration file from calibration parameters
     '''
     
-    S, D, N, K, R, T, P = calib_params
+    S, D, N, K, R, T, P = calib_params[:7]
+    moving = calib_params[7] if len(calib_params) > 7 else [False] * len(S)
     with open(toml_path, 'w+') as cal_f:
         for c in range(len(S)):
             cam_str = f'[{N[c]}]\n'
             name_str = f'name = "{N[c]}"\n'
-            size_str = f'size = {S[c]} \n'
-            mat_str = f'matrix = {K[c]} \n'
-            dist_str = f'distortions = {D[c]} \n' 
-            rot_str = f'rotation = {R[c]} \n'
-            tran_str = f'translation = {T[c]} \n'
+            size_str = f'size = {toml_array(S[c])} \n'
+            mat_str = f'matrix = {toml_array(K[c])} \n'
+            dist_str = f'distortions = {toml_array(D[c])} \n' 
+            rot_str = f'rotation = {toml_array(R[c])} \n'
+            tran_str = f'translation = {toml_array(T[c])} \n'
+            moving_str = f'moving = {toml_array(moving[c])}\n' if moving[c] else ''
             fish_str = f'fisheye = false\n\n'
-            cal_f.write(cam_str + name_str + size_str + mat_str + dist_str + rot_str + tran_str + fish_str)
+            cal_f.write(cam_str + name_str + size_str + mat_str + dist_str + rot_str + tran_str + moving_str + fish_str)
         meta = '[metadata]\nadjusted = false\nerror = 0.0\n'
         cal_f.write(meta)
 
@@ -460,47 +498,25 @@ def setup_cams(calib_params, collection=''):
         w, h = [int(i) for i in S[c]]
         
         # field of view
+        camera.type = 'PERSP'
+        camera.lens_unit = 'FOV'
+        lens = lens_from_intrinsics(camera, K[c], w, h)
         if moving[c] and 'intr' in moving[c]:
-            for n in range(0,len(K[c])):
-                fx, fy = K[c][n][0,0], K[c][n][1,1]
-                fov_x = 2 * np.arctan2(w, 2 * fx)
-                fov_y = 2 * np.arctan2(h, 2 * fy)
-                
-                camera.type = 'PERSP'
-                camera.lens_unit = 'FOV'
-                camera.angle = np.max([fov_x, fov_y])
-            
-                camera.keyframe_insert('lens', frame=n+1)
+            frames = np.arange(1, len(lens)+1)
+            bulk_keyframe_insert(camera, 'lens', frames, lens)
+            camera.lens = lens[0]
         else: 
-            fx, fy = K[c][0,0], K[c][1,1]
-            fov_x = 2 * np.arctan2(w, 2 * fx)
-            fov_y = 2 * np.arctan2(h, 2 * fy)
-            
-            camera.type = 'PERSP'
-            camera.lens_unit = 'FOV'
-            camera.angle = np.max([fov_x, fov_y])
+            camera.lens = lens
             
         # rotation and translation
+        location, rotation_euler = camera_poses(R[c], T[c])
         if moving[c] and 'extr' in moving[c]:
-            for n in range(0,len(R[c])):
-                r, t = world_to_camera_persp(R[c][n], T[c][n])
-                t = np.array([t[1], -t[0], t[2]])
-                homog_matrix = np.block([[r,t.reshape(3,1)], 
-                                        [np.zeros(3), 1 ]])
-                camera_obj.matrix_world = mathutils.Matrix(homog_matrix)
-                set_loc_rotation(camera_obj, np.radians([180,0,0]))
-                camera_obj.rotation_euler += np.radians([0, 0, -90])
-                
-                camera_obj.keyframe_insert('location', frame=n+1)
-                camera_obj.keyframe_insert('rotation_euler', frame=n+1)
+            frames = np.arange(1, len(location)+1)
+            bulk_keyframe_insert(camera_obj, 'location', frames, location, group='Object Transforms')
+            bulk_keyframe_insert(camera_obj, 'rotation_euler', frames, rotation_euler, group='Object Transforms')
+            camera_obj.location, camera_obj.rotation_euler = location[0], rotation_euler[0]
         else:
-            r, t = world_to_camera_persp(R[c], T[c])
-            t = np.array([t[1], -t[0], t[2]])
-            homog_matrix = np.block([[r,t.reshape(3,1)], 
-                                    [np.zeros(3), 1 ]])
-            camera_obj.matrix_world = mathutils.Matrix(homog_matrix)
-            set_loc_rotation(camera_obj, np.radians([180,0,0]))
-            camera_obj.rotation_euler += np.radians([0, 0, -90])
+            camera_obj.location, camera_obj.rotation_euler = location, rotation_euler
         
         # principal point # see https://blender.stackexchange.com/a/58236/174689
         if moving[c] and 'intr' in moving[c]:
@@ -735,9 +751,8 @@ def see_through_selected_camera():
         image = camera.children[0]
         image.empty_image_depth = 'BACK'
 
-    # hide curves
-    objects = bpy.ops.object.select_by_type(type='CURVE')
-    objects = bpy.context.selected_objects
+    # hide rays: Bezier curves, or ray meshes tagged by add_ray_bundle
+    objects = [ob for ob in bpy.context.view_layer.objects if ob.type == 'CURVE' or 'ray_objects' in ob]
     hide(objects, True)
         
     # # HERE I WANT TO DETECT AN ORBITAL CHANGE TO UNHIDE STUFF AND MAKE IMAGE DEPTH AUTO:
@@ -748,13 +763,223 @@ def see_through_selected_camera():
     # bpy.ops.object.detect_orbit('INVOKE_DEFAULT')
     
     
-def reproject_3D_points(collection=''):
+def reprojection_report(trc_path, toml_path, json_dirs=None, pose_model=None, first_frame=0,
+                        min_confidence=reprojection.MIN_CONFIDENCE, bin_size=reprojection.HEATMAP_BIN, output_dir=None):
+    '''
+    Reproject all markers of a .trc file into all cameras of a .toml calibration,
+    and report reprojection errors against 2D detections, or visibility if there are none.
+
+    INPUTS:
+    - trc_path: path to the .trc file, written by Pose2Sim (y-up)
+    - toml_path: path to the .toml calibration file
+    - json_dirs: None, a list of json folders in the order of the calibration cameras,
+      or a folder of json folders (paired with the cameras in alphabetical order, like in Pose2Sim)
+    - pose_model: name of the model from skeletons.py ('HALPE_26' for example),
+      to match marker names with keypoint indices
+    - first_frame: index of the json file of the first .trc frame (default: 0)
+    - min_confidence: keypoints with a lower confidence are ignored
+    - bin_size: number of frames per heatmap column
+    - output_dir: if not None, save statistics (json) and heatmaps (csv) in this folder
+
+    OUTPUTS:
+    - statistics: dict of camera name: dict of marker name: statistics (see reprojection.error_statistics)
+    - uv: reprojected markers, array of shape (n_cams, n_frames, n_markers, 2)
+    - heatmap: errors over time (n_cams, n_markers, n_bins), or None without detections
+    '''
+
+    trc_data_np, markerNames = load_trc(trc_path)
+    n_markers = len(markerNames)
+    points = reprojection.trc_to_calib(trc_data_np[:, 2:2+3*n_markers].reshape(-1, n_markers, 3))
+
+    N, S, D, K, R, T, P, moving = retrieveCal_fromFile(toml_path)
+    cams = list(N.keys())
+    cam_names = [N[c] for c in cams]
+    K_s, R_s, T_s, D_s = reprojection.stack_calibrations([K[c] for c in cams], [R[c] for c in cams],
+                                                         [T[c] for c in cams], [D[c] for c in cams], len(points))
+    uv, depth = reprojection.project_points(points, K_s, R_s, T_s, D_s)
+
+    if not json_dirs:
+        visible = reprojection.visibility(uv, [S[c] for c in cams])
+        statistics = reprojection.visibility_statistics(uv, visible, cam_names, markerNames)
+        heatmap = None
+    else:
+        if isinstance(json_dirs, str):
+            json_dirs = sorted(os.path.join(json_dirs, d) for d in os.listdir(json_dirs) if os.path.isdir(os.path.join(json_dirs, d)))
+        if len(json_dirs) != len(cams):
+            raise ValueError(f'{len(json_dirs)} json folders for {len(cams)} cameras.')
+        model_nodes = {}
+        if pose_model:
+            model_tree = getattr(skeletons, pose_model.upper(), None)
+            if not isinstance(model_tree, skeletons.Node):
+                raise ValueError(f'Unknown pose model {pose_model}. See skeletons.py for available models.')
+            model_nodes = {node.name: node.id for node in PreOrderIter(model_tree)}
+        keypoint_ids = [model_nodes.get(m) for m in markerNames]
+        xy = np.stack([reprojection.match_detections(uv[c], reprojection.read_json_detections(json_dir), keypoint_ids,
+                                                     min_confidence=min_confidence, first_frame=first_frame)
+                       for c, json_dir in enumerate(json_dirs)])
+        errors = reprojection.reprojection_errors(uv, xy)
+        statistics = reprojection.error_statistics(errors, cam_names, markerNames)
+        heatmap = reprojection.error_heatmap(errors, bin_size=bin_size)
+
+    reprojection.print_report(statistics)
+    if output_dir is not None:
+        reprojection.write_report(statistics, output_dir, heatmap=heatmap, cam_names=cam_names, marker_names=markerNames, bin_size=bin_size)
+
+    return statistics, uv, heatmap
+
+
+def ray_bundle_node_group(name, endpoints, ray_width=RAY_WIDTH, material=None):
+    '''
+    Geometry Nodes group which moves each end of the rays to the location of its object,
+    at each frame. Point i of the mesh follows endpoints[ray_end[i]],
+    where 'ray_end' is an integer point attribute.
+
+    INPUTS:
+    - name: name of the node group
+    - endpoints: list of objects the rays start or end at
+    - ray_width: radius of the rays, or 0 to only draw lines (default: RAY_WIDTH)
+    - material: material of the rays (default: None)
+
+    OUTPUT:
+    - node_group: bpy.types.GeometryNodeTree
+    '''
+
+    node_group = bpy.data.node_groups.new(name, 'GeometryNodeTree')
+    try: # Blender >= 4.0
+        node_group.interface.new_socket('Geometry', in_out='INPUT', socket_type='NodeSocketGeometry')
+        node_group.interface.new_socket('Geometry', in_out='OUTPUT', socket_type='NodeSocketGeometry')
+    except AttributeError: # Blender 3.6
+        node_group.inputs.new('NodeSocketGeometry', 'Geometry')
+        node_group.outputs.new('NodeSocketGeometry', 'Geometry')
+    nodes, links = node_group.nodes, node_group.links
+
+    group_input = nodes.new('NodeGroupInput')
+    group_input.location = (-200, 0)
+    ray_end = nodes.new('GeometryNodeInputNamedAttribute')
+    ray_end.data_type = 'INT'
+    ray_end.inputs['Name'].default_value = 'ray_end'
+    ray_end.location = (-200, -200)
+    ray_end_output = [o for o in ray_end.outputs if o.name == 'Attribute' and o.enabled][0]
+
+    # one Set Position node per object, on the points which follow it
+    geometry = group_input.outputs[0]
+    for i, ob in enumerate(endpoints):
+        object_info = nodes.new('GeometryNodeObjectInfo')
+        object_info.transform_space = 'RELATIVE'
+        object_info.inputs['Object'].default_value = ob
+        object_info.location = (200*i, -400)
+        compare = nodes.new('FunctionNodeCompare')
+        compare.data_type = 'INT'
+        compare.operation = 'EQUAL'
+        compare.location = (200*i, -200)
+        compare_a, compare_b = [s for s in compare.inputs if s.enabled][:2]
+        compare_b.default_value = i
+        set_position = nodes.new('GeometryNodeSetPosition')
+        set_position.location = (200*i, 0)
+
+        links.new(ray_end_output, compare_a)
+        links.new(geometry, set_position.inputs['Geometry'])
+        links.new(compare.outputs['Result'], set_position.inputs['Selection'])
+        links.new(object_info.outputs['Location'], set_position.inputs['Position'])
+        geometry = set_position.outputs['Geometry']
+
+    # tubes around the lines
+    x = 200*len(endpoints)
+    if ray_width > 0:
+        mesh_to_curve = nodes.new('GeometryNodeMeshToCurve')
+        mesh_to_curve.location = (x, 0)
+        profile = nodes.new('GeometryNodeCurvePrimitiveCircle')
+        profile.inputs['Resolution'].default_value = 8
+        profile.inputs['Radius'].default_value = ray_width
+        profile.location = (x, -200)
+        curve_to_mesh = nodes.new('GeometryNodeCurveToMesh')
+        curve_to_mesh.location = (x+200, 0)
+        links.new(geometry, mesh_to_curve.inputs['Mesh'])
+        links.new(mesh_to_curve.outputs['Curve'], curve_to_mesh.inputs['Curve'])
+        links.new(profile.outputs['Curve'], curve_to_mesh.inputs['Profile Curve'])
+        geometry = curve_to_mesh.outputs['Mesh']
+        x += 400
+
+    set_material = nodes.new('GeometryNodeSetMaterial')
+    set_material.inputs['Material'].default_value = material
+    set_material.location = (x, 0)
+    group_output = nodes.new('NodeGroupOutput')
+    group_output.location = (x+200, 0)
+    links.new(geometry, set_material.inputs['Geometry'])
+    links.new(set_material.outputs['Geometry'], group_output.inputs[0])
+
+    return node_group
+
+
+def add_ray_bundle(objects, cameras, collection, ray_width=RAY_WIDTH, color=COLOR):
+    '''
+    Add all rays from objects to cameras as the edges of a single mesh.
+    Its points follow the animated objects and cameras with Geometry Nodes,
+    so that no hook nor operator is needed.
+
+    INPUTS:
+    - objects: list of objects to trace rays from
+    - cameras: list of camera objects
+    - collection: collection to add the rays to
+    - ray_width: radius of the rays, or 0 to only draw lines (default: RAY_WIDTH)
+    - color: color of the rays (default: COLOR)
+
+    OUTPUT:
+    - ob: ray object, with one edge per (object, camera) pair
+    '''
+
+    endpoints = list(objects) + list(cameras)
+    obj_ids, cam_ids = np.meshgrid(np.arange(len(objects)), len(objects) + np.arange(len(cameras)), indexing='ij')
+    ray_end = np.stack([obj_ids, cam_ids], axis=-1).ravel().astype(np.int32)
+    locations = np.array([ob.matrix_world.translation for ob in endpoints], dtype=np.float32).reshape(-1, 3)
+
+    mesh = bpy.data.meshes.new('rays')
+    mesh.vertices.add(len(ray_end))
+    mesh.vertices.foreach_set('co', locations[ray_end].ravel())
+    mesh.edges.add(len(ray_end)//2)
+    mesh.edges.foreach_set('vertices', np.arange(len(ray_end), dtype=np.int32))
+    mesh.attributes.new('ray_end', 'INT', 'POINT').data.foreach_set('value', ray_end)
+    mesh.update()
+    matg = createMaterial(color=color, metallic = 0., roughness = 0.5)
+    mesh.materials.append(matg)
+
+    ob = bpy.data.objects.new('rays', mesh)
+    collection.objects.link(ob)
+    ob['ray_objects'] = [o.name for o in objects] # also tags the object as rays, see see_through_selected_camera
+    ob['ray_cameras'] = [c.name for c in cameras]
+    modifier = ob.modifiers.new('Rays', 'NODES')
+    modifier.node_group = ray_bundle_node_group(ob.name, endpoints, ray_width=ray_width, material=matg)
+
+    return ob
+
+
+def reproject_3D_points(collection='', single_mesh=True):
     '''
-    Trace rays from an object to the camera
+    Trace rays from the selected objects to all cameras
+
+    INPUTS:
+    - collection: collection (or name of a new collection) to add the rays to.
+      Default: new 'rays' collection. Only used with single_mesh
+    - single_mesh: all rays in a single mesh which follows objects and cameras (default).
+      If False, one Bezier curve per ray, hooked to its object, each object in its own collection.
+
+    OUTPUT:
+    - ray object if single_mesh, else None
     '''
     
-    objects = bpy.context.selected_objects
+    objects = [ob for ob in bpy.context.selected_objects if ob.type != 'CAMERA']
     cameras = [ob for ob in list(bpy.context.scene.objects) if ob.type == 'CAMERA']
+    if not objects or not cameras:
+        print('No ray to trace: select one or several objects, and add cameras to the scene.')
+        return None
+
+    if single_mesh:
+        if collection=='':
+            collection = 'rays'
+        if isinstance(collection,str):
+            collection = bpy.data.collections.new(collection)
+            bpy.context.scene.collection.children.link(collection)
+        return add_ray_bundle(objects, cameras, collection)
     
     for ob in objects:
         bpy.ops.object.select_all(action='DESELECT')
@@ -13,6 +13,9 @@
 
 ## INIT
 import bpy
+import numpy as np
+
+MATERIALS = {} # (color, metallic, roughness): material name
 
 
 ## AUTHORSHIP INFORMATION
@@ -38,17 +41,36 @@ def ShowMessageBox(message = "", title = "Message Box", icon = 'INFO'):
     bpy.context.window_manager.popup_menu(draw, title = title, icon = icon)
 
 
+def material_key(color, metallic, roughness):
+    '''
+    Key of a material in the registry, rounded so that float noise does not create duplicates
+    '''
+
+    return (tuple(round(float(c), 4) for c in color), round(float(metallic), 4), round(float(roughness), 4))
+
+
 def createMaterial(color=(0.8, 0.8, 0.8, 1), metallic = 0.5, roughness = 0.5):
     '''
-    Create a material
+    Create a material, or reuse the one previously created with the same parameters.
+    Materials are registered by (color, metallic, roughness), and looked up by name, 
+    so that deleted or renamed materials are created again.
     '''
     
-    color_count = [m.name for m in bpy.data.materials].count(str(color))
-    if color_count > 0:
-        color_index = [m.name for m in bpy.data.materials].index(str(color))
-        matg = bpy.data.materials[color_index]
-    else:
-        matg = bpy.data.materials.new(str(color))
+    key = material_key(color, metallic, roughness)
+    name = MATERIALS.get(key)
+    matg = bpy.data.materials.get(name) if name is not None else None
+    if matg is not None:
+        return matg
+
+    # named after the color as in previous versions, so that existing .blend files reuse their materials,
+    # unless a material of this name already has other parameters
+    name = str(color)
+    matg = bpy.data.materials.get(name)
+    if matg is not None and material_key(matg.diffuse_color, matg.metallic, matg.roughness) != key:
+        name = f'{color}_m{key[1]:g}_r{key[2]:g}'
+        matg = bpy.data.materials.get(name)
+    if matg is None:
+        matg = bpy.data.materials.new(name)
         matg.use_nodes = True
         tree = matg.node_tree
         nodes = tree.nodes
@@ -57,5 +79,276 @@ def createMaterial(color=(0.8, 0.8, 0.8, 1), metallic = 0.5, roughness = 0.5):
         matg.diffuse_color = color
         matg.metallic = metallic
         matg.roughness = roughness
+    MATERIALS[key] = matg.name
     
-    return matg
\ No newline at end of file
+    return matg
+
+
+def mesh_from_arrays(name, vertices, faces):
+    '''
+    Create a mesh datablock from numpy arrays, without operators.
+
+    INPUTS:
+    - name: mesh name
+    - vertices: 2D numpy array of shape (n_vertices, 3)
+    - faces: 2D numpy array of vertex indices, shape (n_faces, 3)
+
+    OUTPUT:
+    - mesh: bpy.types.Mesh
+    '''
+
+    vertices = np.asarray(vertices, dtype=np.float32)
+    faces = np.asarray(faces, dtype=np.int32)
+    n_faces, n_corners = faces.shape
+
+    mesh = bpy.data.meshes.new(name)
+    mesh.vertices.add(len(vertices))
+    mesh.vertices.foreach_set('co', vertices.ravel())
+    mesh.loops.add(faces.size)
+    mesh.loops.foreach_set('vertex_index', faces.ravel())
+    mesh.polygons.add(n_faces)
+    mesh.polygons.foreach_set('loop_start', np.arange(0, faces.size, n_corners, dtype=np.int32))
+    try: # Blender < 4.0, read-only afterwards
+        mesh.polygons.foreach_set('loop_total', np.full(n_faces, n_corners, dtype=np.int32))
+    except (AttributeError, RuntimeError, TypeError):
+        pass
+    mesh.update(calc_edges=True)
+    mesh.validate()
+
+    return mesh
+
+
+def set_object_material(obj, material):
+    '''
+    Assign a material to an object rather than to its mesh data,
+    so that objects sharing a mesh can have different materials
+    '''
+
+    if len(obj.material_slots) == 0:
+        obj.data.materials.append(None) # empty slot, on the mesh
+    obj.material_slots[0].link = 'OBJECT'
+    obj.material_slots[0].material = material
+
+
+def shade_smooth(mesh):
+    '''
+    Smooth shading for all the polygons of a mesh, at once
+    '''
+
+    if hasattr(mesh, 'shade_smooth'): # Blender 4.1+
+        mesh.shade_smooth()
+    else:
+        mesh.polygons.foreach_set('use_smooth', np.ones(len(mesh.polygons), dtype=bool))
+    mesh.update()
+
+
+def bulk_keyframe_insert(id_data, data_path, frames, values, group=None, simplify=False, tolerance=1e-6):
+    '''
+    Write all the keyframes of an animated property at once.
+    Much faster than setting the property and calling keyframe_insert frame by frame:
+    the fcurves are created up front and filled with foreach_set.
+    Existing keyframes of these fcurves are replaced.
+
+    INPUTS:
+    - id_data: object or datablock to animate (bpy.types.Object, bpy.types.Camera, etc)
+    - data_path: name of the animated property ('location', 'rotation_euler', 'lens', etc)
+    - frames: 1D array of frame numbers, shape (n_frames,)
+    - values: array of values, shape (n_frames,) or (n_frames, n_components)
+    - group: optional fcurve group (keyframe_insert uses 'Object Transforms' for objects)
+    - simplify: remove keyframes inside constant spans, only keep their first and last keyframes (default: False)
+    - tolerance: maximum difference between values considered equal when simplifying (default: 1e-6)
+
+    OUTPUTS:
+    - fcurves: list of the filled fcurves
+    '''
+
+    frames = np.asarray(frames, dtype=np.float32)
+    values = np.asarray(values, dtype=np.float32)
+    if values.ndim == 1:
+        values = values.reshape(-1, 1)
+
+    if id_data.animation_data is None:
+        id_data.animation_data_create()
+    if id_data.animation_data.action is None:
+        id_data.animation_data.action = bpy.data.actions.new(id_data.name + 'Action')
+    action = id_data.animation_data.action
+
+    fcurves = []
+    for i in range(values.shape[1]):
+        fcurve = action.fcurves.find(data_path, index=i)
+        if fcurve is None:
+            if group is None:
+                fcurve = action.fcurves.new(data_path, index=i)
+            else:
+                fcurve = action.fcurves.new(data_path, index=i, action_group=group)
+        else:
+            fcurve.keyframe_points.clear()
+        
+        fc_frames, fc_values = frames, values[:,i]
+        if simplify and len(frames) > 2:
+            flat = np.abs(np.diff(fc_values)) <= tolerance
+            keep = np.ones(len(frames), dtype=bool)
+            keep[1:-1] = ~(flat[:-1] & flat[1:])
+            fc_frames, fc_values = fc_frames[keep], fc_values[keep]
+
+        co = np.empty(2*len(fc_frames), dtype=np.float32)
+        co[0::2] = fc_frames
+        co[1::2] = fc_values
+        fcurve.keyframe_points.add(len(fc_frames))
+        fcurve.keyframe_points.foreach_set('co', co)
+        fcurve.update()
+        fcurves.append(fcurve)
+
+    return fcurves
+
+
+def _compatible_euler(eul, old_eul):
+    '''
+    Vectorized version of Blender's compatible_eul:
+    shift Euler angles by multiples of 2*pi to bring them as close as possible to old_eul
+    '''
+
+    pi_thresh, pi_x2 = 5.1, 2*np.pi
+    eul = eul.copy()
+    deul = eul - old_eul
+    eul = np.where(deul > pi_thresh, eul - np.floor(deul/pi_x2 + 0.5)*pi_x2, eul)
+    eul = np.where(deul < -pi_thresh, eul + np.floor(-deul/pi_x2 + 0.5)*pi_x2, eul)
+    deul = np.abs(eul - old_eul)
+    sign = np.sign(eul - old_eul)
+    for i in range(3):
+        j, k = [a for a in range(3) if a != i]
+        flip = (deul[...,i] > 3.2) & (deul[...,j] < 1.6) & (deul[...,k] < 1.6)
+        eul[...,i] = np.where(flip, eul[...,i] - sign[...,i]*pi_x2, eul[...,i])
+    return eul
+
+
+def mat_to_euler(R, compatible=True):
+    '''
+    Convert rotation matrices to 'XYZ' Euler angles, all frames at once.
+    Same as mathutils Matrix.to_euler('XYZ'), including the gimbal lock case.
+    If compatible, each frame is made compatible with the previous one
+    (starting from zero), like Blender does when obj.matrix_world is set.
+
+    INPUTS:
+    - R: array of rotation matrices, shape (n_frames, ..., 3, 3)
+    - compatible: keep Euler angles continuous from one frame to the next (default: True)
+
+    OUTPUTS:
+    - eul: array of Euler angles, shape (n_frames, ..., 3)
+    '''
+
+    R = np.asarray(R, dtype=float)
+
+    # two possible solutions
+    cy = np.hypot(R[...,0,0], R[...,1,0])
+    eul1 = np.stack([np.arctan2(R[...,2,1], R[...,2,2]),
+                     np.arctan2(-R[...,2,0], cy),
+                     np.arctan2(R[...,1,0], R[...,0,0])], axis=-1)
+    eul2 = np.stack([np.arctan2(-R[...,2,1], -R[...,2,2]),
+                     np.arctan2(-R[...,2,0], -cy),
+                     np.arctan2(-R[...,1,0], -R[...,0,0])], axis=-1)
+    # singularity when y angle is +/- pi/2
+    gimbal = cy <= 16*np.finfo(np.float32).eps
+    eul_gimbal = np.stack([np.arctan2(-R[...,1,2], R[...,1,1]),
+                           np.arctan2(-R[...,2,0], cy),
+                           np.zeros_like(cy)], axis=-1)
+    eul1 = np.where(gimbal[...,None], eul_gimbal, eul1)
+    eul2 = np.where(gimbal[...,None], eul_gimbal, eul2)
+
+    # smallest solution
+    if not compatible:
+        pick2 = np.abs(eul1).sum(axis=-1) > np.abs(eul2).sum(axis=-1)
+        return np.where(pick2[...,None], eul2, eul1)
+
+    # solution closest to previous frame
+    eul = np.empty_like(eul1)
+    old_eul = np.zeros_like(eul1[0])
+    for n in range(len(eul1)):
+        e1 = _compatible_euler(eul1[n], old_eul)
+        e2 = _compatible_euler(eul2[n], old_eul)
+        pick2 = np.abs(e1-old_eul).sum(axis=-1) > np.abs(e2-old_eul).sum(axis=-1)
+        old_eul = np.where(pick2[...,None], e2, e1)
+        eul[n] = old_eul
+    return eul
+
+
+def euler_to_mat(eul):
+    '''
+    Convert 'XYZ' Euler angles to rotation matrices, all frames at once.
+    Same as mathutils Euler.to_matrix().
+
+    INPUT:
+    - eul: array of Euler angles, shape (..., 3)
+
+    OUTPUT:
+    - R: array of rotation matrices, shape (..., 3, 3)
+    '''
+
+    eul = np.asarray(eul, dtype=float)
+    cx, cy, cz = np.cos(eul[...,0]), np.cos(eul[...,1]), np.cos(eul[...,2])
+    sx, sy, sz = np.sin(eul[...,0]), np.sin(eul[...,1]), np.sin(eul[...,2])
+    R = np.empty(eul.shape[:-1] + (3,3))
+    R[...,0,0], R[...,0,1], R[...,0,2] = cy*cz, sx*sy*cz - cx*sz, cx*sy*cz + sx*sz
+    R[...,1,0], R[...,1,1], R[...,1,2] = cy*sz, sx*sy*sz + cx*cz, cx*sy*sz - sx*cz
+    R[...,2,0], R[...,2,1], R[...,2,2] = -sy, sx*cy, cx*cy
+    return R
+
+
+def keyframe_frames(id_data, data_paths):
+    '''
+    Sorted frames of all the keyframes of some animated properties
+
+    INPUTS:
+    - id_data: animated object or datablock
+    - data_paths: list of property names ('location', 'rotation_euler', 'lens', etc)
+
+    OUTPUT:
+    - frames: 1D array of unique frames, empty if not animated
+    '''
+
+    frames = [np.zeros(0)]
+    anim = id_data.animation_data
+    if anim is not None and anim.action is not None:
+        for fcurve in anim.action.fcurves:
+            if fcurve.data_path in data_paths:
+                co = np.empty(2*len(fcurve.keyframe_points), dtype=np.float32)
+                fcurve.keyframe_points.foreach_get('co', co)
+                frames.append(co[0::2])
+    return np.unique(np.concatenate(frames))
+
+
+def sample_property(id_data, data_path, frames, default):
+    '''
+    Values of a property at given frames, all components at once.
+    Fcurves are matched by data path and array index, whatever their order.
+    Keyframe values are read with foreach_get when keyframes are exactly on the requested frames,
+    otherwise the fcurve is evaluated at each frame (non-uniform keyframes).
+    Components that are not animated keep their current value.
+
+    INPUTS:
+    - id_data: animated object or datablock
+    - data_path: name of the property ('location', 'rotation_euler', 'lens', etc)
+    - frames: 1D array of frames
+    - default: current value of the property
+
+    OUTPUT:
+    - values: array of shape (n_frames, n_components)
+    '''
+
+    frames = np.asarray(frames, dtype=float)
+    default = np.atleast_1d(np.asarray(default, dtype=float))
+    values = np.tile(default, (len(frames), 1))
+    anim = id_data.animation_data
+    if anim is None or anim.action is None:
+        return values
+
+    for fcurve in anim.action.fcurves:
+        if fcurve.data_path != data_path or fcurve.array_index >= len(default) or len(fcurve.keyframe_points) == 0:
+            continue
+        co = np.empty(2*len(fcurve.keyframe_points), dtype=np.float32)
+        fcurve.keyframe_points.foreach_get('co', co)
+        if len(co)//2 == len(frames) and np.allclose(co[0::2], frames):
+            values[:, fcurve.array_index] = co[1::2]
+        else:
+            values[:, fcurve.array_index] = [fcurve.evaluate(f) for f in frames]
+    return values
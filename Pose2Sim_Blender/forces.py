@@ -21,15 +21,20 @@
 
 ## INIT
 import bpy
-from mathutils import Vector
 import numpy as np
 import os
+from .common import createMaterial, set_object_material, mesh_from_arrays, bulk_keyframe_insert, mat_to_euler
+from .mesh_readers import read_stl
+from .cache import cached_load
 
 direction = 'zup'
 SIZE = 1/1000
 COLOR =  (0, 1, 0, 0.8)
+FORCE_THRESHOLD = 20 # N, vertical force below which there is no contact
+H_ZUP = np.array([[1,0,0,0], [0,0,-1,0], [0,1,0,0], [0,0,0,1]])
 rootpath=os.path.dirname(os.path.abspath(__file__))
 arrowFile=os.path.join(rootpath,'Geometry','arrow.stl')
+ARROW_MESH_NAME = 'force_arrow'
 
 
 ## AUTHORSHIP INFORMATION
@@ -44,18 +49,28 @@ __status__ = "Development"
 
 
 ## FUNCTIONS
-def load_grf(grf_path):
+def load_grf(grf_path, use_cache=True):
     '''
     Retrieve data and header from .mot force file
+    Parsed data is cached for faster loading next time.
 
     INPUT: 
     - grf_path: path to the force .mot file
+    - use_cache: read from and write to the cache (default: True)
 
     OUTPUT:
     - grf_data_np: 2D numpy array with forces at each time step
     - grf_header: time and force names (v: 3*value, p: 3*position, m: 3*moment)
     '''
 
+    return cached_load(grf_path, parse_grf, tag='grf', use_cache=use_cache)
+
+
+def parse_grf(grf_path):
+    '''
+    Parse .mot force text file. Use load_grf instead, which caches the result.
+    '''
+
     # read data
     grf_data_np = np.loadtxt(grf_path, skiprows=7)
     
@@ -71,6 +86,23 @@ def load_grf(grf_path):
     return grf_data_np, grf_header
 
 
+def arrow_mesh():
+    '''
+    Arrow mesh shared by all forces.
+    Read once from arrowFile, then reused.
+
+    OUTPUT:
+    - mesh: bpy.types.Mesh
+    '''
+
+    mesh = bpy.data.meshes.get(ARROW_MESH_NAME)
+    if mesh is None:
+        vertices, faces = read_stl(arrowFile)
+        mesh = mesh_from_arrays(ARROW_MESH_NAME, vertices, faces)
+    
+    return mesh
+
+
 def addForce(force_collection, forceName='', text="FORCE", color=COLOR):        
     '''
     Add one force vector to the scene
@@ -81,41 +113,194 @@ def addForce(force_collection, forceName='', text="FORCE", color=COLOR):
     - color: marker color (default: COLOR)
 
     OUTPUTS:
-    - Created new force
+    - Created new force (empty, parent of the arrow)
     '''
 
     # Color
-    matg = bpy.data.materials.new("Green")
-    matg.use_nodes = True
-    tree = matg.node_tree
-    nodes = tree.nodes
-    bsdf = nodes["Principled BSDF"]
-    bsdf.inputs["Base Color"].default_value = color
-    matg.diffuse_color = color
+    matg = createMaterial(color=color, metallic = 0., roughness = 0.5)
 
     #Add arrow    
     arrow = bpy.data.objects.new(forceName,None)
     force_collection.objects.link(arrow)
-    for obj in bpy.data.objects:
-        obj.select_set(False)
-    bpy.ops.wm.stl_import(filepath=arrowFile)
-    selected_objects = [ o for o in bpy.context.scene.objects if o.select_get() ]
-    obj=selected_objects[0]
+    obj = bpy.data.objects.new(forceName+'_arrow', arrow_mesh())
     obj.scale=(1,.5,.5)
     obj.parent=arrow
-    obj.users_collection[0].objects.unlink(obj)
-    obj.active_material = matg
+    set_object_material(obj, matg) # not on the arrow mesh, shared by all forces
     force_collection.objects.link(obj)
+
+    return arrow
     
 
-def import_forces(grf_path, direction='zup', target_framerate=30):
+def hold_where(values, mask):
+    '''
+    Replace masked values with the last unmasked value before them
+    (or the first one after them at the beginning).
+    If all values are masked (unused force plate), the first value is held throughout.
+
+    INPUTS:
+    - values: 2D numpy array of shape (n_frames, n_cols)
+    - mask: 1D boolean numpy array of shape (n_frames,)
+
+    OUTPUT:
+    - held: 2D numpy array of shape (n_frames, n_cols)
+    '''
+
+    if not mask.any():
+        return values
+    if mask.all():
+        return np.repeat(values[:1], len(values), axis=0)
+    idx = np.where(mask, 0, np.arange(len(mask)))
+    idx[:np.argmin(mask)] = np.argmin(mask) # leading masked values
+    idx = np.maximum.accumulate(idx)
+    return values[idx]
+
+
+def threshold_grf(grf_data_np, n_forces, force_threshold=FORCE_THRESHOLD):
+    '''
+    Remove forces when the vertical force is below force_threshold (swing phases).
+    Forces and torques are set to zero, and the center of pressure is held to its last value.
+
+    INPUTS:
+    - grf_data_np: 2D numpy array with forces at each time step (see load_grf)
+    - n_forces: number of forces
+    - force_threshold: vertical force threshold in N (default: FORCE_THRESHOLD)
+
+    OUTPUT:
+    - grf_data_np: thresholded copy
+    '''
+
+    grf_data_np = grf_data_np.copy()
+    for i in range(n_forces):
+        c = 1 + 9*i # vx, vy, vz, px, py, pz, mx, my, mz (OpenSim: y is vertical)
+        below = grf_data_np[:, c+1] < force_threshold
+        grf_data_np[below, c:c+3] = 0
+        grf_data_np[below, c+6:c+9] = 0
+        grf_data_np[:, c+3:c+6] = hold_where(grf_data_np[:, c+3:c+6], below)
+
+    return grf_data_np
+
+
+def lowpass_fir(values, cutoff, n_taps):
+    '''
+    Windowed-sinc low-pass filter, applied with FFT convolution along the first axis.
+    Edges are padded with their values to avoid transients.
+
+    INPUTS:
+    - values: 2D numpy array of shape (n_frames, n_cols)
+    - cutoff: cutoff frequency, as a fraction of the sampling frequency (0 to 0.5)
+    - n_taps: filter length (odd)
+
+    OUTPUT:
+    - filtered: 2D numpy array of shape (n_frames, n_cols)
+    '''
+
+    taps = np.arange(n_taps) - (n_taps-1)/2
+    h = 2*cutoff * np.sinc(2*cutoff*taps) * np.hamming(n_taps)
+    h /= h.sum()
+
+    pad = n_taps
+    padded = np.pad(values, ((pad, pad), (0, 0)), mode='edge')
+    n_fft = 1 << int(np.ceil(np.log2(len(padded) + n_taps - 1)))
+    filtered = np.fft.irfft(np.fft.rfft(padded, n_fft, axis=0) * np.fft.rfft(h, n_fft)[:,None], n_fft, axis=0)
+    start = pad + (n_taps-1)//2
+    return filtered[start:start+len(values)]
+
+
+def preprocess_grf(grf_data_np, n_forces, target_framerate, force_threshold=FORCE_THRESHOLD):
+    '''
+    Prepare force plate data for keyframing:
+    - threshold: no force and constant center of pressure when the vertical force is below force_threshold
+    - anti-aliasing: low-pass filter at the Nyquist frequency of the target framerate
+    - resampling: linear interpolation at the target framerate
+
+    INPUTS:
+    - grf_data_np: 2D numpy array with forces at each time step (see load_grf)
+    - n_forces: number of forces
+    - target_framerate: framerate of the animation
+    - force_threshold: vertical force threshold in N (default: FORCE_THRESHOLD)
+
+    OUTPUT:
+    - grf_resampled_np: 2D numpy array with forces at each frame of the animation
+    '''
+
+    times = grf_data_np[:,0]
+    fps = (len(times)-1) / (times[-1] - times[0])
+    grf_data_np = threshold_grf(grf_data_np, n_forces, force_threshold=force_threshold)
+
+    # anti-aliasing
+    ratio = fps / target_framerate
+    values = grf_data_np[:,1:]
+    if ratio > 1:
+        n_taps = 2*int(np.ceil(4*ratio)) + 1
+        values = lowpass_fir(values, 0.5/ratio, n_taps)
+
+    # resampling
+    times_resampled = np.arange(times[0], times[-1] + 0.5/fps, 1/target_framerate)
+    values_resampled = np.stack([np.interp(times_resampled, times, v) for v in values.T], axis=-1)
+    grf_resampled_np = np.column_stack([times_resampled, values_resampled])
+
+    # threshold again, for flat swing phases
+    return threshold_grf(grf_resampled_np, n_forces, force_threshold=force_threshold)
+
+
+def grf_transforms(grf_data_np, n_forces, direction='zup'):
+    '''
+    Location, rotation, and scale of the force arrows, for all frames and forces at once.
+    Arrows point along the x axis: they are rotated towards the force vector,
+    placed on the center of pressure, and stretched by the force magnitude.
+
+    INPUTS:
+    - grf_data_np: 2D numpy array with forces at each time step (see load_grf)
+    - n_forces: number of forces
+    - direction: 'zup' or 'yup' (default: 'zup')
+
+    OUTPUTS:
+    - loc: 3D numpy array of shape (n_frames, n_forces, 3)
+    - rot: 3D numpy array of Euler angles, shape (n_frames, n_forces, 3)
+    - scale: 3D numpy array of shape (n_frames, n_forces, 3)
+    '''
+
+    # force vectors and centers of pressure: (n_frames, n_forces, 3)
+    vec_cols = 1 + 9*np.arange(n_forces)[:,None] + np.arange(3)
+    grf_vec = grf_data_np[:, vec_cols]
+    cop = grf_data_np[:, vec_cols+3]
+    magnitude = np.linalg.norm(grf_vec, axis=-1)
+
+    # shortest rotation from x axis to force vector, as a quaternion (w, x, y, z)
+    u = np.divide(grf_vec, magnitude[...,None], out=np.zeros_like(grf_vec), where=magnitude[...,None]>0)
+    quat = np.stack([1+u[...,0], np.zeros_like(magnitude), -u[...,2], u[...,1]], axis=-1)
+    opposite = (magnitude>0) & (quat[...,0] < 1e-9) # force along -x: half turn around z
+    quat[opposite] = [0,0,0,1]
+    quat[magnitude==0] = [1,0,0,0]
+    quat /= np.linalg.norm(quat, axis=-1, keepdims=True)
+    w, x, y, z = np.moveaxis(quat, -1, 0)
+    R = np.stack([np.stack([1-2*(y*y+z*z), 2*(x*y-w*z), 2*(x*z+w*y)], axis=-1),
+                  np.stack([2*(x*y+w*z), 1-2*(x*x+z*z), 2*(y*z-w*x)], axis=-1),
+                  np.stack([2*(x*z-w*y), 2*(y*z+w*x), 1-2*(x*x+y*y)], axis=-1)], axis=-2)
+
+    # y-up to z-up
+    if direction=='zup':
+        R = H_ZUP[:3,:3] @ R
+        cop = cop @ H_ZUP[:3,:3].T
+
+    rot = mat_to_euler(R)
+    scale = np.stack([magnitude*SIZE, np.ones_like(magnitude), np.ones_like(magnitude)], axis=-1)
+
+    return cop, rot, scale
+
+
+def import_forces(grf_path, direction='zup', target_framerate=30, preprocess=True, force_threshold=FORCE_THRESHOLD):
     '''
     Import a .mot force file into Blender.
     OpenSim API is not required.
     
     INPUTS: 
     - grf_path: path to a .mot force file
-    - direction: 'zup' or 'yup' (default: 'zu
+    - direction: 'zup' or 'yup' (default: 'zup')
+    - target_framerate: framerate of the animation (default: 30)
+    - preprocess: threshold, filter, and resample forces before keyframing (default: True).
+                  Otherwise, one raw sample is kept every fps/target_framerate samples.
+    - force_threshold: vertical force below which forces are removed, in N (default: FORCE_THRESHOLD)
     
     OUTPUTS:
     - Animated forces
@@ -130,39 +315,31 @@ def import_forces(grf_path, direction='zup', target_framerate=30):
     
     times = grf_data_np[:,0]
     fps = round((len(times)-1) / (times[-1] - times[0]))
-    first_frame = round(times[0]*fps)
-    conv_fac_frame_rate = round(fps / target_framerate)
     # bpy.data.scenes['Scene'].render.fps = fps
+    if preprocess:
+        grf_data_np = preprocess_grf(grf_data_np, len(grfNames), target_framerate, force_threshold=force_threshold)
+        first_frame = round(grf_data_np[0,0]*target_framerate)
+    else:
+        first_frame = round(times[0]*fps)
+        conv_fac_frame_rate = max(round(fps / target_framerate), 1)
+        grf_data_np = grf_data_np[::conv_fac_frame_rate]
         
     # create forces
     force_collection = bpy.data.collections.new('Forces')
     bpy.context.scene.collection.children.link(force_collection)
-    for forceName in grfNames:        
-        addForce(force_collection, forceName=forceName, text=forceName)
-
-    # create arrows
-    x_unit_arrow=Vector([1,0,0])
-    # H_zup = np.array([[0,0,1,0], [1,0,0,0], [0,1,0,0], [0,0,0,1]])
-    H_zup = np.array([[1,0,0,0], [0,0,-1,0], [0,1,0,0], [0,0,0,1]])
-    for n in range(0, len(times), conv_fac_frame_rate):
-        for i, f in enumerate(grfNames):
-            T = grf_data_np[n, 1+3+9*i : 1+3+9*i+3]
-            grf_vec = grf_data_np[n, 1+9*i : 1+9*i+3]
-            R = (x_unit_arrow.rotation_difference( Vector(grf_vec).normalized() )).to_matrix()
-            H = np.block([ [R,T.reshape(3,1)], [np.zeros(3), 1] ])
-            if direction=='zup':
-                H = H_zup @ H
-            scale_arrow = [Vector(grf_vec).magnitude*SIZE, 1, 1]
-            obj = force_collection.objects[f]
-            obj.matrix_world = H.T
-            obj.scale = scale_arrow
-            obj.keyframe_insert('location', frame=first_frame+round(n/conv_fac_frame_rate)+1)
-            obj.keyframe_insert('rotation_euler', frame=first_frame+round(n/conv_fac_frame_rate)+1)
-            obj.keyframe_insert('scale', frame=first_frame+round(n/conv_fac_frame_rate)+1)
+    force_objs = [addForce(force_collection, forceName=forceName, text=forceName) for forceName in grfNames]
+
+    # animate arrows, all frames and forces at once
+    # constant spans (swing phases) are collapsed to their first and last keyframes
+    loc, rot, scale = grf_transforms(grf_data_np, len(grfNames), direction=direction)
+    frames = first_frame + np.arange(len(loc)) + 1
+    for i, obj in enumerate(force_objs):
+        bulk_keyframe_insert(obj, 'location', frames, loc[:,i], group='Object Transforms', simplify=preprocess)
+        bulk_keyframe_insert(obj, 'rotation_euler', frames, rot[:,i], group='Object Transforms', simplify=preprocess)
+        bulk_keyframe_insert(obj, 'scale', frames, scale[:,i], group='Object Transforms', simplify=preprocess)
+        obj.location, obj.rotation_euler, obj.scale = loc[0,i], rot[0,i], scale[0,i]
 
     # hide axes
-    bpy.ops.object.select_by_type(extend=False, type='EMPTY')
-    empties = bpy.context.selected_objects
-    [empt.hide_set(True) for empt in empties]
+    [obj.hide_set(True) for obj in force_objs]
             
     print(f'Forces imported from {grf_path}')
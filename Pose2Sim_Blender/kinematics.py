@@ -0,0 +1,530 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+'''
+    ##################################################
+    ## Forward kinematics of OpenSim models         ##
+    ##################################################
+
+    Computes the transforms of all the bodies of an .osim model in ground,
+    for all the frames of a motion at once, in batched NumPy.
+    OpenSim API is not required.
+
+    Supported joints: CustomJoint (SpatialTransform), WeldJoint, PinJoint,
+    SliderJoint, UniversalJoint, GimbalJoint, BallJoint, FreeJoint, PlanarJoint.
+    Supported functions: LinearFunction, Constant, SimmSpline, NaturalCubicSpline,
+    PiecewiseLinearFunction, PiecewiseConstantFunction, PolynomialFunction, MultiplierFunction.
+    CoordinateCouplerConstraints are used to compute dependent coordinates
+    that are not provided in the motion file.
+    Only OpenSim 4.x model files are supported.
+
+    INPUTS:
+    - osim_path: path to the .osim model file
+    - coordinate values (radians and meters) at each frame
+
+    OUTPUTS:
+    - Transforms of each body in ground, shape (n_frames, n_bodies, 4, 4)
+'''
+
+
+## INIT
+import numpy as np
+from .osim_reader import read_osim
+
+
+## AUTHORSHIP INFORMATION
+__author__ = "David Pagnon"
+__copyright__ = "Copyright 2023, Pose2Sim_Blender"
+__credits__ = ["David Pagnon"]
+__license__ = "MIT License"
+__version__ = "0.7.0"
+__maintainer__ = "David Pagnon"
+__email__ = "contact@david-pagnon.com"
+__status__ = "Development"
+
+
+## CONSTANTS
+FUNCTION_TYPES = ['LinearFunction', 'Constant', 'SimmSpline', 'NaturalCubicSpline',
+                  'PiecewiseLinearFunction', 'PiecewiseConstantFunction', 'PolynomialFunction', 'MultiplierFunction']
+X_AXIS, Y_AXIS, Z_AXIS = [1.,0.,0.], [0.,1.,0.], [0.,0.,1.]
+# Equivalent spatial transform of standard joints:
+# (rotation axes, translation axes, index of the coordinate driving each axis)
+JOINT_AXES = {
+    'WeldJoint': ([], [], []),
+    'PinJoint': ([Z_AXIS], [], [0]),
+    'SliderJoint': ([], [X_AXIS], [0]),
+    'UniversalJoint': ([X_AXIS, Y_AXIS], [], [0, 1]),
+    'GimbalJoint': ([X_AXIS, Y_AXIS, Z_AXIS], [], [0, 1, 2]),
+    'BallJoint': ([X_AXIS, Y_AXIS, Z_AXIS], [], [0, 1, 2]),
+    'FreeJoint': ([X_AXIS, Y_AXIS, Z_AXIS], [X_AXIS, Y_AXIS, Z_AXIS], [0, 1, 2, 3, 4, 5]),
+    'PlanarJoint': ([Z_AXIS], [X_AXIS, Y_AXIS], [0, 1, 2]),
+}
+
+
+## FUNCTIONS
+def child_elements(node, tag=None):
+    '''
+    Direct children of an XML element, optionally with this tag
+    '''
+
+    return [c for c in node if tag is None or c.tag == tag]
+
+
+def child_text(node, tag, default=''):
+    '''
+    Text of the first direct child of an XML element with this tag
+    '''
+
+    child = node.find(tag)
+    if child is None or child.text is None:
+        return default
+    return child.text.strip()
+
+
+def child_floats(node, tag, default=None):
+    '''
+    Numeric values of the first direct child of an XML element with this tag
+    '''
+
+    text = child_text(node, tag)
+    if text == '':
+        return default
+    return np.array([float(x) for x in text.split()])
+
+
+def parse_function(node):
+    '''
+    Parse an OpenSim function node
+
+    INPUT:
+    - node: XML element of the function (LinearFunction, SimmSpline, etc)
+
+    OUTPUT:
+    - function: tuple (function type, dict of parameters)
+    '''
+
+    kind = node.tag
+    if kind == 'LinearFunction':
+        return (kind, {'coefficients': child_floats(node, 'coefficients')})
+    elif kind == 'Constant':
+        return (kind, {'value': float(child_text(node, 'value', '0'))})
+    elif kind == 'PolynomialFunction':
+        return (kind, {'coefficients': child_floats(node, 'coefficients')})
+    elif kind in ['SimmSpline', 'NaturalCubicSpline', 'PiecewiseLinearFunction', 'PiecewiseConstantFunction']:
+        return (kind, {'x': child_floats(node, 'x'), 'y': child_floats(node, 'y')})
+    elif kind == 'MultiplierFunction':
+        inner = [f for c in child_elements(node, 'function') for f in child_elements(c) if f.tag in FUNCTION_TYPES]
+        return (kind, {'function': parse_function(inner[0]), 'scale': float(child_text(node, 'scale', '1'))})
+    else:
+        raise ValueError(f'OpenSim function {kind} is not supported.')
+
+
+def find_function(node):
+    '''
+    Find and parse the function defined directly under an XML element
+    '''
+
+    for c in child_elements(node):
+        if c.tag in FUNCTION_TYPES:
+            return parse_function(c)
+        for f in child_elements(c):
+            if f.tag in FUNCTION_TYPES:
+                return parse_function(f)
+    return ('Constant', {'value': 0.})
+
+
+def simm_spline_coefficients(x, y):
+    '''
+    Coefficients of the cubic spline used by SIMM and OpenSim SimmSpline
+    (Forsythe, Malcolm, Moler end conditions).
+    Between x[k] and x[k+1]: y = y[k] + dx*(b[k] + dx*(c[k] + dx*d[k])), with dx = x-x[k]
+    '''
+
+    n = len(x)
+    b, c, d = np.zeros(n), np.zeros(n), np.zeros(n)
+    if n < 2:
+        return b, c, d
+    if n < 3:
+        b[:] = (y[1]-y[0]) / (x[1]-x[0])
+        return b, c, d
+
+    nm1 = n-1
+    d[0] = x[1] - x[0]
+    c[1] = (y[1]-y[0]) / d[0]
+    for i in range(1, nm1):
+        d[i] = x[i+1] - x[i]
+        b[i] = 2.0 * (d[i-1] + d[i])
+        c[i+1] = (y[i+1]-y[i]) / d[i]
+        c[i] = c[i+1] - c[i]
+
+    # end conditions: third derivatives of the cubics through the first and last 4 points
+    b[0], b[nm1] = -d[0], -d[n-2]
+    c[0], c[nm1] = 0.0, 0.0
+    if n > 3:
+        d1 = c[2]/(x[3]-x[1]) - c[1]/(x[2]-x[0])
+        d2 = c[n-2]/(x[nm1]-x[n-3]) - c[n-3]/(x[n-2]-x[n-4])
+        c[0] = d1*d[0]*d[0] / (x[3]-x[0])
+        c[nm1] = -d2*d[n-2]*d[n-2] / (x[nm1]-x[n-4])
+
+    # tridiagonal system
+    for i in range(1, n):
+        t = d[i-1] / b[i-1]
+        b[i] -= t*d[i-1]
+        c[i] -= t*c[i-1]
+    c[nm1] /= b[nm1]
+    for i in range(n-2, -1, -1):
+        c[i] = (c[i] - d[i]*c[i+1]) / b[i]
+
+    # polynomial coefficients
+    b[nm1] = (y[nm1]-y[n-2])/d[n-2] + d[n-2]*(c[n-2] + 2.0*c[nm1])
+    for i in range(nm1):
+        b[i] = (y[i+1]-y[i])/d[i] - d[i]*(c[i+1] + 2.0*c[i])
+        d[i] = (c[i+1]-c[i]) / d[i]
+        c[i] = 3.0*c[i]
+    c[nm1] = 3.0*c[nm1]
+    d[nm1] = d[n-2]
+
+    return b, c, d
+
+
+def natural_spline_coefficients(x, y):
+    '''
+    Coefficients of a natural cubic spline (zero second derivatives at both ends).
+    Same polynomial form as simm_spline_coefficients.
+    '''
+
+    n = len(x)
+    b, c, d = np.zeros(n), np.zeros(n), np.zeros(n)
+    if n < 3:
+        if n == 2:
+            b[:] = (y[1]-y[0]) / (x[1]-x[0])
+        return b, c, d
+
+    h = np.diff(x)
+    A = np.zeros((n,n))
+    r = np.zeros(n)
+    A[0,0] = A[-1,-1] = 1
+    for i in range(1, n-1):
+        A[i,i-1], A[i,i], A[i,i+1] = h[i-1], 2*(h[i-1]+h[i]), h[i]
+        r[i] = 3*((y[i+1]-y[i])/h[i] - (y[i]-y[i-1])/h[i-1])
+    c = np.linalg.solve(A, r)
+    b[:-1] = np.diff(y)/h - h*(2*c[:-1] + c[1:])/3
+    d[:-1] = (c[1:] - c[:-1]) / (3*h)
+    b[-1] = b[-2] + 2*c[-2]*h[-1] + 3*d[-2]*h[-1]**2
+
+    return b, c, d
+
+
+def eval_function(function, q):
+    '''
+    Evaluate an OpenSim function on an array of values
+
+    INPUTS:
+    - function: tuple (function type, dict of parameters), see parse_function
+    - q: array of coordinate values
+
+    OUTPUT:
+    - array of function values
+    '''
+
+    kind, params = function
+    q = np.asarray(q, dtype=float)
+    if kind == 'LinearFunction':
+        slope, intercept = params['coefficients']
+        return slope*q + intercept
+    elif kind == 'Constant':
+        return np.full_like(q, params['value'])
+    elif kind == 'PolynomialFunction':
+        return np.polyval(params['coefficients'], q)
+    elif kind == 'MultiplierFunction':
+        return params['scale'] * eval_function(params['function'], q)
+
+    x, y = params['x'], params['y']
+    if kind == 'PiecewiseConstantFunction':
+        k = np.clip(np.searchsorted(x, q, side='right')-1, 0, len(x)-1)
+        return y[k]
+    if kind == 'PiecewiseLinearFunction':
+        b = np.append(np.diff(y)/np.diff(x), (y[-1]-y[-2])/(x[-1]-x[-2])) if len(x)>1 else np.zeros(1)
+        c = d = np.zeros_like(b)
+    elif kind == 'SimmSpline':
+        if 'coefficients' not in params:
+            params['coefficients'] = simm_spline_coefficients(x, y)
+        b, c, d = params['coefficients']
+    else: # NaturalCubicSpline
+        if 'coefficients' not in params:
+            params['coefficients'] = natural_spline_coefficients(x, y)
+        b, c, d = params['coefficients']
+
+    # cubic polynomial on each interval, linear extrapolation outside of x range
+    k = np.clip(np.searchsorted(x, q, side='right')-1, 0, len(x)-1)
+    dx = q - x[k]
+    value = y[k] + dx*(b[k] + dx*(c[k] + dx*d[k]))
+    value = np.where(q < x[0], y[0] + (q-x[0])*b[0], value)
+    value = np.where(q > x[-1], y[-1] + (q-x[-1])*b[-1], value)
+    return value
+
+
+def rotation_about_axis(axis, angle):
+    '''
+    Rotation matrices about a fixed axis, for an array of angles
+
+    INPUTS:
+    - axis: 3D rotation axis
+    - angle: array of angles, shape (n_frames,)
+
+    OUTPUT:
+    - R: array of rotation matrices, shape (n_frames, 3, 3)
+    '''
+
+    axis = np.asarray(axis, dtype=float)
+    axis = axis / np.linalg.norm(axis)
+    K = np.array([[0, -axis[2], axis[1]],
+                  [axis[2], 0, -axis[0]],
+                  [-axis[1], axis[0], 0]])
+    angle = np.asarray(angle, dtype=float)[:,None,None]
+    return np.eye(3) + np.sin(angle)*K + (1-np.cos(angle))*(K@K)
+
+
+def offset_transform(translation, orientation):
+    '''
+    Homogeneous transform of a PhysicalOffsetFrame.
+    Orientation is a body-fixed x-y-z rotation sequence.
+    '''
+
+    H = np.eye(4)
+    R = np.eye(3)
+    for axis, angle in zip([X_AXIS, Y_AXIS, Z_AXIS], orientation):
+        R = R @ rotation_about_axis(axis, [angle])[0]
+    H[:3,:3] = R
+    H[:3,3] = translation
+    return H
+
+
+def resolve_frame(frame_path, joint_frames):
+    '''
+    Find the body a frame is attached to, and the frame offset in this body
+
+    INPUTS:
+    - frame_path: path to a frame ('/bodyset/femur_r', '/ground', 'femur_r_offset', etc)
+    - joint_frames: dict of the offset frames of the joint {name: (parent path, transform)}
+
+    OUTPUTS:
+    - body name ('ground' for the ground)
+    - homogeneous transform of the frame in the body, shape (4, 4)
+    '''
+
+    frame_name = frame_path.rstrip('/').split('/')[-1]
+    if frame_name in joint_frames:
+        parent_path, H_offset = joint_frames[frame_name]
+        body_name, H_parent = resolve_frame(parent_path, {k:v for k,v in joint_frames.items() if k != frame_name})
+        return body_name, H_parent @ H_offset
+    return frame_name, np.eye(4)
+
+
+def parse_joint(joint):
+    '''
+    Parse an OpenSim joint node into an equivalent spatial transform
+
+    INPUT:
+    - joint: XML element of the joint (CustomJoint, WeldJoint, PinJoint, etc)
+
+    OUTPUT:
+    - dict with parent and child bodies, offsets, coordinates, and spatial transform axes
+    '''
+
+    # coordinates
+    coordinates = []
+    for coords in child_elements(joint, 'coordinates'):
+        for coord in child_elements(coords, 'Coordinate'):
+            coordinates.append({'name': coord.get('name'),
+                                'default_value': float(child_text(coord, 'default_value', '0'))})
+
+    # parent and child frames
+    joint_frames = {}
+    for frames in child_elements(joint, 'frames'):
+        for frame in child_elements(frames, 'PhysicalOffsetFrame'):
+            translation = child_floats(frame, 'translation', np.zeros(3))
+            orientation = child_floats(frame, 'orientation', np.zeros(3))
+            joint_frames[frame.get('name')] = (child_text(frame, 'socket_parent'), offset_transform(translation, orientation))
+    parent, H_parent_offset = resolve_frame(child_text(joint, 'socket_parent_frame'), joint_frames)
+    child, H_child_offset = resolve_frame(child_text(joint, 'socket_child_frame'), joint_frames)
+
+    # spatial transform: (kind, axis, coordinate name, function)
+    axes = []
+    kind = joint.tag
+    if kind == 'CustomJoint':
+        for spatial_transform in child_elements(joint, 'SpatialTransform'):
+            for transform_axis in child_elements(spatial_transform, 'TransformAxis'):
+                axis_kind = 'rotation' if transform_axis.get('name', '').startswith('rotation') else 'translation'
+                coord_names = child_text(transform_axis, 'coordinates').split()
+                if len(coord_names) > 1:
+                    raise ValueError(f'{transform_axis.get("name")} of {kind} {joint.get("name")} is driven by several coordinates ({", ".join(coord_names)}): this is not supported.')
+                axes.append((axis_kind, child_floats(transform_axis, 'axis'),
+                             coord_names[0] if coord_names else None,
+                             find_function(transform_axis)))
+    elif kind in JOINT_AXES:
+        rotation_axes, translation_axes, coord_ids = JOINT_AXES[kind]
+        identity = ('LinearFunction', {'coefficients': np.array([1., 0.])})
+        axis_list = [('rotation', a) for a in rotation_axes] + [('translation', a) for a in translation_axes]
+        for (axis_kind, axis), c in zip(axis_list, coord_ids):
+            axes.append((axis_kind, np.array(axis), coordinates[c]['name'], identity))
+    else:
+        raise ValueError(f'{kind} {joint.get("name")} is not supported.')
+
+    # motion type, as in OpenSim: rotational if the coordinate drives a rotation linearly,
+    # coupled (no unit conversion) if it only drives rotations through non-linear functions
+    for coord in coordinates:
+        coord['rotational'] = any(a[0]=='rotation' and a[2]==coord['name'] and a[3][0]=='LinearFunction' for a in axes)
+
+    return {'name': joint.get('name'), 'type': kind,
+            'parent': parent, 'child': child,
+            'parent_offset': H_parent_offset, 'child_offset': H_child_offset,
+            'coordinates': coordinates, 'axes': axes}
+
+
+def read_osim_kinematics(osim_path):
+    '''
+    Read the kinematic tree of an .osim model file
+    OpenSim API is not required.
+
+    INPUT:
+    - osim_path: path to the .osim model file
+
+    OUTPUT:
+    - model_kin: dict with body names, joints (from ground to extremities),
+    coordinates, and coordinate coupler constraints
+    '''
+
+    model = read_osim(osim_path)
+
+    bodyNames = [b['name'] for b in model['bodies']]
+    joints = [parse_joint(j) for j in model['joints']]
+
+    couplers = []
+    for constraint in model['constraints']:
+        if constraint.tag != 'CoordinateCouplerConstraint':
+            continue
+        function_nodes = child_elements(constraint, 'coupled_coordinates_function')
+        couplers.append({'independent': child_text(constraint, 'independent_coordinate_names').split(),
+                         'dependent': child_text(constraint, 'dependent_coordinate_name'),
+                         'function': find_function(function_nodes[0]) if function_nodes else ('Constant', {'value': 0.}),
+                         'scale_factor': float(child_text(constraint, 'scale_factor', '1'))})
+
+    return build_kinematic_tree(bodyNames, joints, couplers)
+
+
+def build_kinematic_tree(bodyNames, joints, couplers):
+    '''
+    Sort joints from ground to extremities and list coordinates
+
+    INPUTS:
+    - bodyNames: list of body names
+    - joints: list of parsed joints, see parse_joint
+    - couplers: list of coordinate coupler constraints
+
+    OUTPUT:
+    - model_kin: dict with body names, sorted joints, coordinates, and couplers
+    '''
+
+    sorted_joints, placed = [], {'ground'}
+    remaining = list(joints)
+    while remaining:
+        ready = [j for j in remaining if j['parent'] in placed]
+        if not ready:
+            print(f'Joints {[j["name"] for j in remaining]} are not connected to ground: their child bodies are left at the origin.')
+            break
+        for j in ready:
+            sorted_joints.append(j)
+            placed.add(j['child'])
+            remaining.remove(j)
+
+    coordinates = {c['name']: c for j in joints for c in j['coordinates']}
+
+    return {'bodyNames': bodyNames, 'joints': sorted_joints,
+            'coordinates': coordinates, 'couplers': couplers}
+
+
+def coordinates_from_motion(model_kin, motion_data_np, coordinateNames, in_degrees=True):
+    '''
+    Values of all model coordinates at each frame:
+    from the motion file, from coupler constraints, or default values.
+    Rotational coordinates are converted to radians if needed.
+
+    INPUTS:
+    - model_kin: kinematic tree, see read_osim_kinematics
+    - motion_data_np: 2D array of coordinate values, shape (n_frames, n_columns)
+    - coordinateNames: names of the columns of motion_data_np
+    - in_degrees: True if rotational coordinates are in degrees
+
+    OUTPUT:
+    - q: dict {coordinate name: array of values, shape (n_frames,)}
+    '''
+
+    n_frames = len(motion_data_np)
+    q = {}
+    for i, c in enumerate(coordinateNames):
+        if c in model_kin['coordinates']:
+            q[c] = np.array(motion_data_np[:,i], dtype=float)
+            if in_degrees and model_kin['coordinates'][c]['rotational']:
+                q[c] = q[c] * np.pi/180
+
+    for coupler in model_kin['couplers']:
+        dep, indep = coupler['dependent'], coupler['independent']
+        if dep in q:
+            continue
+        if len(indep) != 1:
+            raise ValueError(f'Coordinate {dep} is coupled to several coordinates ({", ".join(indep)}): this is not supported.')
+        if indep[0] in q:
+            q_indep = q[indep[0]]
+        elif indep[0] in model_kin['coordinates']:
+            q_indep = np.full(n_frames, model_kin['coordinates'][indep[0]]['default_value'])
+        else:
+            continue
+        q[dep] = coupler['scale_factor'] * eval_function(coupler['function'], q_indep)
+
+    for c, coord in model_kin['coordinates'].items():
+        if c not in q:
+            q[c] = np.full(n_frames, coord['default_value'])
+
+    return q
+
+
+def forward_kinematics(model_kin, q):
+    '''
+    Transforms of all bodies in ground, for all frames at once.
+    X_ground_child = X_ground_parent . X_parent_F . X_F_M(q) . inv(X_child_M)
+    with F and M the parent and child offset frames of each joint.
+    Rotations of a spatial transform are body-fixed, translations are expressed in F.
+
+    INPUTS:
+    - model_kin: kinematic tree, see read_osim_kinematics
+    - q: dict {coordinate name: array of values, shape (n_frames,)}, see coordinates_from_motion
+
+    OUTPUT:
+    - H_all: array of homogeneous transforms, shape (n_frames, n_bodies, 4, 4)
+    '''
+
+    n_frames = len(next(iter(q.values()))) if q else 1
+    zeros = np.zeros(n_frames)
+    H_bodies = {'ground': np.broadcast_to(np.eye(4), (n_frames,4,4))}
+
+    for joint in model_kin['joints']:
+        R = np.broadcast_to(np.eye(3), (n_frames,3,3))
+        p = np.zeros((n_frames,3))
+        for axis_kind, axis, coord_name, function in joint['axes']:
+            value = eval_function(function, q[coord_name] if coord_name in q else zeros)
+            if axis_kind == 'rotation':
+                R = R @ rotation_about_axis(axis, value)
+            else:
+                p = p + value[:,None] * (np.asarray(axis)/np.linalg.norm(axis))
+        H_FM = np.zeros((n_frames,4,4))
+        H_FM[:,:3,:3] = R
+        H_FM[:,:3,3] = p
+        H_FM[:,3,3] = 1
+
+        H_parent = H_bodies.get(joint['parent'], H_bodies['ground'])
+        H_bodies[joint['child']] = H_parent @ joint['parent_offset'] @ H_FM @ np.linalg.inv(joint['child_offset'])
+
+    H_all = np.stack([H_bodies.get(b, H_bodies['ground']) for b in model_kin['bodyNames']], axis=1)
+    return H_all
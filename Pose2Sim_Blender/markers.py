@@ -26,14 +26,22 @@ import numpy as np
 import re
 import bpy
 import bmesh
-from .common import ShowMessageBox, createMaterial
+from bpy.app.handlers import persistent
+from .common import ShowMessageBox, createMaterial, bulk_keyframe_insert
+from .cache import cached_load, cached_memmap
 from .skeletons import *
 from anytree import  PreOrderIter
 
 
 direction = 'zup'
 RADIUS = 20/1000 # 12
+SEGMENTS = (32, 16)
+LOW_POLY_SEGMENTS = (12, 6)
+LOW_POLY_THRESHOLD = 60 # markers
 COLOR =  (0, 1, 0, 0.8)
+POINTCLOUD_DATA = {} # point cloud object name: (first_frame, marker_locs, missing)
+LAZY_DATA = {} # lazy point cloud object name: memmap and window of frames in memory
+LAZY_WINDOW = 600 # frames
 
 
 ## AUTHORSHIP INFORMATION
@@ -69,34 +77,226 @@ def find_first_children_with_id(armature_tree):
     return first_children
 
 
-def load_trc(trc_path):
+def load_trc(trc_path, use_cache=True):
     '''
     Retrieve data and marker names from trc
+    Parsed data is cached for faster loading next time.
 
     INPUT: 
     - trc_path: path to the .trc file
+    - use_cache: read from and write to the cache (default: True)
+
+    OUTPUT:
+    - trc_data_np: 2D numpy array with marker coordinates at each time step
+    - markerNames: list of marker names
+    '''
+
+    return cached_load(trc_path, parse_trc, tag='trc', use_cache=use_cache)
+
+
+def parse_trc_header(header_lines):
+    '''
+    Parse the 5 header lines of a trc file
+
+    INPUT:
+    - header_lines: list of the first 5 lines of the file
+
+    OUTPUT:
+    - trc_header: dict with header values (DataRate, NumFrames, NumMarkers, Units, etc),
+      and 'markerNames' list
+    '''
+
+    keys = header_lines[1].rstrip('\r\n').split('\t')
+    values = header_lines[2].rstrip('\r\n').split('\t')
+    trc_header = {k.strip(): v.strip() for k, v in zip(keys, values) if k.strip()}
+    for k in ['DataRate', 'CameraRate', 'OrigDataRate']:
+        if k in trc_header:
+            trc_header[k] = float(trc_header[k])
+    for k in ['NumFrames', 'NumMarkers', 'OrigDataStartFrame', 'OrigNumFrames']:
+        if k in trc_header:
+            trc_header[k] = int(float(trc_header[k]))
+
+    # marker names: one name every 3 columns after Frame# and Time
+    names = header_lines[3].rstrip('\r\n').split('\t')[2:]
+    trc_header['markerNames'] = [n.strip() for n in names if n.strip()]
+
+    return trc_header
+
+
+def parse_trc_block(text, n_cols):
+    '''
+    Parse a block of trc data lines into a 2D array.
+    Empty cells (missing markers) are read as NaN, short rows are padded with NaN.
+
+    INPUTS:
+    - text: data lines, separated by newlines
+    - n_cols: number of columns (Frame#, Time, and 3 per marker)
+
+    OUTPUT:
+    - block: 2D numpy array of shape (n_lines, n_cols)
+    '''
+
+    lines = [l for l in text.replace('\r', '').split('\n') if l.strip()]
+
+    # fast path: all rows have the right number of cells
+    if all(l.count('\t') == n_cols-1 for l in lines):
+        # fill empty cells with nan
+        text = '\n' + '\n'.join(lines) + '\n'
+        text = text.replace('\t\t', '\tnan\t').replace('\t\t', '\tnan\t')
+        text = text.replace('\n\t', '\nnan\t').replace('\t\n', '\tnan\n')
+        values = np.fromstring(text, sep=' ')
+        if values.size == len(lines)*n_cols:
+            return values.reshape(len(lines), n_cols)
+
+    # slow path: ragged rows
+    block = np.full((len(lines), n_cols), np.nan)
+    for i, line in enumerate(lines):
+        row = line.split('\t')[:n_cols]
+        block[i,:len(row)] = [float(r) if r.strip() else np.nan for r in row]
+    return block
+
+
+def iter_trc_blocks(f, n_cols, chunk_size=2**22):
+    '''
+    Read the data lines of an open trc file block by block
+
+    INPUTS:
+    - f: trc file object, after the header lines
+    - n_cols: number of columns (Frame#, Time, and 3 per marker)
+    - chunk_size: number of characters read at once (default: 4M)
+
+    OUTPUT:
+    - yields 2D numpy arrays of shape (n_lines, n_cols)
+    '''
+
+    remainder = ''
+    while True:
+        chunk = f.read(chunk_size)
+        text = remainder + chunk
+        if chunk:
+            # only parse complete lines
+            cut = text.rfind('\n') + 1
+            text, remainder = text[:cut], text[cut:]
+        if text.strip():
+            yield parse_trc_block(text, n_cols)
+        if not chunk:
+            break
+
+
+def parse_trc(trc_path, chunk_size=2**22):
+    '''
+    Parse trc text file. Use load_trc instead, which caches the result.
+    The header is read once, and the data array is preallocated from it,
+    then filled chunk by chunk.
+
+    INPUTS:
+    - trc_path: path to the .trc file
+    - chunk_size: number of characters read at once (default: 4M)
 
     OUTPUT:
     - trc_data_np: 2D numpy array with marker coordinates at each time step
     - markerNames: list of marker names
     '''
 
-    # read data
-    trc_data_np = np.genfromtxt(trc_path, skip_header=5, delimiter = '\t')
-    
-    # read marker names
     with open(trc_path) as f:
-        for i, line in enumerate(f):
-            if i == 2:
-                trc_header = f.readline()[12:-3]
-            elif i > 2:
-                break
-    markerNames = trc_header.split('\t\t\t')
+        # read header
+        header_lines = [f.readline() for _ in range(5)]
+        trc_header = parse_trc_header(header_lines)
+        markerNames = trc_header['markerNames']
+        n_cols = 2 + 3*len(markerNames)
+        
+        # read data
+        trc_data_np = np.full((trc_header.get('NumFrames', 0), n_cols), np.nan)
+        n_rows = 0
+        for block in iter_trc_blocks(f, n_cols, chunk_size=chunk_size):
+            if n_rows + len(block) > len(trc_data_np): # NumFrames was wrong
+                trc_data_np = np.concatenate([trc_data_np[:n_rows], block])
+            else:
+                trc_data_np[n_rows:n_rows+len(block)] = block
+            n_rows += len(block)
     
+    return trc_data_np[:n_rows], markerNames
+
+
+def write_trc_npy(trc_path, npy_path, chunk_size=2**22):
+    '''
+    Convert a trc file to a .npy file, block by block,
+    without loading the whole file in memory.
+    Use load_trc_memmap instead, which caches the result.
+    '''
+
+    with open(trc_path) as f:
+        header_lines = [f.readline() for _ in range(5)]
+        n_rows = sum(1 for line in f if line.strip())
+    n_cols = 2 + 3*len(parse_trc_header(header_lines)['markerNames'])
+
+    trc_data_np = np.lib.format.open_memmap(npy_path, mode='w+', dtype=np.float64, shape=(n_rows, n_cols))
+    with open(trc_path) as f:
+        [f.readline() for _ in range(5)]
+        n = 0
+        for block in iter_trc_blocks(f, n_cols, chunk_size=chunk_size):
+            trc_data_np[n:n+len(block)] = block
+            n += len(block)
+    trc_data_np.flush()
+    del trc_data_np
+
+
+def load_trc_memmap(trc_path, use_cache=True):
+    '''
+    Same as load_trc, but the data stays on disk:
+    the trc file is converted once to a binary .npy file, which is memory-mapped.
+    For very long recordings.
+
+    INPUT: 
+    - trc_path: path to the .trc file
+    - use_cache: keep the .npy file in the cache (default: True)
+
+    OUTPUT:
+    - trc_data_np: read-only 2D numpy memmap with marker coordinates at each time step
+    - markerNames: list of marker names
+    '''
+
+    with open(trc_path) as f:
+        header_lines = [f.readline() for _ in range(5)]
+    markerNames = parse_trc_header(header_lines)['markerNames']
+    trc_data_np = cached_memmap(trc_path, write_trc_npy, tag='trc_npy', use_cache=use_cache)
+
     return trc_data_np, markerNames
 
 
-def addMarker(marker_collection, position=(0,0,0), text="MARKER", material=bpy.types.Material):
+def marker_mesh(radius=RADIUS, low_poly=False, material=None):
+    '''
+    Sphere mesh shared by all markers of the same radius, level of detail, and material.
+    Created once, then reused.
+
+    INPUTS:
+    - radius: sphere radius (default: RADIUS)
+    - low_poly: fewer faces, for large marker sets (default: False)
+    - material: material of the sphere (default: None)
+
+    OUTPUT:
+    - mesh: bpy.types.Mesh
+    '''
+
+    u_segments, v_segments = LOW_POLY_SEGMENTS if low_poly else SEGMENTS
+    mesh_name = f'marker_sphere_{radius:g}_{u_segments}x{v_segments}'
+    if material is not None:
+        mesh_name += f'_{material.name}'
+    
+    mesh = bpy.data.meshes.get(mesh_name)
+    if mesh is None:
+        mesh = bpy.data.meshes.new(mesh_name)
+        bm = bmesh.new()
+        bmesh.ops.create_uvsphere(bm, u_segments=u_segments, v_segments=v_segments, radius=radius)
+        bm.to_mesh(mesh)
+        bm.free()
+        if material is not None:
+            mesh.materials.append(material)
+    
+    return mesh
+
+
+def addMarker(marker_collection, position=(0,0,0), text="MARKER", material=bpy.types.Material, mesh=None):
     '''
     Add one marker to the scene
 
@@ -104,24 +304,330 @@ def addMarker(marker_collection, position=(0,0,0), text="MARKER", material=bpy.t
     - marker_collection: collection to add the marker to
     - position: marker position (default: (0,0,0))
     - text: marker name (default: "MARKER")
-    - color: marker color (default: COLOR)
+    - material: marker material
+    - mesh: shared sphere mesh (default: None, one is created or reused from marker_mesh)
 
     OUTPUTS:
     - Created new marker
     '''
 
-    mySphere=bpy.data.meshes.new('sphere')
-    sphere = bpy.data.objects.new(text, mySphere)
-    bm = bmesh.new()
-    bmesh.ops.create_uvsphere(bm, u_segments=32, v_segments=16, radius=RADIUS)
-    bm.to_mesh(mySphere)
-    bm.free()
+    if mesh is None:
+        mesh = marker_mesh(material=material if isinstance(material, bpy.types.Material) else None)
+    sphere = bpy.data.objects.new(text, mesh)
     sphere.location=position
-    sphere.active_material = material
     marker_collection.objects.link(sphere)
+
+    return sphere
            
 
-def create_armature_trc(armature_tree, armature_name):
+def trc_marker_locations(trc_data_np, n_markers, conv_fac_frame_rate=1, direction='zup'):
+    '''
+    Marker locations of all frames as a 3D array, in Blender coordinates
+
+    INPUTS:
+    - trc_data_np: 2D numpy array from load_trc
+    - n_markers: number of markers
+    - conv_fac_frame_rate: keep one frame out of conv_fac_frame_rate (default: 1)
+    - direction: 'zup' or 'yup' (default: 'zup')
+
+    OUTPUT:
+    - marker_locs: 3D numpy array of shape (n_frames, n_markers, 3)
+    '''
+
+    marker_locs = trc_data_np[::conv_fac_frame_rate, 2:2+3*n_markers].reshape(-1, n_markers, 3)
+    # y-up to z-up
+    if direction=='zup':
+        marker_locs = marker_locs[:,:,[0,2,1]] * [1,-1,1]
+    
+    return marker_locs
+
+
+def pointcloud_node_group(radius=RADIUS, low_poly=False, material=None):
+    '''
+    Geometry Nodes group which instances a sphere on each point of a mesh,
+    except on points whose 'missing' attribute is True.
+    Created once, then reused.
+
+    INPUTS:
+    - radius: sphere radius (default: RADIUS)
+    - low_poly: fewer faces, for large marker sets (default: False)
+    - material: material of the spheres (default: None)
+
+    OUTPUT:
+    - node_group: bpy.types.GeometryNodeTree
+    '''
+
+    u_segments, v_segments = LOW_POLY_SEGMENTS if low_poly else SEGMENTS
+    group_name = f'marker_pointcloud_{radius:g}_{u_segments}x{v_segments}'
+    if material is not None:
+        group_name += f'_{material.name}'
+    node_group = bpy.data.node_groups.get(group_name)
+    if node_group is not None:
+        return node_group
+    
+    node_group = bpy.data.node_groups.new(group_name, 'GeometryNodeTree')
+    try: # Blender >= 4.0
+        node_group.interface.new_socket('Geometry', in_out='INPUT', socket_type='NodeSocketGeometry')
+        node_group.interface.new_socket('Geometry', in_out='OUTPUT', socket_type='NodeSocketGeometry')
+    except AttributeError: # Blender 3.6
+        node_group.inputs.new('NodeSocketGeometry', 'Geometry')
+        node_group.outputs.new('NodeSocketGeometry', 'Geometry')
+    nodes, links = node_group.nodes, node_group.links
+
+    group_input = nodes.new('NodeGroupInput')
+    group_input.location = (-600, 0)
+    missing = nodes.new('GeometryNodeInputNamedAttribute')
+    missing.data_type = 'BOOLEAN'
+    missing.inputs['Name'].default_value = 'missing'
+    missing.location = (-600, -150)
+    delete = nodes.new('GeometryNodeDeleteGeometry')
+    delete.domain = 'POINT'
+    delete.location = (-400, 0)
+    sphere = nodes.new('GeometryNodeMeshUVSphere')
+    sphere.inputs['Segments'].default_value = u_segments
+    sphere.inputs['Rings'].default_value = v_segments
+    sphere.inputs['Radius'].default_value = radius
+    sphere.location = (-600, -300)
+    set_material = nodes.new('GeometryNodeSetMaterial')
+    set_material.inputs['Material'].default_value = material
+    set_material.location = (-400, -300)
+    instance = nodes.new('GeometryNodeInstanceOnPoints')
+    instance.location = (-200, 0)
+    group_output = nodes.new('NodeGroupOutput')
+    group_output.location = (0, 0)
+
+    missing_output = [o for o in missing.outputs if o.name == 'Attribute' and o.enabled][0]
+    links.new(group_input.outputs[0], delete.inputs['Geometry'])
+    links.new(missing_output, delete.inputs['Selection'])
+    links.new(delete.outputs['Geometry'], instance.inputs['Points'])
+    links.new(sphere.outputs['Mesh'], set_material.inputs['Geometry'])
+    links.new(set_material.outputs['Geometry'], instance.inputs['Instance'])
+    links.new(instance.outputs['Instances'], group_output.inputs[0])
+
+    return node_group
+
+
+def pointcloud_data(obj):
+    '''
+    Marker locations of a point cloud object, kept in memory.
+    Reloaded from its trc file if needed (after reopening a .blend file for example).
+
+    INPUT:
+    - obj: point cloud object created by add_pointcloud_markers
+
+    OUTPUT:
+    - first_frame: frame of the first marker locations
+    - marker_locs: 3D numpy array of shape (n_frames, n_markers, 3), NaN replaced with 0
+    - missing: 2D boolean numpy array of shape (n_frames, n_markers)
+    '''
+
+    if obj.name not in POINTCLOUD_DATA:
+        trc_data_np, markerNames = load_trc(obj['pointcloud_trc'])
+        marker_locs = trc_marker_locations(trc_data_np, len(markerNames), 
+                                           conv_fac_frame_rate=obj['conv_fac_frame_rate'], direction=obj['direction'])
+        missing = np.isnan(marker_locs).any(axis=2)
+        marker_locs = np.nan_to_num(marker_locs).astype(np.float32)
+        POINTCLOUD_DATA[obj.name] = (obj['first_frame'], marker_locs, missing)
+    
+    return POINTCLOUD_DATA[obj.name]
+
+
+def lazy_pointcloud_frame(obj, frame):
+    '''
+    Marker locations of a lazy point cloud object at a given frame.
+    Only a window of LAZY_WINDOW frames around the playhead is read from the memory-mapped trc data,
+    and read again when the playhead leaves it.
+
+    INPUTS:
+    - obj: lazy point cloud object created by add_pointcloud_markers
+    - frame: scene frame
+
+    OUTPUTS:
+    - marker_locs: 2D numpy array of shape (n_markers, 3), NaN replaced with 0
+    - missing: 1D boolean numpy array of shape (n_markers,)
+    '''
+
+    if obj.name not in LAZY_DATA:
+        trc_data_np, markerNames = load_trc_memmap(obj['pointcloud_trc'])
+        LAZY_DATA[obj.name] = {'trc_data_np': trc_data_np, 'n_markers': len(markerNames), 'start': 0, 'marker_locs': None, 'missing': None}
+    lazy_data = LAZY_DATA[obj.name]
+    trc_data_np, conv_fac_frame_rate = lazy_data['trc_data_np'], obj['conv_fac_frame_rate']
+
+    n_frames = -(-len(trc_data_np) // conv_fac_frame_rate)
+    n = min(max(frame - obj['first_frame'], 0), n_frames-1)
+    start = lazy_data['start']
+    if lazy_data['marker_locs'] is None or not start <= n < start + len(lazy_data['marker_locs']):
+        # new window, mostly ahead of the playhead
+        start = max(n - LAZY_WINDOW//4, 0)
+        window = np.asarray(trc_data_np[start*conv_fac_frame_rate : (start+LAZY_WINDOW)*conv_fac_frame_rate : conv_fac_frame_rate])
+        marker_locs = trc_marker_locations(window, lazy_data['n_markers'], direction=obj['direction'])
+        lazy_data['start'] = start
+        lazy_data['missing'] = np.isnan(marker_locs).any(axis=2)
+        lazy_data['marker_locs'] = np.nan_to_num(marker_locs).astype(np.float32)
+
+    return lazy_data['marker_locs'][n-start], lazy_data['missing'][n-start]
+
+
+def pointcloud_frame(obj, frame):
+    '''
+    Marker locations of a point cloud object at a given frame
+
+    INPUTS:
+    - obj: point cloud object created by add_pointcloud_markers
+    - frame: scene frame
+
+    OUTPUTS:
+    - marker_locs: 2D numpy array of shape (n_markers, 3), NaN replaced with 0
+    - missing: 1D boolean numpy array of shape (n_markers,)
+    '''
+
+    if obj.get('lazy'):
+        return lazy_pointcloud_frame(obj, frame)
+
+    first_frame, marker_locs, missing = pointcloud_data(obj)
+    n = min(max(frame - first_frame, 0), len(marker_locs)-1)
+    return marker_locs[n], missing[n]
+
+
+def set_pointcloud_frame(obj, frame):
+    '''
+    Move the points of a point cloud object to their locations at a given frame
+    '''
+
+    marker_locs, missing = pointcloud_frame(obj, frame)
+    mesh = obj.data
+    mesh.vertices.foreach_set('co', marker_locs.ravel())
+    mesh.attributes['missing'].data.foreach_set('value', missing)
+    mesh.update()
+
+
+@persistent
+def update_pointcloud_markers(scene, depsgraph=None):
+    '''
+    Frame change handler: move the points of all point cloud markers
+    '''
+
+    for obj in scene.objects:
+        if 'pointcloud_trc' in obj:
+            try:
+                set_pointcloud_frame(obj, scene.frame_current)
+            except Exception as e:
+                print(f'Could not update {obj.name} markers: {e}')
+
+
+def register_pointcloud_handler():
+    '''
+    Update point cloud markers at each frame change
+    '''
+
+    if update_pointcloud_markers not in bpy.app.handlers.frame_change_pre:
+        bpy.app.handlers.frame_change_pre.append(update_pointcloud_markers)
+
+
+def unregister_pointcloud_handler():
+    '''
+    Stop updating point cloud markers
+    '''
+
+    if update_pointcloud_markers in bpy.app.handlers.frame_change_pre:
+        bpy.app.handlers.frame_change_pre.remove(update_pointcloud_markers)
+    POINTCLOUD_DATA.clear()
+    LAZY_DATA.clear()
+
+
+def add_pointcloud_markers(marker_collection, trc_path, markerNames, marker_locs, first_frame, conv_fac_frame_rate=1, 
+                           direction='zup', radius=RADIUS, low_poly=False, material=None):
+    '''
+    Add all markers as the points of a single mesh, displayed as spheres with Geometry Nodes.
+    Points are moved at each frame change by a handler, instead of being keyframed.
+    Much faster than one object per marker for large marker sets.
+    Marker names are stored in the 'marker_name' attribute (and indices in 'marker_index').
+    If marker_locs is None, the point cloud is lazy: marker locations stay on disk,
+    and only a window of frames around the playhead is loaded (see lazy_pointcloud_frame).
+
+    INPUTS:
+    - marker_collection: collection to add the point cloud to
+    - trc_path: path to the .trc file, to reload marker locations when reopening the .blend file
+    - markerNames: list of marker names
+    - marker_locs: 3D numpy array of shape (n_frames, n_markers, 3), or None for a lazy point cloud
+    - first_frame: frame of the first marker locations
+    - conv_fac_frame_rate, direction: as used to compute marker_locs
+    - radius, low_poly, material: sphere parameters
+
+    OUTPUTS:
+    - obj: point cloud object
+    '''
+
+    name = os.path.splitext(os.path.basename(trc_path))[0]
+    mesh = bpy.data.meshes.new(name)
+    mesh.vertices.add(len(markerNames))
+    mesh.attributes.new('missing', 'BOOLEAN', 'POINT')
+    mesh.attributes.new('marker_index', 'INT', 'POINT').data.foreach_set('value', np.arange(len(markerNames)))
+    marker_name_attr = mesh.attributes.new('marker_name', 'STRING', 'POINT')
+    for i, markerName in enumerate(markerNames):
+        marker_name_attr.data[i].value = markerName.strip()
+    
+    obj = bpy.data.objects.new(name, mesh)
+    marker_collection.objects.link(obj)
+    obj['pointcloud_trc'] = trc_path
+    obj['marker_names'] = [m.strip() for m in markerNames]
+    obj['first_frame'] = first_frame
+    obj['conv_fac_frame_rate'] = conv_fac_frame_rate
+    obj['direction'] = direction
+    modifier = obj.modifiers.new('Markers', 'NODES')
+    modifier.node_group = pointcloud_node_group(radius=radius, low_poly=low_poly, material=material)
+
+    if marker_locs is None:
+        obj['lazy'] = True
+    else:
+        missing = np.isnan(marker_locs).any(axis=2)
+        POINTCLOUD_DATA[obj.name] = (first_frame, np.nan_to_num(marker_locs).astype(np.float32), missing)
+    register_pointcloud_handler()
+    set_pointcloud_frame(obj, bpy.context.scene.frame_current)
+
+    return obj
+
+
+def select_pointcloud_markers(obj, markerNames):
+    '''
+    Select points of a point cloud object by marker name
+
+    INPUTS:
+    - obj: point cloud object created by add_pointcloud_markers
+    - markerNames: list of marker names to select
+
+    OUTPUT:
+    - indices: indices of the selected points
+    '''
+
+    selected = np.isin(list(obj['marker_names']), markerNames)
+    obj.data.vertices.foreach_set('select', selected)
+    obj.data.update()
+
+    return np.flatnonzero(selected)
+
+
+def marker_index(marker_objects):
+    '''
+    Index markers by name, once for the whole import.
+    Blender's '.001' name suffixes are stripped.
+    If several markers have the same name, the first one is kept.
+
+    INPUT:
+    - marker_objects: marker objects (a collection's objects for example)
+
+    OUTPUT:
+    - index: dict {marker name: marker object}
+    '''
+
+    index = {}
+    for o in marker_objects:
+        index.setdefault(re.sub(r'\.\d+$', '', o.name.strip()), o)
+    
+    return index
+
+
+def create_armature_trc(armature_tree, armature_name, markers_by_name=None):
     '''
     Creates an armature and sets up the bone hierarchy based on the given tree.
     Constrain armature to marker spheres.
@@ -129,6 +635,7 @@ def create_armature_trc(armature_tree, armature_name):
     INPUTS:
     - armature_tree: anytree hierarchy of bones
     - armature_name: name of the armature object
+    - markers_by_name: dict {marker name: marker object} from marker_index (default: built from the marker collection)
 
     OUTPUTS:
     - Created armature with bones and constraints
@@ -148,6 +655,8 @@ def create_armature_trc(armature_tree, armature_name):
 
     # Set the current frame to the middle of the animation (points are sometimes not well detected at the end of the animation)
     marker_collection = bpy.data.collections[armature_name+'.trc']
+    if markers_by_name is None:
+        markers_by_name = marker_index(marker_collection.objects)
     first_marker = marker_collection.objects[0]
     frame_start, frame_end = first_marker.animation_data.action.frame_range
     bpy.context.scene.frame_set(round((frame_start + frame_end) / 2))    
@@ -160,17 +669,15 @@ def create_armature_trc(armature_tree, armature_name):
         bones[node.name] = bone
         if node.parent:
             # tail (child)
-            try:
-                child_name = node.name
-                tail_marker = [o for o in marker_collection.objects if re.sub(r'\.\d+$', '', o.name.strip()) == child_name][0]
-            except:
+            child_name = node.name
+            tail_marker = markers_by_name.get(child_name)
+            if tail_marker is None:
                 print(f'Could not find {child_name} in the TRC file.')
                 continue
             # head (parent)
-            try:
-                parent_name = node.parent.name
-                head_marker = [o for o in marker_collection.objects if re.sub(r'\.\d+$', '', o.name.strip()) == parent_name][0]
-            except:
+            parent_name = node.parent.name
+            head_marker = markers_by_name.get(parent_name)
+            if head_marker is None:
                 print(f'Could not find {parent_name} in the TRC file.')
                 continue
             bone.tail = tail_marker.location
@@ -185,7 +692,7 @@ def create_armature_trc(armature_tree, armature_name):
         bone_name = node.name
         bone = armature_object.pose.bones.get(bone_name)
         if bone and node.parent:
-            head_marker = [o for o in marker_collection.objects if re.sub(r'\.\d+$', '', o.name.strip()) == node.name][0]
+            head_marker = markers_by_name[node.name]
             armature_object.data.bones.active = armature_object.data.bones.get(bone_name)
             ik_constraint = bone.constraints.new(type='IK')
             ik_constraint.target = head_marker
@@ -199,7 +706,7 @@ def create_armature_trc(armature_tree, armature_name):
         if bone and node.parent:
              if node.parent.name in first_children or node.name in first_children:
                 copy_loc_constraint = bone.constraints.new(type='COPY_LOCATION')
-                copy_loc_constraint.target = [o for o in marker_collection.objects if re.sub(r'\.\d+$', '', o.name.strip()) == node.parent.name][0]
+                copy_loc_constraint.target = markers_by_name[node.parent.name]
     # Delete the child "copy location" constraint when the parent already has one (dirty fix to make it work for Body and Body with feet)
     for node in PreOrderIter(armature_tree):
         bone_name = node.name
@@ -301,7 +808,7 @@ def create_armature_c3d(armature_tree):
     bpy.ops.object.mode_set(mode='OBJECT')
 
  
-def import_trc(trc_path, direction='zup', target_framerate='auto', armature_type=None):
+def import_trc(trc_path, direction='zup', target_framerate='auto', armature_type=None, bulk_keyframes=True, low_poly='auto', marker_mode='objects'):
     '''
     Import a .trc marker file into Blender.
     OpenSim API is not required.
@@ -310,6 +817,10 @@ def import_trc(trc_path, direction='zup', target_framerate='auto', armature_type
     - trc_path: path to a .trc marker file
     - direction: 'zup' or 'yup' (default: 'zup')
     - armature_type: None or string (name of the model from skeletons.py, 'halpe_26' for example)
+    - bulk_keyframes: write all keyframes at once (default), or frame by frame with keyframe_insert
+    - low_poly: True, False, or 'auto' for low poly spheres above LOW_POLY_THRESHOLD markers
+    - marker_mode: 'objects' (one animated object per marker), 'pointcloud' (one mesh for all markers, see add_pointcloud_markers),
+                   or 'lazy' (point cloud whose data stays on disk, for very long recordings)
 
     OUTPUTS:
     - Animated markers
@@ -318,12 +829,15 @@ def import_trc(trc_path, direction='zup', target_framerate='auto', armature_type
     # TRC file
     if trc_path.endswith('.trc'):
         # import trc    
-        trc_data_np, markerNames = load_trc(trc_path)
+        if marker_mode == 'lazy':
+            trc_data_np, markerNames = load_trc_memmap(trc_path) # not read until needed
+        else:
+            trc_data_np, markerNames = load_trc(trc_path)
 
-        # set framerate
-        times = trc_data_np[:,1]
+        # set framerate (only first and last rows are read, which matters in lazy mode)
+        n_frames = len(trc_data_np)
         first_frame = round(trc_data_np[0,0])
-        fps = round((len(times)-1) / (times[-1] - times[0]))
+        fps = round((n_frames-1) / (trc_data_np[-1,1] - trc_data_np[0,1]))
         if target_framerate == 'auto':
             target_framerate = fps
         target_framerate = round(int(target_framerate))
@@ -336,37 +850,62 @@ def import_trc(trc_path, direction='zup', target_framerate='auto', armature_type
         # create markers
         marker_collection = bpy.data.collections.new(os.path.basename(trc_path))
         bpy.context.scene.collection.children.link(marker_collection)
-        for markerName in markerNames:
-            matg = createMaterial(color=COLOR, metallic = 0.5, roughness = 0.5)
-            addMarker(marker_collection,text=markerName.strip(), material=matg)
+        if low_poly == 'auto':
+            low_poly = len(markerNames) > LOW_POLY_THRESHOLD
+        matg = createMaterial(color=COLOR, metallic = 0.5, roughness = 0.5)
+
+        # point cloud: no keyframes, points are moved by a frame change handler
+        if marker_mode in ['pointcloud', 'lazy']:
+            if marker_mode == 'lazy':
+                marker_locs = None
+            else:
+                marker_locs = trc_marker_locations(trc_data_np, len(markerNames), conv_fac_frame_rate=conv_fac_frame_rate, direction=direction)
+            obj = add_pointcloud_markers(marker_collection, trc_path, markerNames, marker_locs, first_frame, conv_fac_frame_rate=conv_fac_frame_rate, 
+                                         direction=direction, radius=RADIUS, low_poly=low_poly, material=matg)
+            obj.select_set(True)
+            if armature_type is not None and armature_type.upper() != 'NONE':
+                ShowMessageBox("Armatures are not supported in point cloud mode", "Not supported")
+            print(f'Marker data imported from {trc_path}')
+            return
+
+        sphere_mesh = marker_mesh(radius=RADIUS, low_poly=low_poly, material=matg)
+        marker_objs = [addMarker(marker_collection, text=markerName.strip(), material=matg, mesh=sphere_mesh) for markerName in markerNames]
+
+        markers_by_name = marker_index(marker_objs)
 
         # animate markers
-        coll_marker_names = [ob.name for ob in marker_collection.objects]
-        for i, m in enumerate(markerNames):
-            m = [coll_m.strip() for coll_m in coll_marker_names if m.strip() == re.sub(r'\.\d+$', '', coll_m.strip())][0]
-            for n in range(0, len(times), conv_fac_frame_rate):
-                # y-up to z-up
-                if direction=='zup':
-                    # loc_x = trc_data_np[n,3*i+4]
-                    # loc_y = trc_data_np[n,3*i+2]
-                    # loc_z = trc_data_np[n,3*i+3]
-                    loc_x = trc_data_np[n,3*i+2]
-                    loc_y = -trc_data_np[n,3*i+4]
-                    loc_z = trc_data_np[n,3*i+3]
-                else:
-                    loc_x = trc_data_np[n,3*i+2]
-                    loc_y = trc_data_np[n,3*i+4]
-                    loc_z = trc_data_np[n,3*i+3]                    
-                obj=marker_collection.objects[m]
-                obj.location=loc_x,loc_y,loc_z
-                obj.keyframe_insert('location',frame=first_frame+round(n/conv_fac_frame_rate))
+        if bulk_keyframes:
+            # all frames and markers at once: (n_frames, n_markers, 3)
+            marker_locs = trc_marker_locations(trc_data_np, len(markerNames), conv_fac_frame_rate=conv_fac_frame_rate, direction=direction)
+            frames = first_frame + np.arange(len(marker_locs))
+            for i, obj in enumerate(marker_objs):
+                bulk_keyframe_insert(obj, 'location', frames, marker_locs[:,i,:], group='Object Transforms')
+                obj.location = marker_locs[0,i,:]
+        else:
+            for i, m in enumerate(markerNames):
+                obj = marker_objs[i]
+                for n in range(0, n_frames, conv_fac_frame_rate):
+                    # y-up to z-up
+                    if direction=='zup':
+                        # loc_x = trc_data_np[n,3*i+4]
+                        # loc_y = trc_data_np[n,3*i+2]
+                        # loc_z = trc_data_np[n,3*i+3]
+                        loc_x = trc_data_np[n,3*i+2]
+                        loc_y = -trc_data_np[n,3*i+4]
+                        loc_z = trc_data_np[n,3*i+3]
+                    else:
+                        loc_x = trc_data_np[n,3*i+2]
+                        loc_y = trc_data_np[n,3*i+4]
+                        loc_z = trc_data_np[n,3*i+3]                    
+                    obj.location=loc_x,loc_y,loc_z
+                    obj.keyframe_insert('location',frame=first_frame+round(n/conv_fac_frame_rate))
         [ob.select_set(True) for ob in marker_collection.objects]
                 
         # create armature
         armature_name = os.path.splitext(os.path.basename(trc_path))[0]
         if armature_type.upper() != 'NONE':
             armature_tree = eval(armature_type.upper())
-            create_armature_trc(armature_tree, armature_name)
+            create_armature_trc(armature_tree, armature_name, markers_by_name=markers_by_name)
         
     
     # C3D file
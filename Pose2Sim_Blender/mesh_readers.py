@@ -0,0 +1,440 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+'''
+    ##################################################
+    ## READ MESH FILES WITHOUT BLENDER OPERATORS    ##
+    ##################################################
+
+    Decode mesh files straight into numpy arrays of vertices and triangular faces.
+    Blender is not required, so that these functions can also run in other processes.
+
+    Supported formats:
+    - .stl (binary and ASCII)
+    - .ply (binary and ASCII)
+    - .vtp (VTK XML polydata as written by OpenSim: ascii, binary, or appended data, 
+      optionally zlib compressed)
+    Polygons and triangle strips are split into triangles.
+    - .npz (decoded meshes saved by convert_mesh)
+
+'''
+
+
+## INIT
+import os
+import re
+import zlib
+import base64
+import xml.etree.ElementTree as ET
+import numpy as np
+
+VTK_TYPES = {'Int8': 'i1', 'UInt8': 'u1', 'Int16': 'i2', 'UInt16': 'u2',
+             'Int32': 'i4', 'UInt32': 'u4', 'Int64': 'i8', 'UInt64': 'u8',
+             'Float32': 'f4', 'Float64': 'f8'}
+PLY_TYPES = {'char': 'i1', 'uchar': 'u1', 'short': 'i2', 'ushort': 'u2',
+             'int': 'i4', 'uint': 'u4', 'float': 'f4', 'double': 'f8',
+             'int8': 'i1', 'uint8': 'u1', 'int16': 'i2', 'uint16': 'u2',
+             'int32': 'i4', 'uint32': 'u4', 'float32': 'f4', 'float64': 'f8'}
+
+
+## AUTHORSHIP INFORMATION
+__author__ = "David Pagnon"
+__copyright__ = "Copyright 2023, Pose2Sim_Blender"
+__credits__ = ["David Pagnon"]
+__license__ = "MIT License"
+__version__ = "0.7.0"
+__maintainer__ = "David Pagnon"
+__email__ = "contact@david-pagnon.com"
+__status__ = "Development"
+
+
+## FUNCTIONS
+def merge_vertices(triangles):
+    '''
+    Merge identical vertices of a triangle soup
+
+    INPUT:
+    - triangles: 3D numpy array of shape (n_faces, 3, 3)
+
+    OUTPUTS:
+    - vertices: 2D numpy array of shape (n_vertices, 3)
+    - faces: 2D numpy array of vertex indices, shape (n_faces, 3)
+    '''
+
+    # compare the 12 bytes of each vertex at once, much faster than np.unique(axis=0)
+    points = np.ascontiguousarray(triangles.reshape(-1, 3), dtype=np.float32)
+    keys = points.view(np.dtype((np.void, points.itemsize*3))).ravel()
+    _, first, faces = np.unique(keys, return_index=True, return_inverse=True)
+    return points[first], faces.reshape(-1, 3).astype(np.int32)
+
+
+def read_stl(stl_path):
+    '''
+    Read a binary or ASCII .stl file
+
+    INPUT:
+    - stl_path: path to the .stl file
+
+    OUTPUTS:
+    - vertices: 2D numpy array of shape (n_vertices, 3)
+    - faces: 2D numpy array of vertex indices, shape (n_faces, 3)
+    '''
+
+    with open(stl_path, 'rb') as f:
+        data = f.read()
+
+    # binary: 80-byte header, face count, then 50 bytes per face
+    # (some VTK exports write a wrong face count, trust the file size instead)
+    is_ascii = data[:5] == b'solid' and b'facet' in data[:1024]
+    if len(data) >= 84 and not is_ascii:
+        n_faces = int(np.frombuffer(data, dtype='<u4', count=1, offset=80)[0])
+        if len(data) != 84 + 50*n_faces and (len(data)-84) % 50 == 0:
+            n_faces = (len(data)-84) // 50
+        if len(data) == 84 + 50*n_faces:
+            face_dtype = np.dtype([('normal', '<f4', 3), ('triangle', '<f4', (3,3)), ('attr', '<u2')])
+            triangles = np.frombuffer(data, dtype=face_dtype, count=n_faces, offset=84)['triangle']
+            return merge_vertices(triangles)
+
+    # ASCII: 'vertex x y z' lines
+    text = data.decode('ascii', errors='ignore')
+    coords = [line.split()[1:4] for line in text.splitlines() if line.strip().startswith('vertex')]
+    triangles = np.array(coords, dtype=np.float32).reshape(-1, 3, 3)
+    return merge_vertices(triangles)
+
+
+def triangulate_polygons(connectivity, offsets):
+    '''
+    Split polygons into triangle fans
+
+    INPUTS:
+    - connectivity: 1D numpy array of the vertex indices of all polygons, one after the other
+    - offsets: 1D numpy array of the end of each polygon in connectivity
+
+    OUTPUT:
+    - faces: 2D numpy array of vertex indices, shape (n_triangles, 3)
+    '''
+
+    offsets = np.asarray(offsets, dtype=np.int64)
+    counts = np.diff(offsets, prepend=0)
+    starts = offsets - counts
+    n_tri = np.clip(counts - 2, 0, None)
+    poly = np.repeat(np.arange(len(counts)), n_tri)
+    corner = np.arange(n_tri.sum()) - np.repeat(np.cumsum(n_tri) - n_tri, n_tri) + 1
+    first = starts[poly]
+    faces = np.stack([connectivity[first], connectivity[first+corner], connectivity[first+corner+1]], axis=1)
+
+    return faces.astype(np.int32)
+
+
+def triangulate_strips(connectivity, offsets):
+    '''
+    Split triangle strips into triangles, keeping a consistent winding
+
+    INPUTS:
+    - connectivity: 1D numpy array of the vertex indices of all strips, one after the other
+    - offsets: 1D numpy array of the end of each strip in connectivity
+
+    OUTPUT:
+    - faces: 2D numpy array of vertex indices, shape (n_triangles, 3)
+    '''
+
+    offsets = np.asarray(offsets, dtype=np.int64)
+    counts = np.diff(offsets, prepend=0)
+    starts = offsets - counts
+    n_tri = np.clip(counts - 2, 0, None)
+    strip = np.repeat(np.arange(len(counts)), n_tri)
+    j = np.arange(n_tri.sum()) - np.repeat(np.cumsum(n_tri) - n_tri, n_tri)
+    first = starts[strip] + j
+    odd = (j % 2).astype(bool)
+    a, b = np.where(odd, first+1, first), np.where(odd, first, first+1)
+    faces = np.stack([connectivity[a], connectivity[b], connectivity[first+2]], axis=1)
+
+    return faces.astype(np.int32)
+
+
+def read_ply(ply_path):
+    '''
+    Read a binary or ASCII .ply file
+
+    INPUT:
+    - ply_path: path to the .ply file
+
+    OUTPUTS:
+    - vertices: 2D numpy array of shape (n_vertices, 3)
+    - faces: 2D numpy array of vertex indices, shape (n_faces, 3)
+    '''
+
+    with open(ply_path, 'rb') as f:
+        data = f.read()
+
+    # header: elements, with their scalar or list properties
+    header_end = data.index(b'end_header') + len(b'end_header')
+    header_end = data.index(b'\n', header_end) + 1
+    elements = []
+    fmt = 'ascii'
+    for line in data[:header_end].decode('ascii', errors='ignore').splitlines():
+        words = line.split()
+        if not words:
+            continue
+        if words[0] == 'format':
+            fmt = words[1]
+        elif words[0] == 'element':
+            elements.append({'name': words[1], 'count': int(words[2]), 'props': []})
+        elif words[0] == 'property':
+            if words[1] == 'list':
+                elements[-1]['props'].append((words[4], (PLY_TYPES[words[2]], PLY_TYPES[words[3]])))
+            else:
+                elements[-1]['props'].append((words[2], PLY_TYPES[words[1]]))
+
+    vertices, faces = np.zeros((0, 3), dtype=np.float32), np.zeros((0, 3), dtype=np.int32)
+    if fmt == 'ascii':
+        tokens = data[header_end:].split()
+        pos = 0
+        for el in elements:
+            if not any(isinstance(t, tuple) for _, t in el['props']):
+                n_props = len(el['props'])
+                values = np.array(tokens[pos:pos+el['count']*n_props], dtype=np.float64).reshape(-1, n_props)
+                pos += el['count']*n_props
+                if el['name'] == 'vertex':
+                    names = [name for name, _ in el['props']]
+                    vertices = values[:, [names.index('x'), names.index('y'), names.index('z')]]
+            else: # single list property, such as vertex_indices
+                rows = []
+                for _ in range(el['count']):
+                    n = int(tokens[pos])
+                    rows.append([int(t) for t in tokens[pos+1:pos+1+n]])
+                    pos += n+1
+                if el['name'] == 'face':
+                    counts = np.array([len(r) for r in rows])
+                    faces = triangulate_polygons(np.array([i for r in rows for i in r], dtype=np.int64), np.cumsum(counts))
+        return vertices.astype(np.float32), faces
+
+    endian = '<' if fmt == 'binary_little_endian' else '>'
+    pos = header_end
+    for el in elements:
+        lists = [(name, t) for name, t in el['props'] if isinstance(t, tuple)]
+        if not lists:
+            dtype = np.dtype([(name, endian+t) for name, t in el['props']])
+            values = np.frombuffer(data, dtype=dtype, count=el['count'], offset=pos)
+            pos += dtype.itemsize * el['count']
+            if el['name'] == 'vertex':
+                vertices = np.stack([values['x'], values['y'], values['z']], axis=1)
+            continue
+
+        # list element: assume all rows have the length of the first one, and check it
+        count_t, index_t = lists[0][1]
+        n = int(np.frombuffer(data, dtype=endian+count_t, count=1, offset=pos)[0])
+        dtype = np.dtype([('n', endian+count_t), ('indices', endian+index_t, (n,))])
+        if len(el['props']) == 1 and pos + dtype.itemsize*el['count'] <= len(data):
+            values = np.frombuffer(data, dtype=dtype, count=el['count'], offset=pos)
+            if np.all(values['n'] == n):
+                pos += dtype.itemsize * el['count']
+                if el['name'] == 'face':
+                    indices = values['indices'].astype(np.int64)
+                    faces = triangulate_polygons(indices.ravel(), np.arange(1, el['count']+1) * n)
+                continue
+        # mixed polygon sizes
+        count_size, index_size = np.dtype(count_t).itemsize, np.dtype(index_t).itemsize
+        connectivity, offsets = [], []
+        for _ in range(el['count']):
+            for name, t in el['props']:
+                if isinstance(t, tuple):
+                    n = int(np.frombuffer(data, dtype=endian+t[0], count=1, offset=pos)[0])
+                    indices = np.frombuffer(data, dtype=endian+t[1], count=n, offset=pos+count_size)
+                    pos += count_size + n*index_size
+                    if name in ('vertex_indices', 'vertex_index'):
+                        connectivity.append(indices)
+                        offsets.append(n)
+                else:
+                    pos += np.dtype(t).itemsize
+        if el['name'] == 'face' and connectivity:
+            faces = triangulate_polygons(np.concatenate(connectivity).astype(np.int64), np.cumsum(offsets))
+
+    return vertices.astype(np.float32), faces
+
+
+def decode_vtp_array(text, dtype, header_dtype, compressed):
+    '''
+    Decode a base64 VTK data array, possibly split into zlib compressed blocks
+    '''
+
+    text = re.sub(rb'\s+', b'', text)
+    if not compressed:
+        raw = base64.b64decode(text)
+        n_bytes = int(np.frombuffer(raw, dtype=header_dtype, count=1)[0])
+        return np.frombuffer(raw, dtype=dtype, count=n_bytes//dtype.itemsize, offset=header_dtype.itemsize)
+
+    # header: number of blocks, block size, last block size, compressed size of each block
+    n_chars = lambda n_bytes: -(-n_bytes//3) * 4
+    n_blocks = int(np.frombuffer(base64.b64decode(text[:n_chars(3*header_dtype.itemsize)]), dtype=header_dtype, count=1)[0])
+    header_chars = n_chars((3+n_blocks) * header_dtype.itemsize)
+    header = np.frombuffer(base64.b64decode(text[:header_chars]), dtype=header_dtype, count=3+n_blocks)
+    raw = base64.b64decode(text[header_chars:])
+    return decompress_vtp_blocks(raw, header, dtype)
+
+
+def decompress_vtp_blocks(raw, header, dtype):
+    '''
+    Concatenate zlib compressed blocks of a VTK data array
+    '''
+
+    n_blocks = int(header[0])
+    block_ends = np.cumsum(header[3:3+n_blocks].astype(np.int64))
+    block_starts = block_ends - header[3:3+n_blocks].astype(np.int64)
+    data = b''.join(zlib.decompress(raw[s:e]) for s, e in zip(block_starts, block_ends))
+    return np.frombuffer(data, dtype=dtype)
+
+
+def read_appended_array(appended, offset, dtype, header_dtype, compressed, encoding):
+    '''
+    Read a VTK data array from the AppendedData section of a .vtp file
+    '''
+
+    if encoding == 'base64':
+        rest = appended[offset:]
+        if not compressed:
+            n_bytes = int(np.frombuffer(base64.b64decode(rest[:-(-header_dtype.itemsize//3)*4]), dtype=header_dtype, count=1)[0])
+            end = -(-(header_dtype.itemsize + n_bytes)//3) * 4
+        else:
+            n_chars = lambda n_bytes: -(-n_bytes//3) * 4
+            n_blocks = int(np.frombuffer(base64.b64decode(rest[:n_chars(3*header_dtype.itemsize)]), dtype=header_dtype, count=1)[0])
+            header_chars = n_chars((3+n_blocks) * header_dtype.itemsize)
+            header = np.frombuffer(base64.b64decode(rest[:header_chars]), dtype=header_dtype, count=3+n_blocks)
+            end = header_chars + n_chars(int(header[3:].astype(np.int64).sum()))
+        return decode_vtp_array(rest[:end], dtype, header_dtype, compressed)
+
+    if not compressed:
+        n_bytes = int(np.frombuffer(appended, dtype=header_dtype, count=1, offset=offset)[0])
+        return np.frombuffer(appended, dtype=dtype, count=n_bytes//dtype.itemsize, offset=offset+header_dtype.itemsize)
+    n_blocks = int(np.frombuffer(appended, dtype=header_dtype, count=1, offset=offset)[0])
+    header = np.frombuffer(appended, dtype=header_dtype, count=3+n_blocks, offset=offset)
+    start = offset + (3+n_blocks)*header_dtype.itemsize
+    return decompress_vtp_blocks(appended[start:], header, dtype)
+
+
+def read_vtp(vtp_path):
+    '''
+    Read a VTK XML polydata .vtp file, as used by OpenSim for its geometry.
+    Polygons and triangle strips are split into triangles.
+
+    INPUT:
+    - vtp_path: path to the .vtp file
+
+    OUTPUTS:
+    - vertices: 2D numpy array of shape (n_vertices, 3)
+    - faces: 2D numpy array of vertex indices, shape (n_faces, 3)
+    '''
+
+    with open(vtp_path, 'rb') as f:
+        data = f.read()
+
+    # raw appended data is not valid XML: cut it out before parsing
+    appended, encoding = b'', 'raw'
+    appended_start = data.find(b'<AppendedData')
+    if appended_start >= 0:
+        tag_end = data.index(b'>', appended_start)
+        encoding_match = re.search(rb'encoding="(\w+)"', data[appended_start:tag_end])
+        encoding = encoding_match.group(1).decode() if encoding_match else 'raw'
+        appended_end = data.rfind(b'</AppendedData>')
+        appended = data[tag_end+1:appended_end]
+        appended = appended[appended.index(b'_')+1:]
+        if encoding == 'base64':
+            appended = re.sub(rb'\s+', b'', appended)
+        data = data[:tag_end+1] + data[appended_end:]
+
+    root = ET.fromstring(data)
+    endian = '>' if root.get('byte_order') == 'BigEndian' else '<'
+    header_dtype = np.dtype(endian + VTK_TYPES[root.get('header_type', 'UInt32')])
+    compressed = root.get('compressor') is not None
+
+    def read_array(node):
+        dtype = np.dtype(endian + VTK_TYPES[node.get('type')])
+        fmt = node.get('format', 'ascii')
+        if fmt == 'ascii':
+            return np.array((node.text or '').split(), dtype=dtype)
+        if fmt == 'binary':
+            return decode_vtp_array((node.text or '').encode(), dtype, header_dtype, compressed)
+        return read_appended_array(appended, int(node.get('offset')), dtype, header_dtype, compressed, encoding)
+
+    def cells(piece, tag):
+        node = piece.find(tag)
+        if node is None:
+            return None, None
+        arrays = {a.get('Name'): a for a in node.findall('DataArray')}
+        if 'connectivity' not in arrays or 'offsets' not in arrays:
+            return None, None
+        return read_array(arrays['connectivity']).astype(np.int64), read_array(arrays['offsets']).astype(np.int64)
+
+    vertices_list, faces_list, n_vertices = [], [], 0
+    for piece in root.iter('Piece'):
+        points = read_array(piece.find('Points').find('DataArray'))
+        vertices_list.append(points.reshape(-1, 3))
+        connectivity, offsets = cells(piece, 'Polys')
+        if connectivity is not None:
+            faces_list.append(triangulate_polygons(connectivity, offsets) + n_vertices)
+        connectivity, offsets = cells(piece, 'Strips')
+        if connectivity is not None:
+            faces_list.append(triangulate_strips(connectivity, offsets) + n_vertices)
+        n_vertices += len(vertices_list[-1])
+
+    vertices = np.concatenate(vertices_list) if vertices_list else np.zeros((0, 3))
+    faces = np.concatenate(faces_list) if faces_list else np.zeros((0, 3), dtype=np.int32)
+    return vertices.astype(np.float32), faces.astype(np.int32)
+
+
+def read_npz(npz_path):
+    '''
+    Read a mesh saved by convert_mesh
+
+    INPUT:
+    - npz_path: path to the .npz file
+
+    OUTPUTS:
+    - vertices: 2D numpy array of shape (n_vertices, 3)
+    - faces: 2D numpy array of vertex indices, shape (n_faces, 3)
+    '''
+
+    with np.load(npz_path, allow_pickle=False) as mesh:
+        return mesh['vertices'], mesh['faces']
+
+
+def convert_mesh(mesh_path, npz_path):
+    '''
+    Decode a mesh file and save its vertices and faces as a .npz file.
+    Only depends on numpy, so that it can run in a separate process.
+
+    INPUTS:
+    - mesh_path: path to the .stl, .ply, or .vtp file
+    - npz_path: path to the output .npz file
+
+    OUTPUT:
+    - npz_path
+    '''
+
+    vertices, faces = read_mesh(mesh_path)
+    os.makedirs(os.path.dirname(npz_path), exist_ok=True)
+    tmp_path = npz_path[:-4] + f'.tmp.{os.getpid()}.npz'
+    np.savez(tmp_path, vertices=vertices, faces=faces)
+    os.replace(tmp_path, npz_path)
+
+    return npz_path
+
+
+def read_mesh(mesh_path):
+    '''
+    Read a .stl, .ply, .vtp, or .npz mesh file, depending on its extension
+
+    INPUT:
+    - mesh_path: path to the mesh file
+
+    OUTPUTS:
+    - vertices: 2D numpy array of shape (n_vertices, 3)
+    - faces: 2D numpy array of vertex indices, shape (n_faces, 3)
+    '''
+
+    readers = {'.stl': read_stl, '.ply': read_ply, '.vtp': read_vtp, '.npz': read_npz}
+    ext = os.path.splitext(mesh_path)[1].lower()
+    if ext not in readers:
+        raise ValueError(f'Unsupported mesh format: {mesh_path}')
+    return readers[ext](mesh_path)
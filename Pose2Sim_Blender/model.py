@@ -8,10 +8,10 @@
     ##################################################
     
     Reads an .osim model file, lists bodies and corresponding meshes
-    Searches the meshes on the computer, converts them to .stl if only defined as .vtp
+    Searches the meshes (stl, ply, vtp) on the computer and reads them without import operators
     Adds meshes and their parent bodies to the scene and scale them.
 
-    OpenSim API is not required.
+    Neither OpenSim API nor VTK is required.
     
     INPUTS: 
     - osim_path: path to the .osim model file
@@ -25,15 +25,26 @@
 
 ## INIT
 import bpy
-from xml.dom import minidom
 import os
-from Pose2Sim_Blender.Pose2Sim_Blender.common import createMaterial
+import sys
+import importlib.util
+import multiprocessing
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+from .common import createMaterial, set_object_material, mesh_from_arrays, shade_smooth
+from .mesh_readers import read_mesh, convert_mesh
+from .cache import USE_CACHE, geometry_cache_path, remove_stale_geometry
+from .osim_reader import read_osim
 try:
     import vtk
 except ImportError:
     pass
 
 COLOR = (0.8, 0.8, 0.8, 1)
+FILES_PER_WORKER = 8 # starting a process costs about as much as decoding a few files
+GEOMETRY_PATH = os.environ.get('POSE2SIM_BLENDER_GEOMETRY_PATH', '') # additional geometry directories, separated by os.pathsep
+MESH_EXTENSIONS = ('.stl', '.ply', '.vtp')
+MESH_LIBRARY = {} # mesh file path: mesh datablock, shared by all objects using this file
 
 
 ## AUTHORSHIP INFORMATION
@@ -75,19 +86,269 @@ def vtp2stl(vtp_path):
         print(f'{vtp_path} file converted')
 
 
-def import_model(osim_path, modelRoot='',stlRoot='.',collection='', color = COLOR):
+def search_directories(modelRoot, stlRoot='.', geometry_paths=''):
+    '''
+    List the directories where geometry files are searched, by order of priority.
+    Directories that do not exist are left out.
+
+    INPUTS:
+    - modelRoot: directory of the .osim file
+    - stlRoot: directory of the geometry files shipped with Pose2Sim_Blender
+    - geometry_paths: additional directories, separated by os.pathsep (add-on preference)
+      Directories from the POSE2SIM_BLENDER_GEOMETRY_PATH environment variable are added as well
+
+    OUTPUT:
+    - directories: list of existing directories
+    '''
+
+    directories = [os.path.join(modelRoot,'Geometry'), stlRoot]
+    directories += [d for d in geometry_paths.split(os.pathsep) + GEOMETRY_PATH.split(os.pathsep) if d.strip()]
+    # OpenSim installs only exist on Windows
+    if sys.platform == 'win32':
+        directories.append('C:\\OpenSim 4.5\\Geometry')
+        try:
+            import opensim as osim
+            directories.append(os.path.join('C:\\', f'OpenSim {osim.__version__[:3]}', 'Geometry'))
+        except ImportError:
+            pass
+
+    existing = []
+    for d in directories:
+        d = os.path.abspath(os.path.expanduser(d.strip()))
+        if d not in existing and os.path.isdir(d):
+            existing.append(d)
+    return existing
+
+
+def geometry_index(directories):
+    '''
+    List each directory once, and index the mesh files it contains.
+    Replaces checking the existence of each candidate file in each directory.
+
+    INPUT:
+    - directories: list of directories, by order of priority
+
+    OUTPUT:
+    - index: dict of normalized file name: (directory rank, path)
+      When a name is found in several directories, the first one wins
+    '''
+
+    index = {}
+    for rank, d in enumerate(directories):
+        try:
+            entries = list(os.scandir(d))
+        except OSError:
+            continue
+        for e in entries:
+            key = os.path.normcase(e.name)
+            if key.endswith(MESH_EXTENSIONS) and key not in index:
+                index[key] = (rank, e.path)
+    return index
+
+
+def resolve_mesh_file(filename_vtp, index, directories=()):
+    '''
+    Find a mesh file on the computer, as .stl, .vtp.ply, or .vtp.
+    In the first directory where one is found, .stl is preferred over .vtp.ply, and .vtp.ply over .vtp.
+
+    INPUTS:
+    - filename_vtp: mesh file name, as written in the .osim file
+    - index: geometry index (see geometry_index)
+    - directories: searched directories, for file names with a subdirectory
+
+    OUTPUT:
+    - mesh_file: path to the mesh file, or None if not found
+    '''
+
+    filename_stl=str.replace(filename_vtp,'.vtp','.stl')
+    filename_ply=str.replace(filename_vtp,'.vtp','.vtp.ply')
+    candidates = [filename_stl, filename_ply, filename_vtp]
+
+    found = [index[os.path.normcase(f)] for f in candidates if os.path.normcase(f) in index]
+    if found:
+        return min(found, key=lambda f: f[0])[1]
+    # file names with a subdirectory are not indexed
+    if os.path.dirname(filename_vtp):
+        for dir in directories:
+            for f in candidates:
+                if os.path.exists(os.path.join(dir, f)):
+                    return os.path.join(dir, f)
+
+    print(f'File {filename_stl} or {filename_ply} or {filename_vtp} not found on system')
+    return None
+
+
+@contextmanager
+def standalone_mesh_readers():
+    '''
+    Temporarily make mesh_readers importable as a top-level module, so that
+    worker processes can import it without importing the add-on (and bpy).
+    Spawned workers copy sys.path when they start, so the package directory
+    only needs to be on it while the process pool is alive.
+    It is then removed, so that other add-on modules never become top-level modules.
+    '''
+
+    package_dir = os.path.dirname(os.path.abspath(__file__))
+    added_path = package_dir not in sys.path
+    added_module = 'mesh_readers' not in sys.modules
+    if added_path:
+        sys.path.append(package_dir)
+    try:
+        if added_module:
+            spec = importlib.util.spec_from_file_location('mesh_readers', os.path.join(package_dir, 'mesh_readers.py'))
+            module = importlib.util.module_from_spec(spec)
+            sys.modules['mesh_readers'] = module
+            spec.loader.exec_module(module)
+        yield sys.modules['mesh_readers']
+    finally:
+        if added_module:
+            sys.modules.pop('mesh_readers', None)
+        if added_path and package_dir in sys.path:
+            sys.path.remove(package_dir)
+
+
+def convert_geometry(mesh_files, n_workers=None, use_cache=True):
+    '''
+    Decode .vtp files into the geometry cache, in parallel.
+    Files already in the cache (and not modified since) are not decoded again.
+
+    INPUTS:
+    - mesh_files: list of paths to mesh files. Only .vtp files are converted
+    - n_workers: maximum number of processes (default: number of cores)
+    - use_cache: if False, do nothing (default: True)
+
+    OUTPUT:
+    - cache_paths: dict of source path: decoded .npz path
+    '''
+
+    cache_paths, todo = {}, {}
+    if not (use_cache and USE_CACHE):
+        return cache_paths
+    for mesh_file in set(mesh_files):
+        if not mesh_file.endswith('.vtp'):
+            continue
+        try:
+            cache_path = geometry_cache_path(mesh_file)
+        except OSError:
+            continue
+        if os.path.isfile(cache_path):
+            cache_paths[mesh_file] = cache_path
+        else:
+            todo[mesh_file] = cache_path
+    if not todo:
+        return cache_paths
+
+    n_workers = min(-(-len(todo)//FILES_PER_WORKER), n_workers or os.cpu_count() or 1)
+    if n_workers > 1:
+        try:
+            with standalone_mesh_readers() as mesh_readers, \
+                 ProcessPoolExecutor(max_workers=n_workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+                worker = mesh_readers.convert_mesh
+                futures = {mesh_file: pool.submit(worker, mesh_file, cache_path) for mesh_file, cache_path in todo.items()}
+                for mesh_file, future in futures.items():
+                    try:
+                        future.result()
+                        cache_paths[mesh_file] = todo[mesh_file]
+                    except Exception as e:
+                        print(f'Could not convert {mesh_file}: {e}')
+        except Exception as e:
+            print(f'Could not start conversion processes ({e}), converting in Blender instead')
+    for mesh_file, cache_path in todo.items():
+        if mesh_file in cache_paths:
+            continue
+        try:
+            convert_mesh(mesh_file, cache_path)
+            cache_paths[mesh_file] = cache_path
+        except Exception as e:
+            print(f'Could not convert {mesh_file}: {e}')
+
+    for mesh_file in todo:
+        if mesh_file in cache_paths:
+            remove_stale_geometry(cache_paths[mesh_file])
+    print(f'{len(todo)} geometry files converted with {n_workers} process(es)')
+
+    return cache_paths
+
+
+def library_mesh(file_path):
+    '''
+    Mesh datablock previously read from file_path during this session, if it still exists
+
+    INPUT:
+    - file_path: resolved path of the mesh file
+
+    OUTPUT:
+    - mesh: bpy.types.Mesh, or None
+    '''
+
+    mesh = MESH_LIBRARY.get(os.path.normcase(os.path.abspath(file_path)))
+    if mesh is None:
+        return None
+    try:
+        mesh.name # raises ReferenceError if the mesh was deleted
+        return mesh
+    except ReferenceError:
+        del MESH_LIBRARY[os.path.normcase(os.path.abspath(file_path))]
+        return None
+
+
+def add_to_library(file_path, mesh):
+    '''
+    Store a mesh datablock read from file_path, so that it is only read once per session
+    '''
+
+    MESH_LIBRARY[os.path.normcase(os.path.abspath(file_path))] = mesh
+
+
+def load_mesh_file(mesh_file, cache_path=None):
+    '''
+    Create a mesh datablock from a .stl, .ply, or .vtp file.
+    Files are decoded with numpy, which is much faster than import operators.
+    Falls back to Blender operators if the file cannot be decoded.
+
+    INPUTS:
+    - mesh_file: path to the mesh file
+    - cache_path: optional path to its decoded version (see convert_geometry)
+
+    OUTPUT:
+    - mesh: bpy.types.Mesh
+    '''
+
+    mesh_name = os.path.basename(mesh_file).split('.')[0]
+    try:
+        vertices, faces = read_mesh(cache_path if cache_path else mesh_file)
+        return mesh_from_arrays(mesh_name, vertices, faces)
+    except Exception as e:
+        print(f'Could not read {mesh_file} ({e}), trying Blender importer instead')
+
+    bpy.ops.object.select_all(action='DESELECT')
+    if mesh_file.endswith('.ply'):
+        bpy.ops.wm.ply_import(filepath=mesh_file)
+    elif mesh_file.endswith('.vtp'):
+        vtp2stl(mesh_file)
+        bpy.ops.wm.stl_import(filepath=mesh_file.replace('.vtp','.stl'))
+    else:
+        bpy.ops.wm.stl_import(filepath=mesh_file)
+    selected_objects = [ o for o in bpy.context.scene.objects if o.select_get() ]
+    mesh = selected_objects[0].data
+    bpy.data.objects.remove(selected_objects[0])
+    
+    return mesh
+
+
+def import_model(osim_path, modelRoot='',stlRoot='.',collection='', color = COLOR, geometry_paths=''):
     '''osim_path
     Reads an .osim model file, lists bodies and corresponding meshes
-    Searches the meshes (stl, ply, vtp) on the computer, 
-    converts them to .stl if only defined as .vtp
+    Searches the meshes (stl, ply, vtp) on the computer and reads them
     Adds meshes and their parent bodies to the scene and scale them.
 
-    OpenSim API is not required.
+    Neither OpenSim API nor VTK is required.
     
     INPUTS: 
     - osim_path: path to the .osim model file
     - modelRoot, stlRoot: optional paths
     - collection: optional collection name
+    - geometry_paths: optional geometry directories, separated by os.pathsep
 
     OUTPUTS:
     - Imported .osim model
@@ -102,101 +363,62 @@ def import_model(osim_path, modelRoot='',stlRoot='.',collection='', color = COLO
     if modelRoot=='':
         modelRoot=os.path.dirname(osim_path)
     
-    geometry_directories = [os.path.join(modelRoot,'Geometry'), stlRoot, 'C:\\OpenSim 4.5\\Geometry']
-    try:
-        import opensim as osim
-        geometry_directories.append(os.path.join('C:\\', f'OpenSim {osim.__version__[:3]}', 'Geometry'))
-    except ImportError:
-        pass
+    geometry_directories = search_directories(modelRoot, stlRoot, geometry_paths)
+    index = geometry_index(geometry_directories)
     
-    xmldoc = minidom.parse(osim_path)
-    bodySet = xmldoc.getElementsByTagName('BodySet')[0]
-    bodies=bodySet.getElementsByTagName('Body')
+    model = read_osim(osim_path)
+
+    # find all mesh files first, and convert the .vtp ones in parallel
+    mesh_files = {}
+    for body in model['bodies']:
+        for mesh in body['meshes']:
+            if mesh['mesh_file'] not in mesh_files:
+                mesh_files[mesh['mesh_file']] = resolve_mesh_file(mesh['mesh_file'], index, geometry_directories)
+    cache_paths = convert_geometry([f for f in mesh_files.values() if f is not None and library_mesh(f) is None])
+
     obj = []
-    for i,body in enumerate(bodies): 
+    for i,body in enumerate(model['bodies']): 
         # add object to collection
-        bodyName=body.getAttribute('name')
-
-        try:
-            physicalOffset_translation = body.getElementsByTagName('components')[0].getElementsByTagName('PhysicalOffsetFrame')[0].getElementsByTagName('translation')[0].firstChild.nodeValue
-            physicalOffset_translation = [float(x) for x in physicalOffset_translation.split()]
-        except: 
-            physicalOffset_translation = [0., 0., 0.]
-        
+        bodyName=body['name']
         obj += [bpy.data.objects.new(bodyName,None)]
         collection.objects.link(obj[i])
     
         # an object can be composed of several meshes
         print('\nImporting ',bodyName)
-        meshes=body.getElementsByTagName('Mesh')  
-        for mesh in meshes:
-            # import mesh file
-            files=mesh.getElementsByTagName('mesh_file')
-            # print([file.firstChild.nodeValue for file in files])
-            scaleFactorElems=mesh.getElementsByTagName('scale_factors')
-            scaleFactorStr=scaleFactorElems[0].firstChild.nodeValue
-            scaleFactor=[float(x) for x in scaleFactorStr.split()]
-            file=files[0]
-            filename_vtp=file.firstChild.nodeValue
-            filename_stl=str.replace(filename_vtp,'.vtp','.stl')
-            filename_ply=str.replace(filename_vtp,'.vtp','.vtp.ply')
-            bpy.ops.object.select_all(action='DESELECT')
+        for mesh in body['meshes']:
+            mesh_file = mesh_files[mesh['mesh_file']]
+            if mesh_file is None:
+                continue
             
-            for dir in geometry_directories:
-                fullFile_stl = os.path.join(dir, filename_stl)
-                fullFile_ply = os.path.join(dir, filename_ply)
-                fullFile_vtp = os.path.join(dir, filename_vtp)
-                # print(f'{fullFile_ply} exists: {os.path.exists(fullFile_ply)}')
-                if os.path.exists(fullFile_stl):
-                    bpy.ops.wm.stl_import(filepath=fullFile_stl)
-                    # bpy.ops.import_mesh.stl(filepath=fullFile_stl)
-                    break
-                elif os.path.exists(fullFile_ply):
-                    bpy.ops.wm.ply_import(filepath=fullFile_ply)
-                    break
-                elif os.path.exists(fullFile_vtp):
-                    try:
-                        vtp2stl(fullFile_vtp)
-                        bpy.ops.wm.stl_import(filepath=fullFile_stl)
-                    except:
-                        print('VTK not installed on Blender. Try Pose2Sim_Blender Full install instead')
-                    break
-            else:
-                print(f'File {filename_stl} or {filename_ply} or {filename_vtp} not found on system')
-                # raise Exception(f'File {filename_stl} or {filename_ply} or {filename_vtp} not found on system')
+            # Read each mesh file once per session, then share its mesh data
+            mesh_data = library_mesh(mesh_file)
+            if mesh_data is None:
+                mesh_data = load_mesh_file(mesh_file, cache_paths.get(mesh_file))
+                add_to_library(mesh_file, mesh_data)
+                shade_smooth(mesh_data)
+            mesh_obj = bpy.data.objects.new(mesh_data.name, mesh_data)
             
             # Scale meshes
-            selected_objects = [ o for o in bpy.context.scene.objects if o.select_get() ]
-            mesh_obj=selected_objects[0]
-            mesh_obj.scale=scaleFactor
+            mesh_obj.scale=mesh['scale_factors']
             
             # Translation and rotation of PhysicalOffsetFrame if exists
-            translation_nodes = [node for node in mesh.parentNode.parentNode.childNodes if node.nodeName == "translation"]
-            if translation_nodes:
-                translation_text = translation_nodes[0].firstChild.nodeValue
-                mesh_obj.location = [float(t) for t in translation_text.split()]
-            rotation_nodes = [node for node in mesh.parentNode.parentNode.childNodes if node.nodeName == "orientation"]
-            if rotation_nodes:
-                rotation_text = rotation_nodes[0].firstChild.nodeValue
-                mesh_obj.rotation_euler = [float(t) for t in rotation_text.split()]
+            if mesh['translation'] is not None:
+                mesh_obj.location = mesh['translation']
+            if mesh['orientation'] is not None:
+                mesh_obj.rotation_euler = mesh['orientation']
         
             # Parent meshes to object in collection
             mesh_obj.parent=obj[i]
-            mesh_obj.users_collection[0].objects.unlink(mesh_obj)
             collection.objects.link(mesh_obj)
 
-    # hide axes, add material, add smooth shading
-    objects = collection.objects
-    for obj in objects:
-        matg = createMaterial(color=COLOR, metallic = 0., roughness = 0.5)
-        obj.active_material = matg
-        for mesh in obj.children:
-            for polygon in mesh.data.polygons:
-                polygon.use_smooth = True
-    for obj in objects:
-        obj.select_set(obj.type == "EMPTY")
-    empties = bpy.context.selected_objects
-    [empt.hide_set(True) for empt in empties]
+    # hide axes, add material (smooth shading is set once per mesh file, when read)
+    # the material is linked to objects, since meshes are shared with other models
+    matg = createMaterial(color=color, metallic = 0., roughness = 0.5)
+    for obj in collection.objects:
+        if obj.type == 'EMPTY':
+            obj.hide_set(True)
+        else:
+            set_object_material(obj, matg)
     
     bpy.context.view_layer.active_layer_collection = bpy.context.view_layer.layer_collection.children[collection.name]
     
@@ -11,10 +11,10 @@
     from a .mot motion file (joint angles) and a .osim model file,
     saves to a .csv file (body positions and orientations).
     Animates a previously loaded .osim model.
-    Requires OpenSim API to be installed in Blender (see Readme.md).
+    Body positions are computed with the built-in kinematics engine,
+    or with OpenSim API if use_opensim is True (see Readme.md).
 
-    Can also import the resulting csv file,
-    in which case OpenSim API is not required.
+    Can also import the resulting csv file.
     
     INPUTS: 
     - mot_path: path to a .mot motion file (joint angles) 
@@ -32,10 +32,13 @@
 import os
 import numpy as np
 import bpy
-from .common import ShowMessageBox
+from .common import ShowMessageBox, bulk_keyframe_insert, mat_to_euler
+from .cache import cached_load
+from .kinematics import read_osim_kinematics, coordinates_from_motion, forward_kinematics
 
 direction = 'zup'
 export_to_csv = True
+H_ZUP = np.array([[1,0,0,0], [0,0,-1,0], [0,1,0,0], [0,0,0,1]])
 
 
 ## AUTHORSHIP INFORMATION
@@ -50,22 +53,188 @@ __status__ = "Development"
 
 
 ## FUNCTIONS
-def apply_mot_to_model(mot_path, osim_path, direction='zup', target_framerate='auto'):
+def load_mot(mot_path, use_cache=True):
+    '''
+    Retrieve data and header from .mot motion file
+    OpenSim API is not required.
+    Parsed data is cached for faster loading next time.
+
+    INPUT:
+    - mot_path: path to the .mot file
+    - use_cache: read from and write to the cache (default: True)
+
+    OUTPUTS:
+    - times: 1D numpy array of time stamps
+    - motion_data_np: 2D numpy array with coordinates at each time step (without time column)
+    - coordinateNames: list of coordinate names
+    - in_degrees: True if rotational coordinates are in degrees
+    '''
+
+    return cached_load(mot_path, parse_mot, tag='mot', use_cache=use_cache)
+
+
+def parse_mot(mot_path):
+    '''
+    Parse .mot motion text file. Use load_mot instead, which caches the result.
+    '''
+
+    # read header
+    in_degrees = False
+    with open(mot_path) as f:
+        for i, line in enumerate(f):
+            if line.strip().lower().startswith('indegrees'):
+                in_degrees = line.split('=')[-1].strip().lower() == 'yes'
+            if line.strip().lower() == 'endheader':
+                break
+        mot_header = f.readline().split()
+    skiprows = i+2
+
+    # read data
+    mot_data_np = np.loadtxt(mot_path, skiprows=skiprows, ndmin=2)
+    times = mot_data_np[:,0]
+    
+    return times, mot_data_np[:,1:], mot_header[1:], in_degrees
+
+
+def load_body_csv(csv_path, use_cache=True):
+    '''
+    Retrieve body positions and orientations from a .csv file
+    previously exported by apply_mot_to_model.
+    Parsed data is cached for faster loading next time.
+
+    INPUT:
+    - csv_path: path to the .csv file
+    - use_cache: read from and write to the cache (default: True)
+
+    OUTPUTS:
+    - loc_rot_frame_all_np: 2D numpy array with times, and body locations and rotations at each time step
+    - bodyNames: list of body names
+    '''
+
+    return cached_load(csv_path, parse_body_csv, tag='csv', use_cache=use_cache)
+
+
+def parse_body_csv(csv_path):
+    '''
+    Parse .csv body text file. Use load_body_csv instead, which caches the result.
+    '''
+
+    loc_rot_frame_all_np = np.loadtxt(csv_path, delimiter=",", dtype=float, skiprows=1)
+    with open(csv_path) as f:
+        csv_header = f.readline()
+    bodyNames = csv_header.split(',')[1::6]
+    bodyNames = [b[1:-2] for b in bodyNames]
+
+    return loc_rot_frame_all_np, bodyNames
+
+
+def get_body_transforms(model, motion_data_np, coordinateNames, frame_indices):
+    '''
+    OpenSim stage: set the model state at each selected frame,
+    and collect the transforms of all bodies in ground.
+    Requires OpenSim API.
+
+    INPUTS:
+    - model: OpenSim model
+    - motion_data_np: 2D numpy array of coordinates (radians and meters), shape (n_times, n_coordinates)
+    - coordinateNames: list of coordinate names (columns of motion_data_np)
+    - frame_indices: rows of motion_data_np to process
+
+    OUTPUTS:
+    - H_all: array of homogeneous transforms, shape (n_frames, n_bodies, 4, 4)
+    '''
+
+    model_coordSet = model.getCoordinateSet()
+    model_bodySet = model.getBodySet()
+    bodies = [model_bodySet.get(i) for i in range(model_bodySet.getSize())]
+    coordinates = []
+    for c, coord in enumerate(coordinateNames):
+        try:
+            coordinates.append((c, model_coordSet.get(coord)))
+        except:
+            pass
+
+    state = model.initSystem()
+    H_all = np.zeros((len(frame_indices), len(bodies), 4, 4))
+    H_all[:,:,3,3] = 1
+    for f, n in enumerate(frame_indices):
+        # set model struct in each time state
+        for c, coordinate in coordinates:
+            coordinate.setValue(state, motion_data_np[n,c], enforceContraints=False)
+        # model.assemble(state)
+        model.realizePosition(state) # much faster (IK already done, no need to compute it again)
+
+        # use state of model to get body coordinates in ground
+        for b, body in enumerate(bodies):
+            H_swig = body.getTransformInGround(state)
+            R_swig = H_swig.R()
+            H_all[f,b,:3,:3] = [[R_swig.get(i,j) for j in range(3)] for i in range(3)]
+            H_all[f,b,:3,3] = H_swig.T().to_numpy()
+
+    return H_all
+
+
+def transforms_to_loc_rot(H_all, direction='zup'):
+    '''
+    Vectorized stage: convert body transforms to locations and Euler angles,
+    for all frames and bodies at once.
+
+    INPUTS:
+    - H_all: array of homogeneous transforms, shape (n_frames, n_bodies, 4, 4)
+    - direction: 'zup' or 'yup' (default: 'zup')
+
+    OUTPUTS:
+    - loc_rot: array of [loc_x, loc_y, loc_z, rot_x, rot_y, rot_z], shape (n_frames, n_bodies, 6)
+    '''
+
+    # y-up to z-up
+    if direction=='zup':
+        H_all = H_ZUP @ H_all
+    loc = H_all[...,:3,3]
+    rot = mat_to_euler(H_all[...,:3,:3])
+
+    return np.concatenate([loc, rot], axis=-1)
+
+
+def animate_bodies(collection, bodyNames, loc_rot, frames):
+    '''
+    Write location and rotation keyframes of all bodies in bulk.
+
+    INPUTS:
+    - collection: collection of the previously loaded model
+    - bodyNames: list of body names
+    - loc_rot: array of locations and Euler angles, shape (n_frames, n_bodies, 6)
+    - frames: frame numbers, shape (n_frames,)
+
+    OUTPUTS:
+    - Animated bodies
+    '''
+
+    for i, b in enumerate(bodyNames):
+        b_iterated = [o.name for o in collection.objects if o.name.startswith(b)][0]
+        obj = collection.objects[b_iterated]
+        bulk_keyframe_insert(obj, 'location', frames, loc_rot[:,i,:3], group='Object Transforms')
+        bulk_keyframe_insert(obj, 'rotation_euler', frames, loc_rot[:,i,3:], group='Object Transforms')
+
+
+def apply_mot_to_model(mot_path, osim_path, direction='zup', target_framerate='auto', use_opensim=False):
     '''
     Computes the coordinates of each opensim bodies in the ground plane
     from a .mot motion file (joint angles) and a .osim model file,
     saves to a .csv file (body positions and orientations).
     Animates a previously loaded .osim model.
-    Requires OpenSim API to be installed in Blender (see Readme.md).
+    OpenSim API is not required, unless use_opensim is True (see Readme.md).
 
-    Can also import the resulting csv file,
-    in which case OpenSim API is not required.
+    Can also import the resulting csv file.
 
     INPUTS: 
     - mot_path: path to a .mot motion file (joint angles) 
                 or to a .csv file (body positions and orientations)
     - osim_path: path to the .osim model file
     - direction: 'zup' or 'yup' (default: 'zup')
+    - target_framerate: 'auto' or framerate of the animation
+    - use_opensim: compute body positions with OpenSim API instead of the built-in kinematics engine.
+      OpenSim API is also used, if installed, for models the built-in engine does not support
 
     OUTPUTS:
     - mot_path.csv (file with body positions and orientations)
@@ -78,8 +247,18 @@ def apply_mot_to_model(mot_path, osim_path, direction='zup', target_framerate='a
         ShowMessageBox("First select a model in the outliner", "No OpenSim model found")
         raise('First select a model in the outliner.')
     
-    # If chosen file is .mot (joint angles)
-    if os.path.splitext(mot_path)[1] == '.mot':
+    def with_opensim(error):
+        # model not supported by the built-in kinematics engine: use OpenSim API if it is installed
+        try:
+            import opensim
+        except ImportError:
+            ShowMessageBox(f"{error} OpenSim API required: Please proceed to Pose2Sim_Blender full install", "Model not supported")
+            raise error
+        print(f'{error} Using OpenSim API instead.')
+        return apply_mot_to_model(mot_path, osim_path, direction=direction, target_framerate=target_framerate, use_opensim=True)
+
+    # If chosen file is .mot (joint angles), with OpenSim API
+    if os.path.splitext(mot_path)[1] == '.mot' and use_opensim:
         # read model and motion files
         try:
             import opensim as osim
@@ -122,67 +301,48 @@ def apply_mot_to_model(mot_path, osim_path, direction='zup', target_framerate='a
             except:
                 pass
         
+        # body transforms
+        frame_indices = range(0, len(times), conv_fac_frame_rate)
+        H_all = get_body_transforms(model, motion_data_np, coordinateNames, frame_indices)
+
+    # If chosen file is .mot (joint angles), with built-in kinematics
+    elif os.path.splitext(mot_path)[1] == '.mot':
+        # read model and motion files
+        try:
+            model_kin = read_osim_kinematics(osim_path)
+        except ValueError as e:
+            return with_opensim(e)
+        times, motion_data_np, coordinateNames, in_degrees = load_mot(mot_path)
+        bodyNames = model_kin['bodyNames']
+
+        # set framerate
+        fps = round((len(times)-1) / (times[-1] - times[0]))
+        first_frame = round(times[0]*fps)
+        if target_framerate == 'auto':
+            target_framerate = fps
+        target_framerate = round(int(target_framerate))
+        bpy.context.scene.render.fps = target_framerate
+        conv_fac_frame_rate = fps // target_framerate
+        if conv_fac_frame_rate == 0:
+            conv_fac_frame_rate = 1
+
+        # body transforms, all frames at once
+        frame_indices = range(0, len(times), conv_fac_frame_rate)
+        try:
+            q = coordinates_from_motion(model_kin, motion_data_np[frame_indices], coordinateNames, in_degrees=in_degrees)
+        except ValueError as e:
+            return with_opensim(e)
+        H_all = forward_kinematics(model_kin, q)
+
+    if os.path.splitext(mot_path)[1] == '.mot':
         # animate model
-        state = model.initSystem()
-        loc_rot_frame_all = []
-        # H_zup = np.array([[0,0,1,0], [1,0,0,0], [0,1,0,0], [0,0,0,1]])
-        H_zup = np.array([[1,0,0,0], [0,0,-1,0], [0,1,0,0], [0,0,0,1]])
-        
-        # print('Time frame:')
-        for n in range(0, len(times), conv_fac_frame_rate):
-            # print(times[n], 's')
-            # set model struct in each time state
-            for c, coord in enumerate(coordinateNames): ## PROBLEME QUAND HEADERS DE MOTION_DATA_NP ET COORDINATENAMES SONT PAS DANS LE MEME ORDRE
-                try:
-                    model.getCoordinateSet().get(coord).setValue(state, motion_data_np[n,c], enforceContraints=False)
-                except:
-                    pass
-            # model.assemble(state)
-            model.realizePosition(state) # much faster (IK already done, no need to compute it again)
-            
-            # use state of model to get body coordinates in ground
-            loc_rot_frame = []
-            for b in bodies:
-                H_swig = b.getTransformInGround(state)
-                T = H_swig.T().to_numpy()
-                R_swig = H_swig.R()
-                R = np.array([[R_swig.get(0,0), R_swig.get(0,1), R_swig.get(0,2)],
-                    [R_swig.get(1,0), R_swig.get(1,1), R_swig.get(1,2)],
-                    [R_swig.get(2,0), R_swig.get(2,1), R_swig.get(2,2)]])
-                H = np.block([ [R,T.reshape(3,1)], [np.zeros(3), 1] ])
-                
-                # y-up to z-up
-                if direction=='zup':
-                    H = H_zup @ H
-                
-                # convert matrix to loc and rot, and export to csv
-                if export_to_csv:
-                    loc_x, loc_y, loc_z = H[0:3,3]
-                    R_mat = H[0:3,0:3]
-                    sy = np.sqrt(R_mat[1,0]**2 +  R_mat[0,0]**2) # singularity when y angle is +/- pi/2
-                    if sy>1e-6:
-                        rot_x = np.arctan2(R_mat[2,1], R_mat[2,2])
-                        rot_y = np.arctan2(-R_mat[2,0], sy)
-                        rot_z = np.arctan2(R_mat[1,0], R_mat[0,0])
-                    else: # to be verified
-                        rot_x = np.arctan2(-R_mat[1,2], R_mat[1,1])
-                        rot_y = np.arctan2(-R[2,0], sy)
-                        rot_z = 0
-                    loc_rot_frame.extend([loc_x, loc_y, loc_z, rot_x, rot_y, rot_z])
-            
-                # set coordinates of blender bodies to this state
-                b_iterated = [o.name for o in collection.objects if o.name.startswith(b.getName())][0]
-                obj=collection.objects[b_iterated]
-                obj.matrix_world = H.T
-                obj.keyframe_insert('location',frame=first_frame+round(n/conv_fac_frame_rate))
-                obj.keyframe_insert('rotation_euler',frame=first_frame+round(n/conv_fac_frame_rate))
-            
-            if export_to_csv:
-                loc_rot_frame_all.append(loc_rot_frame)
+        loc_rot = transforms_to_loc_rot(H_all, direction=direction)
+        frames = first_frame + np.arange(len(frame_indices))
+        animate_bodies(collection, bodyNames, loc_rot, frames)
 
         # export to csv
         if export_to_csv:
-            loc_rot_frame_all_np = np.array(loc_rot_frame_all)
+            loc_rot_frame_all_np = loc_rot.reshape(len(frame_indices), -1)
             loc_rot_frame_all_np = np.insert(loc_rot_frame_all_np, 0, times[::conv_fac_frame_rate], axis=1) # insert time column
             bodyHeader = 'times, ' + ''.join([f'{b}_x, {b}_y, {b}_z, {b}_rotx, {b}_roty, {b}_rotz, ' for b in bodyNames])[:-2]
             np.savetxt(os.path.splitext(mot_path)[0]+'.csv', loc_rot_frame_all_np, delimiter=',', header=bodyHeader)
@@ -191,11 +351,7 @@ def apply_mot_to_model(mot_path, osim_path, direction='zup', target_framerate='a
     # If chosen file is .csv (body positions and rotations)
     elif os.path.splitext(mot_path)[1] == '.csv':
         # read csv motion file
-        loc_rot_frame_all_np = np.loadtxt(mot_path, delimiter=",", dtype=float, skiprows=1)
-        with open(mot_path) as f:
-            csv_header = f.readline()
-        bodyNames = csv_header.split(',')[1::6]
-        bodyNames = [b[1:-2] for b in bodyNames]
+        loc_rot_frame_all_np, bodyNames = load_body_csv(mot_path)
 
         # set framerate
         times = loc_rot_frame_all_np[:,0]
@@ -210,20 +366,8 @@ def apply_mot_to_model(mot_path, osim_path, direction='zup', target_framerate='a
             conv_fac_frame_rate = 1
         
         # animate model
-        for n in range(0, len(times), conv_fac_frame_rate):
-            for i, b in enumerate(bodyNames):
-                loc_x = loc_rot_frame_all_np[n,6*i+1]
-                loc_y = loc_rot_frame_all_np[n,6*i+2]
-                loc_z = loc_rot_frame_all_np[n,6*i+3]
-                rot_x = loc_rot_frame_all_np[n,6*i+4]
-                rot_y = loc_rot_frame_all_np[n,6*i+5]
-                rot_z = loc_rot_frame_all_np[n,6*i+6]
-
-                b_nameiterated = [o.name for o in collection.objects if o.name.startswith(b)][0]
-                obj=collection.objects[b_nameiterated]
-                obj.location=loc_x,loc_y,loc_z
-                obj.rotation_euler=rot_x,rot_y,rot_z
-                obj.keyframe_insert('location',frame=first_frame+round(n/conv_fac_frame_rate)+1)
-                obj.keyframe_insert('rotation_euler',frame=first_frame+round(n/conv_fac_frame_rate)+1)
+        loc_rot = loc_rot_frame_all_np[::conv_fac_frame_rate, 1:1+6*len(bodyNames)].reshape(-1, len(bodyNames), 6)
+        frames = first_frame + np.arange(len(loc_rot)) + 1
+        animate_bodies(collection, bodyNames, loc_rot, frames)
 
     print(f'OpenSim motion imported from {mot_path}')
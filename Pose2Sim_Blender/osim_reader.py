@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+'''
+    ##################################################
+    ## STREAMING READER FOR OPENSIM .OSIM FILES     ##
+    ##################################################
+
+    Reads an .osim model file into a compact description of the model,
+    shared by model import (bodies and meshes) and kinematics (joints and constraints).
+
+    The file is streamed with xml.etree.ElementTree.iterparse: only BodySet, JointSet,
+    and ConstraintSet are kept, while ForceSet (muscles), MarkerSet, etc are discarded
+    as they are read. Descriptions are kept in memory until the file is modified.
+    Neither OpenSim API nor Blender is required.
+
+    INPUTS:
+    - osim_path: path to the .osim model file
+
+    OUTPUTS:
+    - model: dict with the model name, bodies with their meshes,
+    and the XML elements of joints and constraints
+'''
+
+
+## INIT
+import os
+import xml.etree.ElementTree as ET
+
+KEPT_SETS = ('BodySet', 'JointSet', 'ConstraintSet')
+OSIM_MODELS = {} # (path, size, modification time): model description
+
+
+## AUTHORSHIP INFORMATION
+__author__ = "David Pagnon"
+__copyright__ = "Copyright 2023, Pose2Sim_Blender"
+__credits__ = ["David Pagnon"]
+__license__ = "MIT License"
+__version__ = "0.7.0"
+__maintainer__ = "David Pagnon"
+__email__ = "contact@david-pagnon.com"
+__status__ = "Development"
+
+
+## FUNCTIONS
+def element_floats(node, tag, default=None):
+    '''
+    Numeric values of the first direct child of an element with this tag
+    '''
+
+    child = node.find(tag)
+    if child is None or not (child.text or '').strip():
+        return default
+    return [float(x) for x in child.text.split()]
+
+
+def parse_mesh(mesh, frame):
+    '''
+    Parse a Mesh element of a body
+
+    INPUTS:
+    - mesh: Mesh element
+    - frame: element the mesh is attached to (Body or PhysicalOffsetFrame)
+
+    OUTPUT:
+    - dict with mesh file name, scale factors, and offset in the body
+      (translation and orientation are None if the mesh is attached to the body itself)
+    '''
+
+    return {'mesh_file': (mesh.findtext('mesh_file') or '').strip(),
+            'scale_factors': element_floats(mesh, 'scale_factors', [1., 1., 1.]),
+            'translation': element_floats(frame, 'translation'),
+            'orientation': element_floats(frame, 'orientation')}
+
+
+def parse_body(body):
+    '''
+    Parse a Body element
+
+    INPUT:
+    - body: Body element
+
+    OUTPUT:
+    - dict with body name and list of meshes (see parse_mesh)
+    '''
+
+    meshes = []
+    for frame in body.iter():
+        for geometry in frame.findall('attached_geometry'):
+            meshes += [parse_mesh(mesh, frame) for mesh in geometry.findall('Mesh') if mesh.findtext('mesh_file')]
+
+    return {'name': body.get('name'), 'meshes': meshes}
+
+
+def stream_osim(osim_path, kept_sets=KEPT_SETS):
+    '''
+    Stream an .osim file and only keep some of the sets of the model.
+    Elements of the other sets are discarded as soon as they are read.
+
+    INPUTS:
+    - osim_path: path to the .osim model file
+    - kept_sets: tags of the sets to keep
+
+    OUTPUTS:
+    - model_name: name of the model
+    - sets: dict of set tag: set element
+    '''
+
+    model_name, sets = '', {}
+    ancestors = [] # open elements, from the root
+    kept_depth = None # depth of the kept set being read
+    for event, elem in ET.iterparse(osim_path, events=('start', 'end')):
+        if event == 'start':
+            if elem.tag == 'Model' and not model_name:
+                model_name = elem.get('name', '')
+            if kept_depth is None and elem.tag in kept_sets and ancestors and ancestors[-1].tag == 'Model':
+                kept_depth = len(ancestors)
+                sets[elem.tag] = elem
+            ancestors.append(elem)
+            continue
+
+        ancestors.pop()
+        if kept_depth is not None:
+            if len(ancestors) == kept_depth: # end of the kept set
+                kept_depth = None
+                ancestors[-1].remove(elem)
+        elif ancestors:
+            ancestors[-1].remove(elem)
+
+    return model_name, sets
+
+
+def read_osim(osim_path):
+    '''
+    Read the bodies, meshes, joints, and constraints of an .osim model file.
+    The description is reused as long as the file is not modified.
+
+    INPUT:
+    - osim_path: path to the .osim model file
+
+    OUTPUT:
+    - model: dict with
+      - name: model name
+      - bodies: list of bodies (see parse_body)
+      - joints: list of joint elements (CustomJoint, WeldJoint, etc)
+      - constraints: list of constraint elements (CoordinateCouplerConstraint, etc)
+    '''
+
+    osim_path = os.path.abspath(osim_path)
+    stat = os.stat(osim_path)
+    key = (osim_path, stat.st_size, stat.st_mtime_ns)
+    if key in OSIM_MODELS:
+        return OSIM_MODELS[key]
+
+    model_name, sets = stream_osim(osim_path)
+    set_objects = lambda tag: list(sets[tag].find('objects')) if tag in sets and sets[tag].find('objects') is not None else []
+    model = {'name': model_name,
+             'bodies': [parse_body(b) for b in set_objects('BodySet') if b.tag == 'Body'],
+             'joints': set_objects('JointSet'),
+             'constraints': set_objects('ConstraintSet')}
+
+    for k in [k for k in OSIM_MODELS if k[0] == osim_path]:
+        del OSIM_MODELS[k]
+    OSIM_MODELS[key] = model
+
+    return model
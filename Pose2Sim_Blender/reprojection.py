@@ -0,0 +1,376 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+'''
+    ##################################################
+    ## BATCH REPROJECTION OF 3D MARKERS             ##
+    ##################################################
+
+    Projects all markers of all frames into all cameras at once,
+    with the pinhole model and OpenCV distortions (k1, k2, p1, p2[, k3[, k4, k5, k6]]).
+    Static and moving cameras (one calibration per frame) can be mixed.
+
+    When 2D detections are given (OpenPose-like json files, as written by Pose2Sim),
+    reprojection errors are computed for each camera, marker, and frame,
+    and summarized as statistics and as a heatmap of errors over time.
+    Without detections, the fraction of frames where each marker
+    is seen in front of the camera and within the image is reported instead.
+
+    Neither OpenCV nor Blender is required.
+
+    INPUTS:
+    - points: 3D marker coordinates (n_frames, n_markers, 3), in the calibration frame
+    - K, R, T, D: intrinsics, rotations, translations, distortions of each camera
+
+    OUTPUTS:
+    - uv: 2D coordinates (n_cams, n_frames, n_markers, 2), NaN behind the cameras
+    - errors, statistics, heatmap
+'''
+
+
+## INIT
+import os
+import json
+import warnings
+import numpy as np
+
+N_DISTORTIONS = 8 # k1, k2, p1, p2, k3, k4, k5, k6
+MIN_CONFIDENCE = 0.3
+HEATMAP_BIN = 10 # frames per heatmap column
+
+
+## AUTHORSHIP INFORMATION
+__author__ = "David Pagnon"
+__copyright__ = "Copyright 2023, Pose2Sim_Blender"
+__credits__ = ["David Pagnon"]
+__license__ = "MIT License"
+__version__ = "0.7.0"
+__maintainer__ = "David Pagnon"
+__email__ = "contact@david-pagnon.com"
+__status__ = "Development"
+
+
+## FUNCTIONS
+def trc_to_calib(marker_locs):
+    '''
+    Pose2Sim writes y-up .trc files from z-up calibrations:
+    bring trc coordinates back to the calibration frame
+
+    INPUT:
+    - marker_locs: array of shape (..., 3), as read in the .trc file
+
+    OUTPUT:
+    - points: array of shape (..., 3), in the calibration frame
+    '''
+
+    return np.asarray(marker_locs, dtype=float)[...,[2,0,1]]
+
+
+def stack_calibrations(K, R, T, D, n_frames):
+    '''
+    Stack the calibrations of all cameras into arrays with a frame axis.
+    Static cameras keep a frame axis of length 1, which is broadcast when projecting.
+    Moving cameras with fewer calibrated frames than n_frames keep their last calibration.
+
+    INPUTS:
+    - K, R, T, D: lists (one item per camera) of intrinsics (3,3) or (n,3,3),
+      rotation matrices (3,3) or (n,3,3), translations (3,) or (n,3),
+      and distortions (4 to 8 coefficients)
+    - n_frames: number of frames to project
+
+    OUTPUTS:
+    - K, R, T: arrays of shape (n_cams, 1 or n_frames, 3, 3) and (n_cams, 1 or n_frames, 3)
+    - D: array of shape (n_cams, 8)
+    '''
+
+    def frame_axis(arrays, ndim):
+        arrays = [np.asarray(a, dtype=float).reshape((-1,)+np.shape(a)[-ndim:]) for a in arrays]
+        if all(len(a) == 1 for a in arrays):
+            return np.stack(arrays)
+        arrays = [a[np.minimum(np.arange(n_frames), len(a)-1)] for a in arrays]
+        return np.stack(arrays)
+
+    D_stack = np.zeros((len(D), N_DISTORTIONS))
+    for c, d in enumerate(D):
+        d = np.ravel(d)[:N_DISTORTIONS]
+        D_stack[c,:len(d)] = d
+
+    return frame_axis(K, 2), frame_axis(R, 2), frame_axis(T, 1), D_stack
+
+
+def distort(xy, D):
+    '''
+    Apply OpenCV radial and tangential distortions to normalized image coordinates
+
+    INPUTS:
+    - xy: array of shape (n_cams, ..., 2)
+    - D: array of shape (n_cams, 8)
+
+    OUTPUT:
+    - xy_distorted: array of shape (n_cams, ..., 2)
+    '''
+
+    D = D.reshape((len(D),) + (1,)*(xy.ndim-2) + (N_DISTORTIONS,))
+    k1, k2, p1, p2, k3, k4, k5, k6 = np.moveaxis(D, -1, 0)
+    x, y = xy[...,0], xy[...,1]
+    r2 = x*x + y*y
+    radial = (1 + r2*(k1 + r2*(k2 + r2*k3))) / (1 + r2*(k4 + r2*(k5 + r2*k6)))
+    xd = x*radial + 2*p1*x*y + p2*(r2 + 2*x*x)
+    yd = y*radial + p1*(r2 + 2*y*y) + 2*p2*x*y
+
+    return np.stack([xd, yd], axis=-1)
+
+
+def project_points(points, K, R, T, D=None):
+    '''
+    Project all markers of all frames into all cameras at once
+
+    INPUTS:
+    - points: array of shape (n_frames, n_markers, 3), in the calibration frame
+    - K, R, T: arrays of shape (n_cams, 1 or n_frames, 3, 3) and (n_cams, 1 or n_frames, 3),
+      see stack_calibrations
+    - D: array of shape (n_cams, 8), or None to ignore distortions
+
+    OUTPUTS:
+    - uv: array of shape (n_cams, n_frames, n_markers, 2). NaN if the point is missing or behind the camera
+    - depth: array of shape (n_cams, n_frames, n_markers), distance along the optical axis
+    '''
+
+    points = np.asarray(points, dtype=float)
+    n_cams, n_frames = len(K), len(points)
+    R = np.broadcast_to(R, (n_cams, n_frames, 3, 3))
+    T = np.broadcast_to(T, (n_cams, n_frames, 3))
+    K = np.broadcast_to(K, (n_cams, n_frames, 3, 3))
+
+    points_cam = np.einsum('cfij,fmj->cfmi', R, points) + T[:,:,None,:]
+    depth = points_cam[...,2]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        xy = points_cam[...,:2] / depth[...,None]
+    if D is not None and np.any(D):
+        xy = distort(xy, np.asarray(D, dtype=float))
+    uv = np.einsum('cfij,cfmj->cfmi', K[...,:2,:2], xy) + K[:,:,None,:2,2]
+    uv[~(depth > 0)] = np.nan
+
+    return uv, depth
+
+
+def visibility(uv, image_sizes):
+    '''
+    Whether projected points fall within the images
+
+    INPUTS:
+    - uv: array of shape (n_cams, n_frames, n_markers, 2)
+    - image_sizes: array of shape (n_cams, 2), width and height of each image
+
+    OUTPUT:
+    - visible: boolean array of shape (n_cams, n_frames, n_markers)
+    '''
+
+    size = np.asarray(image_sizes, dtype=float)[:,None,None,:]
+    with np.errstate(invalid='ignore'):
+        return np.all((uv >= 0) & (uv < size), axis=-1)
+
+
+def read_json_detections(json_dir):
+    '''
+    Read the 2D keypoints of all persons in a folder of OpenPose-like json files,
+    one file per frame, in alphabetical order
+
+    INPUT:
+    - json_dir: folder of json files
+
+    OUTPUT:
+    - detections: list (one item per frame) of arrays of shape (n_persons, n_keypoints, 3): x, y, confidence
+    '''
+
+    json_files = sorted(f for f in os.listdir(json_dir) if f.endswith('.json'))
+    detections = []
+    for json_file in json_files:
+        with open(os.path.join(json_dir, json_file)) as f:
+            people = json.load(f).get('people', [])
+        keypoints = [np.asarray(p['pose_keypoints_2d'], dtype=float).reshape(-1, 3) for p in people if p.get('pose_keypoints_2d')]
+        n_keypoints = max([len(k) for k in keypoints], default=0)
+        persons = np.full((len(keypoints), n_keypoints, 3), np.nan)
+        for p, k in enumerate(keypoints):
+            persons[p,:len(k)] = k
+        detections.append(persons)
+
+    return detections
+
+
+def match_detections(uv_cam, detections, keypoint_ids, min_confidence=MIN_CONFIDENCE, first_frame=0):
+    '''
+    Pick the detected person closest to the reprojected markers on each frame,
+    and arrange their keypoints like the markers
+
+    INPUTS:
+    - uv_cam: array of shape (n_frames, n_markers, 2), reprojected markers in one camera
+    - detections: list of arrays of shape (n_persons, n_keypoints, 3), see read_json_detections
+    - keypoint_ids: keypoint index of each marker (None or -1 if the marker is not detected)
+    - min_confidence: keypoints with a lower confidence are ignored
+    - first_frame: index of the detection of the first frame
+
+    OUTPUT:
+    - xy: array of shape (n_frames, n_markers, 2), NaN where there is no detection
+    '''
+
+    n_frames, n_markers = uv_cam.shape[:2]
+    ids = np.array([-1 if i is None else i for i in keypoint_ids], dtype=int)
+    xy = np.full((n_frames, n_markers, 2), np.nan)
+    for f in range(min(n_frames, len(detections) - first_frame)):
+        persons = detections[first_frame + f]
+        detected = (ids >= 0) & (ids < persons.shape[1])
+        if len(persons) == 0 or not detected.any():
+            continue
+        kpts = np.full((len(persons), n_markers, 3), np.nan)
+        kpts[:,detected] = persons[:,ids[detected]]
+        kpts[kpts[...,2] < min_confidence] = np.nan
+        with np.errstate(invalid='ignore'):
+            distances = np.linalg.norm(kpts[...,:2] - uv_cam[f], axis=-1)
+        valid = np.isfinite(distances)
+        if not valid.any():
+            continue
+        median = [np.median(d[v]) if v.any() else np.inf for d, v in zip(distances, valid)]
+        xy[f] = kpts[int(np.argmin(median)),:,:2]
+
+    return xy
+
+
+def reprojection_errors(uv, xy):
+    '''
+    Pixel distance between reprojected markers and 2D detections
+
+    INPUTS:
+    - uv, xy: arrays of shape (n_cams, n_frames, n_markers, 2)
+
+    OUTPUT:
+    - errors: array of shape (n_cams, n_frames, n_markers), NaN where either is missing
+    '''
+
+    return np.linalg.norm(uv - xy, axis=-1)
+
+
+def error_statistics(errors, cam_names, marker_names):
+    '''
+    Reprojection error statistics of each marker in each camera, and of each camera overall
+
+    INPUTS:
+    - errors: array of shape (n_cams, n_frames, n_markers), NaN values are ignored
+    - cam_names, marker_names: lists of names
+
+    OUTPUT:
+    - statistics: dict of camera name: dict of marker name (or 'all'):
+      dict with mean, median, rmse, max errors (px) and number of valid frames
+    '''
+
+    def describe(e, axis):
+        valid = np.isfinite(e)
+        n = valid.sum(axis=axis)
+        filled = np.where(valid, e, 0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = filled.sum(axis=axis) / n
+            rmse = np.sqrt((filled**2).sum(axis=axis) / n)
+        max_ = np.where(n > 0, np.where(valid, e, -np.inf).max(axis=axis), np.nan)
+        with warnings.catch_warnings(): # all-NaN slices for markers without detections
+            warnings.simplefilter('ignore', RuntimeWarning)
+            median = np.nanmedian(np.where(valid, e, np.nan), axis=axis)
+        return mean, median, rmse, max_, n
+
+    per_marker = describe(errors, axis=1) # (n_cams, n_markers)
+    per_cam = describe(errors.reshape(len(errors), -1), axis=1) # (n_cams,)
+
+    statistics = {}
+    for c, cam in enumerate(cam_names):
+        statistics[cam] = {marker: dict(zip(['mean', 'median', 'rmse', 'max', 'n_frames'], [float(s[c,m]) for s in per_marker[:4]] + [int(per_marker[4][c,m])]))
+                           for m, marker in enumerate(marker_names)}
+        statistics[cam]['all'] = dict(zip(['mean', 'median', 'rmse', 'max', 'n_frames'], [float(s[c]) for s in per_cam[:4]] + [int(per_cam[4][c])]))
+
+    return statistics
+
+
+def visibility_statistics(uv, visible, cam_names, marker_names):
+    '''
+    Fraction of frames where each marker is reprojected within each image,
+    when no detections are available to compute errors
+
+    OUTPUT:
+    - statistics: dict of camera name: dict of marker name (or 'all'):
+      dict with the fraction of visible frames and the number of reprojected frames
+    '''
+
+    reprojected = np.all(np.isfinite(uv), axis=-1)
+    n = reprojected.sum(axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        fraction = visible.sum(axis=1) / n
+
+    statistics = {}
+    for c, cam in enumerate(cam_names):
+        statistics[cam] = {marker: {'visible': float(fraction[c,m]), 'n_frames': int(n[c,m])} for m, marker in enumerate(marker_names)}
+        n_all = int(n[c].sum())
+        statistics[cam]['all'] = {'visible': float(visible[c].sum() / n_all) if n_all else float('nan'), 'n_frames': n_all}
+
+    return statistics
+
+
+def error_heatmap(errors, bin_size=HEATMAP_BIN):
+    '''
+    Mean reprojection error over consecutive bins of frames
+
+    INPUTS:
+    - errors: array of shape (n_cams, n_frames, n_markers)
+    - bin_size: number of frames per bin
+
+    OUTPUT:
+    - heatmap: array of shape (n_cams, n_markers, n_bins), NaN for bins without detection
+    '''
+
+    n_cams, n_frames, n_markers = errors.shape
+    n_bins = -(-n_frames // bin_size)
+    padded = np.full((n_cams, n_bins*bin_size, n_markers), np.nan)
+    padded[:,:n_frames] = errors
+    padded = padded.reshape(n_cams, n_bins, bin_size, n_markers)
+    valid = np.isfinite(padded)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        heatmap = np.where(valid, padded, 0).sum(axis=2) / valid.sum(axis=2)
+
+    return np.swapaxes(heatmap, 1, 2)
+
+
+def write_report(statistics, output_dir, heatmap=None, cam_names=None, marker_names=None, bin_size=HEATMAP_BIN):
+    '''
+    Save statistics as a json file, and heatmaps as one csv file per camera
+    (one row per marker, one column per bin of frames).
+    NaN statistics (markers without keypoint or without valid detection) are written as null.
+    '''
+
+    statistics = {cam: {marker: {k: v if np.isfinite(v) else None for k, v in s.items()} for marker, s in stats.items()}
+                  for cam, stats in statistics.items()}
+    os.makedirs(output_dir, exist_ok=True)
+    with open(os.path.join(output_dir, 'reprojection_statistics.json'), 'w') as f:
+        json.dump(statistics, f, indent=2, allow_nan=False)
+
+    if heatmap is not None:
+        header = 'marker,' + ','.join(str(b*bin_size) for b in range(heatmap.shape[-1]))
+        for c, cam in enumerate(cam_names):
+            rows = [f'{marker},' + ','.join(f'{e:.2f}' if np.isfinite(e) else '' for e in heatmap[c,m]) for m, marker in enumerate(marker_names)]
+            with open(os.path.join(output_dir, f'reprojection_heatmap_{cam}.csv'), 'w') as f:
+                f.write('\n'.join([header] + rows) + '\n')
+
+
+def print_report(statistics):
+    '''
+    Print one line per camera, and the worst marker of each camera
+    '''
+
+    for cam, stats in statistics.items():
+        markers = {m: s for m, s in stats.items() if m != 'all'}
+        if 'mean' in stats['all']:
+            worst = max(markers, key=lambda m: markers[m]['mean'] if np.isfinite(markers[m]['mean']) else -1)
+            print(f"{cam}: mean {stats['all']['mean']:.1f} px, median {stats['all']['median']:.1f} px, "
+                  f"rmse {stats['all']['rmse']:.1f} px, max {stats['all']['max']:.1f} px over {stats['all']['n_frames']} points. "
+                  f"Worst marker: {worst} ({markers[worst]['mean']:.1f} px)")
+        else:
+            hidden = [m for m, s in markers.items() if s['visible'] < 1]
+            print(f"{cam}: {stats['all']['visible']*100:.1f}% of {stats['all']['n_frames']} reprojected points within the image. "
+                  f"Markers partly outside: {', '.join(hidden) if hidden else 'none'}")
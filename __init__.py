@@ -67,6 +67,18 @@ __status__ = "Development"
 
 
 ## CLASSES
+class Pose2SimPreferences(bpy.types.AddonPreferences):
+    bl_idname = __name__
+
+    geometry_paths : StringProperty(
+        name='Geometry folders',
+        description=f"Additional folders where .osim geometry files are searched, separated by '{os.pathsep}'",
+        default='')
+
+    def draw(self, context):
+        self.layout.prop(self, "geometry_paths")
+
+
 bl_info = {
     "name": "Pose2Sim Blender",
     "author": "David Pagnon, Jonathan Camargo",
@@ -271,6 +283,17 @@ class addMarkers(bpy.types.Operator, bpy_extras.io_utils.ImportHelper):
         default='none'
     )
 
+    marker_mode: EnumProperty(
+        name="Markers as",
+        description="One object per marker, or one point cloud for all markers (faster with many markers, but no armature)",
+        items=[
+            ('objects', "Objects", "One animated object per marker"),
+            ('pointcloud', "Point cloud", "All markers in one mesh, displayed with Geometry Nodes"),
+            ('lazy', "Lazy point cloud", "Point cloud whose data stays on disk, for very long recordings"),
+        ],
+        default='objects'
+    )
+
     # File picker properties
     files: CollectionProperty(
         type=bpy.types.OperatorFileListElement,
@@ -282,13 +305,14 @@ class addMarkers(bpy.types.Operator, bpy_extras.io_utils.ImportHelper):
     def execute(self, context):
         for file in self.files:
             trc_path = os.path.join(self.directory, file.name)
-            markers.import_trc(trc_path, direction='zup', target_framerate=self.target_framerate, armature_type=self.armature_type)
+            markers.import_trc(trc_path, direction='zup', target_framerate=self.target_framerate, armature_type=self.armature_type, marker_mode=self.marker_mode)
         return {'FINISHED'}
 
     def draw(self, context):
         layout = self.layout
         layout.prop(self, "target_framerate")
         layout.prop(self, "armature_type")
+        layout.prop(self, "marker_mode")
 
     def invoke(self, context, event):
         context.window_manager.fileselect_add(self)
@@ -310,7 +334,8 @@ class addModel(bpy.types.Operator,bpy_extras.io_utils.ImportHelper):
     def execute(self, context):
         global osim_path
         osim_path= bpy.path.abspath(self.filepath)
-        model.import_model(osim_path,stlRoot=stlFolder)
+        geometry_paths = context.preferences.addons[__name__].preferences.geometry_paths
+        model.import_model(osim_path,stlRoot=stlFolder,geometry_paths=geometry_paths)
         return {'FINISHED'}
     
 
@@ -520,6 +545,7 @@ class panel1(bpy.types.Panel):
 def register():
     print('Addon Registered')
     
+    bpy.utils.register_class(Pose2SimPreferences)
     bpy.utils.register_class(importCal)
     bpy.utils.register_class(exportCal)
     bpy.utils.register_class(showImages)
@@ -529,6 +555,7 @@ def register():
     bpy.utils.register_class(addModel)
     bpy.utils.register_class(addMotion)
     bpy.utils.register_class(addForces)
+    markers.register_pointcloud_handler()
     
     bpy.utils.register_class(frameRange)
     bpy.types.Scene.before_after_frames = bpy.props.PointerProperty(type=frameRange)
@@ -557,6 +584,7 @@ def unregister():
     bpy.utils.unregister_class(addModel)
     bpy.utils.unregister_class(addMotion)
     bpy.utils.unregister_class(addForces)
+    markers.unregister_pointcloud_handler()
     
     bpy.utils.unregister_class(frameRange)
     bpy.utils.unregister_class(trackPoints)
@@ -568,6 +596,7 @@ def unregister():
     bpy.utils.unregister_class(alembicExport)
     
     bpy.utils.unregister_class(panel1)
+    bpy.utils.unregister_class(Pose2SimPreferences)
 
 
 # This allows you to run the script directly from Blender's Text editor
@@ -0,0 +1,418 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+'''
+    ####################################################
+    ## Pose2Sim Blender: headless batch import        ##
+    ####################################################
+
+    Import many Pose2Sim sessions without opening Blender's interface,
+    save them as .blend files, and optionally render them from each camera.
+    Several Blender instances run in parallel, one per session.
+
+    A session is either:
+    - a directory: the calibration .toml, .osim model, .mot or .csv motion,
+      .trc markers, .mot forces, and videos are searched for in it
+      (directories without any of these files are searched for sessions recursively)
+    - a manifest .toml or .json file, with optional keys (paths relative to the manifest):
+        osim = 'kinematics/model.osim'
+        motion = 'kinematics/motion.mot'
+        markers = ['pose-3d/markers.trc']
+        forces = 'forces.mot'
+        calibration = 'calibration/Calib.toml'
+        videos = ['videos/cam01.mp4', 'videos/cam02.mp4']
+        output = 'blender'
+        name = 'trial_01'
+      A manifest can also list several sessions under a 'sessions' key.
+
+    Usage:
+    python batch.py path/to/project path/to/manifest.toml --jobs 4 --blender path/to/blender
+    blender -b -P batch.py -- path/to/project --render
+
+    OPTIONS:
+    - --jobs: number of Blender instances running in parallel (default: half of the cores)
+    - --blender: path to the Blender executable (default: 'blender', or the running Blender)
+    - --output: output directory (default: 'blender' folder in each session)
+    - --framerate: target framerate of the animation (default: 'auto')
+    - --render: render the animation from each camera
+    - --render_format: 'movie' or 'images' (default: 'movie')
+    - --engine: render engine (default: 'BLENDER_WORKBENCH')
+    - --no_blend: do not save a .blend file
+
+    OUTPUTS:
+    - One .blend file per session, and its log file
+    - Rendered videos or images, if required
+'''
+
+
+## INIT
+import os
+import sys
+import glob
+import json
+import argparse
+import subprocess
+import importlib.util
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+rootpath = os.path.dirname(os.path.abspath(__file__))
+VIDEO_EXTENSIONS = ('.mp4', '.avi', '.mov', '.mkv')
+DATA_EXTENSIONS = ('.osim', '.mot', '.csv', '.trc', '.toml') + VIDEO_EXTENSIONS
+
+
+## AUTHORSHIP INFORMATION
+__author__ = "David Pagnon"
+__copyright__ = "Copyright 2023, Pose2Sim_Blender"
+__credits__ = ["David Pagnon"]
+__license__ = "MIT License"
+__version__ = "0.7.0"
+__maintainer__ = "David Pagnon"
+__email__ = "contact@david-pagnon.com"
+__status__ = "Development"
+
+
+## FUNCTIONS
+def load_manifest(manifest_path):
+    '''
+    Read a .toml or .json manifest, and make its paths absolute
+
+    INPUT:
+    - manifest_path: path to the manifest file
+
+    OUTPUT:
+    - sessions: list of session dicts
+    '''
+
+    if manifest_path.endswith('.json'):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+    else:
+        try:
+            import tomllib
+            with open(manifest_path, 'rb') as f:
+                manifest = tomllib.load(f)
+        except ImportError:
+            import toml
+            manifest = toml.load(manifest_path)
+
+    sessions = manifest if isinstance(manifest, list) else manifest.get('sessions', [manifest])
+    manifest_dir = os.path.dirname(os.path.abspath(manifest_path))
+    manifest_name = os.path.splitext(os.path.basename(manifest_path))[0]
+    for i, session in enumerate(sessions):
+        for key in ['osim', 'motion', 'forces', 'calibration', 'output']:
+            if session.get(key):
+                session[key] = os.path.join(manifest_dir, session[key])
+        for key in ['markers', 'videos']:
+            if isinstance(session.get(key), str):
+                session[key] = [session[key]]
+            session[key] = [os.path.join(manifest_dir, p) for p in session.get(key, [])]
+        session.setdefault('name', manifest_name if len(sessions) == 1 else f'{manifest_name}_{i}')
+        session.setdefault('output', os.path.join(manifest_dir, 'blender'))
+
+    return sessions
+
+
+def is_force_file(mot_path):
+    '''
+    True if a .mot file contains forces rather than coordinates
+    '''
+
+    with open(mot_path) as f:
+        for i, line in enumerate(f):
+            if line.strip().lower() == 'endheader' or i > 50:
+                break
+        header = f.readline().split()
+
+    return any(h.endswith('vx') for h in header)
+
+
+def find_session_files(session_dir):
+    '''
+    Search a Pose2Sim session directory for files to import
+
+    INPUT:
+    - session_dir: path to the session directory
+
+    OUTPUT:
+    - session: dict of file paths
+    '''
+
+    def find(*patterns):
+        return sorted(set(f for pattern in patterns for f in glob.glob(os.path.join(session_dir, pattern), recursive=True)))
+
+    calibrations = find('calibration/*.toml') or [c for c in find('**/*.toml') if 'calib' in os.path.basename(c).lower()]
+    osims = find('kinematics/*.osim') or find('**/*.osim')
+    mots = find('kinematics/*.mot') or find('**/*.mot')
+    motions = [m for m in mots if not is_force_file(m)] or find('kinematics/*.csv')
+    forces = [m for m in find('**/*.mot') if is_force_file(m)]
+    trcs = find('pose-3d/*.trc') or find('**/*.trc')
+    videos = [v for v in find('videos/*') if v.lower().endswith(VIDEO_EXTENSIONS)]
+
+    session = {
+        'name': os.path.basename(os.path.normpath(session_dir)),
+        'osim': osims[0] if osims else None,
+        'motion': motions[0] if motions else None,
+        'markers': trcs,
+        'forces': forces[0] if forces else None,
+        'calibration': calibrations[0] if calibrations else None,
+        'videos': videos,
+        'output': os.path.join(session_dir, 'blender'),
+        }
+
+    return session
+
+
+def find_sessions(path):
+    '''
+    Find sessions from a manifest file or a directory.
+    A directory is a session if it contains a 'pose-3d', 'kinematics', or 'calibration' folder,
+    or data files. Otherwise, its subdirectories are searched.
+
+    INPUT:
+    - path: path to a manifest or a directory
+
+    OUTPUT:
+    - sessions: list of session dicts
+    '''
+
+    if os.path.isfile(path):
+        return load_manifest(path)
+
+    subdirs = sorted(d for d in os.listdir(path) if os.path.isdir(os.path.join(path, d)))
+    has_files = any(f.lower().endswith(DATA_EXTENSIONS) and f != 'Config.toml' for f in os.listdir(path))
+    if has_files or any(d in subdirs for d in ['pose-3d', 'kinematics', 'calibration']):
+        return [find_session_files(path)]
+
+    sessions = []
+    for d in subdirs:
+        sessions += find_sessions(os.path.join(path, d))
+    return sessions
+
+
+def run_session(session, blender_path, args):
+    '''
+    Import one session in a new background Blender instance
+
+    INPUTS:
+    - session: session dict
+    - blender_path: path to the Blender executable
+    - args: command line arguments
+
+    OUTPUT:
+    - returncode: 0 if the session was imported successfully
+    - log_path: path to the log file
+    '''
+
+    output_dir = args.output or session['output']
+    os.makedirs(output_dir, exist_ok=True)
+    log_path = os.path.join(output_dir, session['name'] + '.log')
+
+    cmd = [blender_path, '-b', '--factory-startup', '--python-exit-code', '1',
+           '-P', os.path.abspath(__file__), '--',
+           '--worker', json.dumps(session),
+           '--framerate', str(args.framerate),
+           '--render_format', args.render_format,
+           '--engine', args.engine]
+    if args.output:
+        cmd += ['--output', args.output]
+    if args.render:
+        cmd += ['--render']
+    if args.no_blend:
+        cmd += ['--no_blend']
+
+    with open(log_path, 'w') as log:
+        returncode = subprocess.call(cmd, stdout=log, stderr=subprocess.STDOUT)
+
+    return returncode, log_path
+
+
+def run_batch(sessions, blender_path, args):
+    '''
+    Import all sessions, with several Blender instances in parallel
+    '''
+
+    print(f'Importing {len(sessions)} sessions with {args.jobs} Blender instances in parallel.')
+    failed = []
+    with ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        futures = {executor.submit(run_session, session, blender_path, args): session for session in sessions}
+        for future in as_completed(futures):
+            session = futures[future]
+            try:
+                returncode, log_path = future.result()
+            except Exception as e:
+                returncode, log_path = 1, str(e)
+            if returncode == 0:
+                print(f'{session["name"]}: done.')
+            else:
+                failed.append(session['name'])
+                print(f'{session["name"]}: FAILED. See {log_path}')
+
+    print(f'\n{len(sessions)-len(failed)}/{len(sessions)} sessions imported.')
+    if failed:
+        print(f'Failed sessions: {", ".join(failed)}')
+    return len(failed) == 0
+
+
+def import_addon():
+    '''
+    Import the add-on modules from this directory,
+    even if another version of the add-on is installed in Blender
+    '''
+
+    spec = importlib.util.spec_from_file_location('Pose2Sim_Blender_batch', os.path.join(rootpath, '__init__.py'),
+                                                  submodule_search_locations=[rootpath])
+    addon = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = addon
+    spec.loader.exec_module(addon)
+
+    return addon
+
+
+def render_cams(output_dir, render_format='movie', engine='BLENDER_WORKBENCH'):
+    '''
+    Render the animation from each camera of the scene.
+    Unlike cameras.film_from_cams, does not require a 3D viewport.
+    '''
+
+    import bpy
+
+    scene = bpy.context.scene
+    scene.render.engine = engine
+    if render_format == 'movie':
+        scene.render.image_settings.file_format = 'FFMPEG'
+        scene.render.ffmpeg.format = 'MPEG4'
+        scene.render.ffmpeg.codec = 'H264'
+        scene.render.ffmpeg.audio_codec = 'NONE'
+        extension = 'mp4'
+    else:
+        scene.render.image_settings.file_format = 'PNG'
+        extension = 'png'
+
+    cams = [ob for ob in scene.objects if ob.type == 'CAMERA']
+    for cam in cams:
+        scene.camera = cam
+        scene.render.filepath = os.path.join(output_dir, cam.name, cam.name+'.'+extension)
+        bpy.ops.render.render(animation=True)
+        print(f'Rendered {cam.name} to {os.path.dirname(scene.render.filepath)}')
+
+
+def import_session(session, args):
+    '''
+    Import one session in the running Blender instance,
+    save it as a .blend file, and render it if required
+    '''
+
+    import bpy
+
+    addon = import_addon()
+    bpy.ops.wm.read_factory_settings(use_empty=True)
+    scene = bpy.context.scene
+    framerate = args.framerate
+
+    # cameras and videos
+    if session.get('calibration'):
+        addon.cameras.import_cameras(session['calibration'])
+        cams = [ob for ob in scene.objects if ob.type == 'CAMERA']
+        for video in session.get('videos', []):
+            video_name = os.path.splitext(os.path.basename(video))[0].lower()
+            cam = [c for c in cams if c.name.lower() in video_name or video_name in c.name.lower()]
+            if cam:
+                try:
+                    bpy.context.view_layer.objects.active = cam[0]
+                    addon.cameras.show_images(cam[0], video)
+                except Exception as e:
+                    print(f'WARNING: Could not show {video} on {cam[0].name}: {e}')
+            else:
+                print(f'WARNING: No camera found for {video}')
+
+    # model and motion
+    if session.get('osim'):
+        collections_before = set(bpy.data.collections)
+        addon.model.import_model(session['osim'], stlRoot=addon.stlFolder)
+        model_collection = [c for c in bpy.data.collections if c not in collections_before][0]
+        if session.get('motion'):
+            layer_collection = bpy.context.view_layer.layer_collection.children[model_collection.name]
+            bpy.context.view_layer.active_layer_collection = layer_collection
+            addon.motion.apply_mot_to_model(session['motion'], session['osim'], direction='zup', target_framerate=framerate)
+
+    # markers and forces
+    for trc_path in session.get('markers', []):
+        addon.markers.import_trc(trc_path, direction='zup', target_framerate=framerate, armature_type='none')
+    if session.get('forces'):
+        grf_framerate = scene.render.fps if framerate == 'auto' else int(framerate)
+        addon.forces.import_forces(session['forces'], direction='zup', target_framerate=grf_framerate)
+
+    # frame range
+    frame_ranges = [a.frame_range for a in bpy.data.actions]
+    if frame_ranges:
+        scene.frame_start = int(min(f[0] for f in frame_ranges))
+        scene.frame_end = int(max(f[1] for f in frame_ranges))
+
+    # save and render
+    output_dir = args.output or session['output']
+    os.makedirs(output_dir, exist_ok=True)
+    if not args.no_blend:
+        blend_path = os.path.join(output_dir, session['name']+'.blend')
+        bpy.ops.wm.save_as_mainfile(filepath=blend_path)
+        print(f'Session saved to {blend_path}')
+    if args.render:
+        render_cams(os.path.join(output_dir, session['name']), render_format=args.render_format, engine=args.engine)
+
+
+def parse_args(argv):
+    '''
+    Parse command line arguments.
+    When run from Blender, arguments are those after '--'.
+    '''
+
+    if '--' in argv:
+        argv = argv[argv.index('--')+1:]
+    else:
+        argv = argv[1:]
+
+    parser = argparse.ArgumentParser(description='Import Pose2Sim sessions into Blender without user interface.')
+    parser.add_argument('sessions', nargs='*', help='Session directories or manifest files (.toml or .json)')
+    parser.add_argument('--jobs', type=int, default=max(1, (os.cpu_count() or 2)//2), help='Number of Blender instances running in parallel')
+    parser.add_argument('--blender', default=None, help='Path to the Blender executable')
+    parser.add_argument('--output', default=None, help='Output directory (default: blender folder in each session)')
+    parser.add_argument('--framerate', default='auto', help='Target framerate of the animation')
+    parser.add_argument('--render', action='store_true', help='Render the animation from each camera')
+    parser.add_argument('--render_format', default='movie', choices=['movie', 'images'], help='Render as movie or image sequence')
+    parser.add_argument('--engine', default='BLENDER_WORKBENCH', help='Render engine')
+    parser.add_argument('--no_blend', action='store_true', help='Do not save a .blend file')
+    parser.add_argument('--worker', default=None, help=argparse.SUPPRESS) # session dict, set by run_session
+
+    return parser.parse_args(argv)
+
+
+def main(argv=sys.argv):
+    args = parse_args(argv)
+
+    # worker: import one session in this Blender instance
+    if args.worker:
+        import_session(json.loads(args.worker), args)
+        return
+
+    # main process: dispatch sessions to Blender instances
+    sessions = []
+    for path in args.sessions:
+        sessions += find_sessions(os.path.abspath(path))
+    if not sessions:
+        print('No session found.')
+        sys.exit(1)
+
+    blender_path = args.blender
+    if blender_path is None:
+        try:
+            import bpy
+            blender_path = bpy.app.binary_path
+        except ImportError:
+            blender_path = 'blender'
+
+    if not run_batch(sessions, blender_path, args):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+'''
+    ####################################################
+    ## Pose2Sim Blender: TRC parser benchmark         ##
+    ####################################################
+
+    Compare the streaming .trc parser of the add-on (markers.parse_trc)
+    with the previous np.genfromtxt reader: same output, and parsing time.
+    The cache is not used, so that text parsing is measured.
+
+    By default, the .trc files of the Examples folder are used, as well as
+    a long file made of 100 copies of Pose2Sim_markers.trc with missing markers (gaps).
+
+    Usage:
+    blender -b -P benchmark_trc.py
+    blender -b -P benchmark_trc.py -- path/to/file1.trc path/to/file2.trc --repeats 5
+    python benchmark_trc.py (if the bpy module is installed)
+
+    OPTIONS:
+    - --repeats: number of runs of each parser, the fastest one is reported (default: 3)
+    - --copies: number of copies of Pose2Sim_markers.trc in the long file (default: 100)
+
+    OUTPUTS:
+    - One line per file: parsing times, and whether outputs are identical
+'''
+
+
+## INIT
+import os
+import sys
+import time
+import argparse
+import tempfile
+import numpy as np
+
+rootpath = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, rootpath) # not done by blender -P
+from batch import import_addon
+
+EXAMPLES = [os.path.join(rootpath, 'Examples', f) for f in ('Moco_markers.trc', 'Pose2Sim_markers.trc')]
+GAP_FRACTION = 0.05 # fraction of missing markers in the long file
+
+
+## AUTHORSHIP INFORMATION
+__author__ = "David Pagnon"
+__copyright__ = "Copyright 2023, Pose2Sim_Blender"
+__credits__ = ["David Pagnon"]
+__license__ = "MIT License"
+__version__ = "0.7.0"
+__maintainer__ = "David Pagnon"
+__email__ = "contact@david-pagnon.com"
+__status__ = "Development"
+
+
+## FUNCTIONS
+def genfromtxt_trc(trc_path):
+    '''
+    Previous trc reader, for reference
+
+    INPUT:
+    - trc_path: path to the .trc file
+
+    OUTPUT:
+    - trc_data_np: 2D numpy array with marker coordinates at each time step
+    - markerNames: list of marker names
+    '''
+
+    trc_data_np = np.genfromtxt(trc_path, skip_header=5, delimiter = '\t')
+    with open(trc_path) as f:
+        header_lines = [f.readline() for _ in range(4)]
+    markerNames = [n.strip() for n in header_lines[3].split('\t')[2:] if n.strip()]
+
+    return trc_data_np, markerNames
+
+
+def write_long_trc(trc_path, out_path, copies=100, gap_fraction=GAP_FRACTION, seed=0):
+    '''
+    Write a long .trc file made of copies of trc_path,
+    with frame numbers and times continued, and random missing markers (empty cells)
+    '''
+
+    with open(trc_path) as f:
+        header_lines = [f.readline() for _ in range(5)]
+        rows = [l.rstrip('\r\n').split('\t') for l in f if l.strip()]
+    n_markers = (len(rows[0]) - 2) // 3
+    dt = float(rows[1][1]) - float(rows[0][1])
+    rng = np.random.default_rng(seed)
+
+    n_frames = copies * len(rows)
+    header_lines[2] = header_lines[2].replace(f'\t{len(rows)}\t', f'\t{n_frames}\t', 1)
+    with open(out_path, 'w') as f:
+        f.writelines(header_lines)
+        for i in range(n_frames):
+            row = rows[i % len(rows)].copy()
+            row[0], row[1] = str(i+1), f'{(i+1)*dt:.6f}'
+            for m in np.flatnonzero(rng.random(n_markers) < gap_fraction):
+                row[2+3*m:5+3*m] = ['', '', '']
+            f.write('\t'.join(row) + '\n')
+
+
+def best_time(parser, trc_path, repeats=3):
+    '''
+    Fastest of several runs of a parser, and its output
+    '''
+
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        output = parser(trc_path)
+        times.append(time.perf_counter() - start)
+
+    return min(times), output
+
+
+def compare(trc_path, parse_trc, repeats=3):
+    '''
+    Parse a file with both readers, check outputs are identical, and print times
+    '''
+
+    t_ref, (ref_data, ref_names) = best_time(genfromtxt_trc, trc_path, repeats=repeats)
+    t_new, (new_data, new_names) = best_time(parse_trc, trc_path, repeats=repeats)
+    n_cols = new_data.shape[1] # genfromtxt adds an empty column for trailing tabs
+    identical = (ref_names == new_names and ref_data.shape[0] == new_data.shape[0]
+                 and np.allclose(ref_data[:,:n_cols], new_data, equal_nan=True))
+    print(f'{os.path.basename(trc_path)} ({len(new_data)} frames, {len(new_names)} markers): '
+          f'genfromtxt {t_ref:.3f} s -> parse_trc {t_new:.3f} s (x{t_ref/t_new:.1f}), '
+          f'{"identical" if identical else "DIFFERENT"} outputs')
+
+    return identical
+
+
+def parse_args(argv):
+    '''
+    Parse command line arguments.
+    When run from Blender, arguments are those after '--'.
+    '''
+
+    if '--' in argv:
+        argv = argv[argv.index('--')+1:]
+    else:
+        argv = argv[1:] if argv and argv[0].endswith('.py') else []
+
+    parser = argparse.ArgumentParser(description='Compare the trc parser of the add-on with np.genfromtxt.')
+    parser.add_argument('trc_files', nargs='*', help='.trc files (default: Examples, and a long file with gaps)')
+    parser.add_argument('--repeats', type=int, default=3, help='Number of runs of each parser')
+    parser.add_argument('--copies', type=int, default=100, help='Number of copies of Pose2Sim_markers.trc in the long file')
+
+    return parser.parse_args(argv)
+
+
+def main(argv=sys.argv):
+    args = parse_args(argv)
+    addon = import_addon()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        trc_files = args.trc_files
+        if not trc_files:
+            long_trc = os.path.join(tmp_dir, f'Pose2Sim_markers_x{args.copies}_gaps.trc')
+            write_long_trc(EXAMPLES[1], long_trc, copies=args.copies)
+            trc_files = EXAMPLES + [long_trc]
+        identical = [compare(trc_path, addon.markers.parse_trc, repeats=args.repeats) for trc_path in trc_files]
+
+    if not all(identical):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()